@@ -0,0 +1,158 @@
+"""
+Engine (see engine.py) running on asyncio only, used with --no-gui
+and by the system daemon : no Qt needed
+"""
+
+import asyncio
+import os
+import threading
+
+from enacrestic.engine import Process, Timer
+
+READ_CHUNK_SIZE = 65536
+# Output still pending once the process exited is read for that long at most
+# (e.g. a grandchild keeping the pipe open)
+DRAIN_TIMEOUT_SECONDS = 1
+
+
+class AsyncioTimer(Timer):
+    def __init__(self, loop, callback, single_shot=False):
+        super().__init__(callback, single_shot)
+        self.loop = loop
+        self.handle = None
+        self.interval = None
+
+    def start(self, msec):
+        self.stop()
+        self.interval = msec / 1000
+        self.handle = self.loop.call_later(self.interval, self._timeout)
+
+    def stop(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+    def is_active(self):
+        return self.handle is not None
+
+    def _timeout(self):
+        if self.single_shot:
+            self.handle = None
+        else:
+            self.handle = self.loop.call_later(self.interval, self._timeout)
+        self.callback()
+
+
+class AsyncioProcess(Process):
+    def __init__(self, loop):
+        super().__init__()
+        self.loop = loop
+        self.stdin_fd = None
+        self.stdout_fd = None
+        self.task = None
+
+    def pipe_to(self, process):
+        process.stdin_fd, self.stdout_fd = os.pipe()
+
+    def start(self, cmd, args, env=None, cwd=None):
+        self.running = True
+        self.task = self.loop.create_task(self._run(cmd, args, env, cwd))
+
+    async def _run(self, cmd, args, env, cwd):
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                cmd,
+                *args,
+                env=env,
+                cwd=cwd,
+                stdin=(
+                    asyncio.subprocess.DEVNULL
+                    if self.stdin_fd is None
+                    else self.stdin_fd
+                ),
+                stdout=(
+                    asyncio.subprocess.PIPE
+                    if self.stdout_fd is None
+                    else self.stdout_fd
+                ),
+                stderr=asyncio.subprocess.PIPE,
+            )
+        except OSError as e:
+            self._close_pipe_ends()
+            self._failed_to_start(str(e))
+            return
+        # The child has its own copies
+        self._close_pipe_ends()
+        self._started(proc.pid)
+        readers = [
+            self.loop.create_task(self._read(proc.stderr, self._received_stderr))
+        ]
+        if proc.stdout is not None:
+            readers.append(
+                self.loop.create_task(self._read(proc.stdout, self._received_stdout))
+            )
+        returncode = await proc.wait()
+        _, pending = await asyncio.wait(readers, timeout=DRAIN_TIMEOUT_SECONDS)
+        for reader in pending:
+            reader.cancel()
+        if returncode < 0:
+            # Same as Qt : the signal number
+            self._finished(-returncode, True)
+        else:
+            self._finished(returncode, False)
+
+    async def _read(self, stream, on_data):
+        while True:
+            data = await stream.read(READ_CHUNK_SIZE)
+            if not data:
+                return
+            on_data(data)
+
+    def _close_pipe_ends(self):
+        for fd in (self.stdin_fd, self.stdout_fd):
+            if fd is not None:
+                os.close(fd)
+        self.stdin_fd = None
+        self.stdout_fd = None
+
+
+class AsyncioEngine:
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.exit_code = 0
+
+    def timer(self, callback, single_shot=False):
+        return AsyncioTimer(self.loop, callback, single_shot)
+
+    def single_shot(self, msec, callback):
+        self.loop.call_later(msec / 1000, callback)
+
+    def process(self):
+        return AsyncioProcess(self.loop)
+
+    def add_signal_handler(self, signum, callback):
+        self.loop.add_signal_handler(signum, callback)
+
+    def watch_resume(self, callback):
+        # No D-Bus without Qt, the scheduler detects wall-clock jumps
+        return False
+
+    def run_in_thread(self, function, on_done):
+        def _target():
+            result = function()
+            try:
+                self.loop.call_soon_threadsafe(on_done, result)
+            except RuntimeError:
+                pass  # Loop closed, the app is gone
+
+        # Daemon thread : never delays the exit
+        threading.Thread(target=_target, daemon=True).start()
+
+    def exec(self):
+        self.loop.run_forever()
+        return self.exit_code
+
+    def quit(self, exit_code=0):
+        self.exit_code = exit_code
+        self.loop.stop()
@@ -0,0 +1,430 @@
+"""
+`enacrestic benchmark` : find the best --compression and --pack-size
+for this machine.
+
++ samples a subset of the files of bkp_include,
+  read once first so that every setting reads it from the page cache
++ backs it up to a scratch local repository
+  with each compression level and pack size,
+  measuring the throughput, the CPU time and the size stored
++ recommends, for each bandwidth profile (and "default"), the setting
+  giving the best effective throughput : restic compresses and uploads
+  at the same time, so it runs at the slowest of
+  + the CPU (throughput measured locally)
+  + the uplink (uplink speed / compression ratio)
+  Among settings within 5% of the best, the one storing less wins.
++ optionally saves them as "backup_tuning" in prefs.json,
+  used by every backup afterwards (the app has to be quit first,
+  it would write its own conf back when quitting)
+
+`enacrestic benchmark --read-concurrency` : how many files restic should
+read at once on the storage of --scratch-dir (see storage.py).
+
++ generates a tree of small and large files, evicted from the page cache
++ reads it with `restic backup --dry-run` (reading and chunking,
+  nothing stored) at each read concurrency
++ compares them with restic's default and with the value ENACrestic
+  starts from for this storage class
+"""
+
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+
+from pidfile import PIDFile
+
+from enacrestic import const
+from enacrestic.conf import Conf, update_conf_file
+from enacrestic.history import RunHistory
+from enacrestic.state import Operation, Status
+from enacrestic.storage import classify_path
+from enacrestic.time_windows import window_name
+from enacrestic.utils import bytes_to_human
+
+MIB = 1024**2
+# restic's default --read-concurrency
+RESTIC_READ_CONCURRENCY = 2
+
+
+def sample_files(roots, budget_bytes, max_files_scanned, seed=0):
+    """
+    return a random list of files under roots, totalling about budget_bytes
+    Directories are walked in random order, to cover the whole tree
+    even when only max_files_scanned files are looked at
+    """
+    rnd = random.Random(seed)
+    candidates = []
+    for root in roots:
+        if os.path.isfile(root):
+            candidates.append((root, os.path.getsize(root)))
+            continue
+        for dirpath, dirnames, filenames in os.walk(root):
+            rnd.shuffle(dirnames)
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    if os.path.islink(path) or not os.path.isfile(path):
+                        continue
+                    candidates.append((path, os.path.getsize(path)))
+                except OSError:
+                    continue
+            if len(candidates) >= max_files_scanned:
+                break
+    rnd.shuffle(candidates)
+    sample = []
+    total = 0
+    for path, size in candidates:
+        # Keep room for several files, not a single huge one
+        if size > budget_bytes / 4 or total >= budget_bytes:
+            continue
+        sample.append(path)
+        total += size
+    return sample, total
+
+
+def effective_throughput(result, uplink):
+    """
+    return the expected backup throughput (input bytes/s)
+    of a benchmark result on an uplink (bytes/s, None if unlimited)
+    """
+    if uplink is None:
+        return result["throughput"]
+    ratio = result["stored_size"] / max(result["input_size"], 1)
+    return min(result["throughput"], uplink / max(ratio, 1e-6))
+
+
+def recommend(results, uplink):
+    """
+    return the best result for an uplink (bytes/s, None if unlimited)
+    """
+    best = max(effective_throughput(result, uplink) for result in results)
+    good_enough = [
+        result
+        for result in results
+        if effective_throughput(result, uplink) >= 0.95 * best
+    ]
+    return min(good_enough, key=lambda result: result["stored_size"])
+
+
+def estimated_uplink():
+    """
+    return the best upload throughput (bytes/s) achieved by past backups,
+    a lower bound of the uplink speed. None if unknown
+    """
+    throughputs = [
+        run["bytes_uploaded"] / run["seconds"]
+        for run in RunHistory().get_runs((Operation.BACKUP,), limit=100)
+        if run["status"] == Status.OK.value
+        and run.get("bytes_uploaded")
+        and run["seconds"] > 0
+        and run.get("limit_upload") is None
+    ]
+    if len(throughputs) == 0:
+        return None
+    return max(throughputs)
+
+
+def generate_tree(root, total_bytes, seed=0):
+    """
+    Write about total_bytes of incompressible files under root :
+    half of them small (16-256 KiB), half large (1-8 MiB),
+    100 files per folder. return the number of files
+    """
+    rnd = random.Random(seed)
+    total = 0
+    nb_files = 0
+    while total < total_bytes:
+        if rnd.random() < 0.5:
+            size = rnd.randint(16 * 1024, 256 * 1024)
+        else:
+            size = rnd.randint(1 * MIB, 8 * MIB)
+        size = min(size, total_bytes - total)
+        folder = os.path.join(root, f"{nb_files // 100:04d}")
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, f"{nb_files:06d}.bin"), "wb") as f:
+            f.write(os.urandom(size))
+            f.flush()
+            os.fsync(f.fileno())
+        total += size
+        nb_files += 1
+    return nb_files
+
+
+def warm_page_cache(paths):
+    """
+    Read the files once, so that the measures don't depend on
+    which of them are already in the page cache
+    """
+    for path in paths:
+        try:
+            with open(path, "rb") as f:
+                while f.read(MIB):
+                    pass
+        except OSError:
+            continue
+
+
+def evict_from_cache(root):
+    """
+    Drop the (clean) pages of the files under root from the page cache,
+    so that they are read from the storage again
+    """
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            fd = os.open(os.path.join(dirpath, filename), os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+
+
+class Benchmark:
+    def __init__(self, args):
+        self.args = args
+        self.env = {
+            key: value
+            for key, value in os.environ.items()
+            if key
+            not in (
+                "RESTIC_REPOSITORY",
+                "RESTIC_PASSWORD_FILE",
+                "RESTIC_PASSWORD_COMMAND",
+            )
+        }
+        self.env.update({"LC_ALL": "C", "RESTIC_PASSWORD": "benchmark"})
+
+    def _restic(self, repo, args):
+        """
+        run restic on the scratch repository, return its stdout
+        """
+        p = subprocess.run(
+            ["restic", "--repo", repo, "--no-cache"] + args,
+            env=self.env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+        )
+        if p.returncode != 0:
+            raise RuntimeError(p.stderr.strip())
+        return p.stdout
+
+    def _measure(self, files_from, input_size, compression, pack_size):
+        scratch = tempfile.mkdtemp(
+            prefix="enacrestic-benchmark-", dir=self.args.scratch_dir
+        )
+        repo = os.path.join(scratch, "repo")
+        try:
+            self._restic(repo, ["init", "--repository-version", "2"])
+            cpu_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+            start = time.monotonic()
+            self._restic(
+                repo,
+                [
+                    "backup",
+                    "--files-from-verbatim",
+                    files_from,
+                    "--compression",
+                    compression,
+                    "--pack-size",
+                    str(pack_size),
+                    "--json",
+                ],
+            )
+            seconds = time.monotonic() - start
+            cpu_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+            stats = json.loads(
+                self._restic(repo, ["stats", "--mode", "raw-data", "--json"])
+            )
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+        return {
+            "compression": compression,
+            "pack_size": pack_size,
+            "input_size": input_size,
+            "seconds": seconds,
+            "cpu_seconds": (cpu_after.ru_utime - cpu_before.ru_utime)
+            + (cpu_after.ru_stime - cpu_before.ru_stime),
+            "throughput": input_size / max(seconds, 1e-3),
+            "stored_size": stats["total_size"],
+        }
+
+    def run(self):
+        """
+        return the exit code of `enacrestic benchmark`
+        """
+        if self.args.save and PIDFile(const.PID_FILE).is_running:
+            print(
+                "ENACrestic is running: quit it first, "
+                "it would overwrite backup_tuning when quitting"
+            )
+            return 1
+        try:
+            with open(const.RESTIC_USER_PREFS["FILESFROM"], "r") as f:
+                roots = [
+                    os.path.expanduser(line.strip())
+                    for line in f.readlines()
+                    if line.strip() != "" and not line.startswith("#")
+                ]
+        except FileNotFoundError:
+            print(f"{const.RESTIC_USER_PREFS['FILESFROM']} not found")
+            return 1
+
+        print("Sampling files to back up ...")
+        sample, input_size = sample_files(
+            roots, self.args.sample_mib * MIB, const.BENCHMARK_MAX_FILES_SCANNED
+        )
+        if input_size == 0:
+            print("No file to sample")
+            return 1
+        print(f"{len(sample)} files, {bytes_to_human(input_size)}\n")
+        warm_page_cache(sample)
+
+        results = []
+        with tempfile.NamedTemporaryFile("w", suffix=".txt") as files_from:
+            files_from.write("\n".join(sample) + "\n")
+            files_from.flush()
+            for compression in const.BENCHMARK_COMPRESSIONS:
+                for pack_size in const.BENCHMARK_PACK_SIZES_MIB:
+                    try:
+                        result = self._measure(
+                            files_from.name, input_size, compression, pack_size
+                        )
+                    except (OSError, RuntimeError, ValueError) as e:
+                        print(f"compression {compression}, pack size {pack_size}: {e}")
+                        return 1
+                    results.append(result)
+                    print(
+                        f"compression {compression:<4} pack size {pack_size:>3} MiB : "
+                        f"{bytes_to_human(result['throughput'])}/s, "
+                        f"{result['cpu_seconds']:.1f} s CPU, "
+                        f"stored {bytes_to_human(result['stored_size'])} "
+                        f"({100 * result['stored_size'] / input_size:.0f}%)"
+                    )
+
+        tuning = self._recommendations(results)
+        if self.args.save:
+            update_conf_file(backup_tuning=tuning)
+            print(f"\nSaved as backup_tuning in {const.RESTIC_CONFFILE}")
+        else:
+            print("\nUse --save to use these settings for the next backups")
+        return 0
+
+    def _recommendations(self, results):
+        """
+        return {profile name: {"compression": ..., "pack_size": ...}}
+        and print them
+        """
+        if self.args.uplink_mbps is not None:
+            uplink = self.args.uplink_mbps * 1e6 / 8
+            origin = "given"
+        else:
+            uplink = estimated_uplink()
+            origin = "best of past backups"
+        print(
+            "\nUplink: "
+            + (
+                "unknown (considered unlimited)"
+                if uplink is None
+                else f"{bytes_to_human(uplink)}/s ({origin})"
+            )
+        )
+
+        profiles = [("default", uplink)]
+        for profile in Conf.read().bandwidth_profiles:
+            limit_upload = profile.get("limit_upload")
+            if limit_upload == 0:
+                continue
+            profile_uplink = uplink
+            if limit_upload is not None:
+                profile_uplink = limit_upload * 1024
+                if uplink is not None:
+                    profile_uplink = min(profile_uplink, uplink)
+            profiles.append((window_name(profile), profile_uplink))
+
+        tuning = {}
+        for name, profile_uplink in profiles:
+            best = recommend(results, profile_uplink)
+            tuning[name] = {
+                "compression": best["compression"],
+                "pack_size": best["pack_size"],
+            }
+            print(
+                f"Recommended for '{name}': --compression {best['compression']} "
+                f"--pack-size {best['pack_size']} "
+                f"(~{bytes_to_human(effective_throughput(best, profile_uplink))}/s)"
+            )
+        return tuning
+
+
+class ReadConcurrencyBenchmark(Benchmark):
+    def _measure_read(self, repo, tree, tree_bytes, read_concurrency):
+        evict_from_cache(tree)
+        self.env["RESTIC_READ_CONCURRENCY"] = str(read_concurrency)
+        start = time.monotonic()
+        self._restic(repo, ["backup", "--dry-run", "--json", tree])
+        seconds = time.monotonic() - start
+        return {
+            "read_concurrency": read_concurrency,
+            "seconds": seconds,
+            "throughput": tree_bytes / max(seconds, 1e-3),
+        }
+
+    def run(self):
+        """
+        return the exit code of `enacrestic benchmark --read-concurrency`
+        """
+        tree_folder = self.args.scratch_dir or const.ENACRESTIC_PREF_FOLDER
+        storage_class = classify_path(tree_folder)
+        print(f"Storage of {tree_folder}: {storage_class or 'unknown'}")
+        tree = tempfile.mkdtemp(prefix="enacrestic-benchmark-tree-", dir=tree_folder)
+        scratch = tempfile.mkdtemp(prefix="enacrestic-benchmark-")
+        repo = os.path.join(scratch, "repo")
+        results = []
+        try:
+            print(f"Generating {self.args.tree_mib} MiB of files ...")
+            nb_files = generate_tree(tree, self.args.tree_mib * MIB)
+            print(f"{nb_files} files\n")
+            self._restic(repo, ["init", "--repository-version", "2"])
+            for read_concurrency in const.BENCHMARK_READ_CONCURRENCIES:
+                result = self._measure_read(
+                    repo, tree, self.args.tree_mib * MIB, read_concurrency
+                )
+                results.append(result)
+                print(
+                    f"read concurrency {read_concurrency:>2} : "
+                    f"{bytes_to_human(result['throughput'])}/s "
+                    f"({result['seconds']:.1f} s)"
+                )
+        except (OSError, RuntimeError) as e:
+            print(f"Benchmark failed: {e}")
+            return 1
+        finally:
+            shutil.rmtree(tree, ignore_errors=True)
+            shutil.rmtree(scratch, ignore_errors=True)
+
+        throughputs = {
+            result["read_concurrency"]: result["throughput"] for result in results
+        }
+        best = max(results, key=lambda result: result["throughput"])
+        print(
+            f"\nBest: {best['read_concurrency']} files at once, "
+            f"{bytes_to_human(best['throughput'])}/s"
+        )
+        if RESTIC_READ_CONCURRENCY in throughputs:
+            print(
+                f"  {best['throughput'] / throughputs[RESTIC_READ_CONCURRENCY]:.2f}x "
+                f"restic's default ({RESTIC_READ_CONCURRENCY})"
+            )
+        start_value = const.READ_CONCURRENCY_PER_STORAGE.get(storage_class)
+        if start_value in throughputs and RESTIC_READ_CONCURRENCY in throughputs:
+            print(
+                f"ENACrestic starts with {start_value} on {storage_class} storage: "
+                f"{throughputs[start_value] / throughputs[RESTIC_READ_CONCURRENCY]:.2f}x "
+                "restic's default (refined over the backups afterwards)"
+            )
+        return 0
@@ -0,0 +1,373 @@
+"""
+Local catalog of the repository's snapshots, stored in a SQLite database
+(~/.enacrestic/catalog.sqlite), to list them instantly, even offline.
+
+It is updated
+
++ incrementally after each backup (from its JSON summary)
++ after each forget (its JSON output lists every snapshot kept)
++ by a full sync (`restic snapshots --json`)
+  when none happened for CATALOG_SYNC_EVERY_N_HOURS
+
+Since it is a cache, consumers are told how old its data is.
+"""
+
+import datetime
+import json
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+
+from enacrestic import const
+from enacrestic.utils import (
+    bytes_to_human,
+    load_restic_env,
+    parse_restic_time,
+    utc_to_local_str,
+)
+
+DB_DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def age_to_human(utc_dt, now_utc_dt=None):
+    """
+    return nice age as "3 min ago"
+    """
+    if utc_dt is None:
+        return "never"
+    if now_utc_dt is None:
+        now_utc_dt = datetime.datetime.utcnow()
+    seconds = max((now_utc_dt - utc_dt).total_seconds(), 0)
+    if seconds < 60:
+        return "just now"
+    for unit, unit_seconds in (("day", 86400), ("h", 3600), ("min", 60)):
+        if seconds >= unit_seconds:
+            nb_units = int(seconds // unit_seconds)
+            if unit == "day" and nb_units > 1:
+                unit = "days"
+            return f"{nb_units} {unit} ago"
+
+
+class SnapshotCatalog:
+    def __init__(self, db_path=const.CATALOG_DB):
+        self.db = sqlite3.connect(db_path)
+        self.db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS snapshots (
+                id TEXT PRIMARY KEY,
+                short_id TEXT NOT NULL,
+                time_utc TEXT NOT NULL,
+                hostname TEXT,
+                username TEXT,
+                paths TEXT NOT NULL,
+                tags TEXT NOT NULL,
+                total_bytes_processed INTEGER,
+                data_added INTEGER
+            )
+            """
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS snapshots_time ON snapshots (time_utc)"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+        )
+        # Snapshots already copied to the secondary repository
+        self.db.execute("CREATE TABLE IF NOT EXISTS replicated (id TEXT PRIMARY KEY)")
+        self.db.commit()
+
+    def _get_meta_dt(self, key):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        return datetime.datetime.strptime(row[0], DB_DATE_FORMAT)
+
+    def _set_meta_dt(self, key, utc_dt):
+        self.db.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+            (key, utc_dt.strftime(DB_DATE_FORMAT)),
+        )
+
+    @property
+    def last_update_utc_dt(self):
+        """
+        Last time the catalog has been updated, None if never
+        """
+        return self._get_meta_dt("last_update")
+
+    @property
+    def last_sync_utc_dt(self):
+        """
+        Last time the catalog has been synced with the whole repository,
+        None if never
+        """
+        return self._get_meta_dt("last_sync")
+
+    def sync_is_due(self):
+        """
+        Answer if a full sync should be run
+        """
+        last_sync_utc_dt = self.last_sync_utc_dt
+        return last_sync_utc_dt is None or (
+            datetime.datetime.utcnow() - last_sync_utc_dt
+            >= datetime.timedelta(hours=const.CATALOG_SYNC_EVERY_N_HOURS)
+        )
+
+    def _upsert(self, snapshot):
+        """
+        Insert or update a snapshot as given by restic --json
+        Sizes are kept if restic doesn't give them (before restic 0.17)
+        """
+        summary = snapshot.get("summary") or {}
+        self.db.execute(
+            """
+            INSERT INTO snapshots (id, short_id, time_utc, hostname, username,
+                paths, tags, total_bytes_processed, data_added)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (id) DO UPDATE SET
+                short_id = excluded.short_id,
+                time_utc = excluded.time_utc,
+                hostname = excluded.hostname,
+                username = excluded.username,
+                paths = excluded.paths,
+                tags = excluded.tags,
+                total_bytes_processed = COALESCE(
+                    excluded.total_bytes_processed, total_bytes_processed
+                ),
+                data_added = COALESCE(excluded.data_added, data_added)
+            """,
+            (
+                snapshot["id"],
+                snapshot.get("short_id", snapshot["id"][:8]),
+                parse_restic_time(snapshot["time"]).strftime(DB_DATE_FORMAT),
+                snapshot.get("hostname"),
+                snapshot.get("username"),
+                json.dumps(snapshot.get("paths") or []),
+                json.dumps(snapshot.get("tags") or []),
+                summary.get("total_bytes_processed"),
+                summary.get("data_added"),
+            ),
+        )
+
+    def add_backup(self, summary, paths, tags=None):
+        """
+        Add the snapshot just saved by a backup, from its JSON summary
+        Details not given by the summary are guessed, next sync fixes them
+        """
+        now_utc_dt = datetime.datetime.utcnow()
+        with self.db:
+            self._upsert(
+                {
+                    "id": summary["snapshot_id"],
+                    "time": now_utc_dt.isoformat() + "Z",
+                    "hostname": socket.gethostname(),
+                    "username": const.USERNAME,
+                    "paths": paths,
+                    "tags": tags,
+                    "summary": summary,
+                }
+            )
+            self._set_meta_dt("last_update", now_utc_dt)
+
+    def sync(self, snapshots):
+        """
+        Replace the catalog content with the complete list of snapshots
+        of the repository (as given by `restic snapshots --json`)
+        """
+        now_utc_dt = datetime.datetime.utcnow()
+        with self.db:
+            self.db.execute("CREATE TEMP TABLE IF NOT EXISTS seen (id TEXT)")
+            self.db.execute("DELETE FROM seen")
+            for snapshot in snapshots:
+                self._upsert(snapshot)
+                self.db.execute("INSERT INTO seen (id) VALUES (?)", (snapshot["id"],))
+            self.db.execute(
+                "DELETE FROM snapshots WHERE id NOT IN (SELECT id FROM seen)"
+            )
+            self.db.execute(
+                "DELETE FROM replicated WHERE id NOT IN (SELECT id FROM seen)"
+            )
+            self._set_meta_dt("last_update", now_utc_dt)
+            self._set_meta_dt("last_sync", now_utc_dt)
+
+    def apply_forget(self, groups, scoped=False):
+        """
+        Update the catalog from `restic forget --json` output.
+        + not scoped : every snapshot of the repository is either kept
+          or removed -> the kept ones are the complete list of snapshots
+        + scoped (--tag) : only the snapshots having the tag are listed
+          -> only the removed ones are deleted
+        return the IDs of the removed snapshots
+        """
+        kept = []
+        removed = []
+        for group in groups:
+            kept += group.get("keep") or []
+            removed += [snapshot["id"] for snapshot in group.get("remove") or []]
+        if not scoped:
+            self.sync(kept)
+            return removed
+        with self.db:
+            for snapshot in kept:
+                self._upsert(snapshot)
+            self.db.executemany(
+                "DELETE FROM snapshots WHERE id = ?",
+                [(snapshot_id,) for snapshot_id in removed],
+            )
+            self.db.executemany(
+                "DELETE FROM replicated WHERE id = ?",
+                [(snapshot_id,) for snapshot_id in removed],
+            )
+            self._set_meta_dt("last_update", datetime.datetime.utcnow())
+        return removed
+
+    def get_snapshots(self, limit=20, hostname=None):
+        """
+        return the most recent snapshots (newest first) as dicts
+        limit=-1 : no limit
+        """
+        query = (
+            "SELECT id, short_id, time_utc, hostname, username, paths, tags, "
+            "total_bytes_processed, data_added FROM snapshots"
+        )
+        params = []
+        if hostname is not None:
+            query += " WHERE hostname = ?"
+            params.append(hostname)
+        query += " ORDER BY time_utc DESC LIMIT ?"
+        params.append(limit)
+        return [
+            {
+                "id": row[0],
+                "short_id": row[1],
+                "time_utc_dt": datetime.datetime.strptime(row[2], DB_DATE_FORMAT),
+                "hostname": row[3],
+                "username": row[4],
+                "paths": json.loads(row[5]),
+                "tags": json.loads(row[6]),
+                "total_bytes_processed": row[7],
+                "data_added": row[8],
+            }
+            for row in self.db.execute(query, params)
+        ]
+
+    def snapshot_ids(self):
+        return {row[0] for row in self.db.execute("SELECT id FROM snapshots")}
+
+    def remove(self, snapshot_id):
+        with self.db:
+            self.db.execute("DELETE FROM snapshots WHERE id = ?", (snapshot_id,))
+
+    def replicated_ids(self):
+        return {row[0] for row in self.db.execute("SELECT id FROM replicated")}
+
+    def mark_replicated(self, snapshot_ids):
+        """
+        Remember that snapshot_ids have been copied to the secondary repository
+        """
+        with self.db:
+            self.db.executemany(
+                "INSERT OR IGNORE INTO replicated (id) VALUES (?)",
+                [(snapshot_id,) for snapshot_id in snapshot_ids],
+            )
+
+    def get_snapshot(self, snapshot_id):
+        """
+        return the snapshot of snapshot_id as dict, None if unknown
+        """
+        for snapshot in self.get_snapshots(limit=-1):
+            if snapshot["id"] == snapshot_id:
+                return snapshot
+        return None
+
+    def total_bytes_processed(self):
+        """
+        return the size of the data backed up by all snapshots
+        (only the ones whose size is known)
+        """
+        row = self.db.execute(
+            "SELECT SUM(total_bytes_processed) FROM snapshots"
+        ).fetchone()
+        return row[0] or 0
+
+    def count(self):
+        return self.db.execute("SELECT COUNT(*) FROM snapshots").fetchone()[0]
+
+    def age_message(self):
+        """
+        return how old the cached data is, for the user
+        """
+        return (
+            f"Catalog updated {age_to_human(self.last_update_utc_dt)}, "
+            f"last full sync {age_to_human(self.last_sync_utc_dt)}"
+        )
+
+
+def snapshot_to_str(snapshot):
+    """
+    return one line describing a snapshot
+    """
+    line = (
+        f"{utc_to_local_str(snapshot['time_utc_dt'])}  {snapshot['short_id']}  "
+        f"{snapshot['hostname']}"
+    )
+    if snapshot["total_bytes_processed"] is not None:
+        line += f"  {bytes_to_human(snapshot['total_bytes_processed'])}"
+    if snapshot["data_added"] is not None:
+        line += f" (+{bytes_to_human(snapshot['data_added'])})"
+    if len(snapshot["tags"]) > 0:
+        line += f"  [{', '.join(snapshot['tags'])}]"
+    return line
+
+
+def print_snapshots(nb_snapshots, hostname=None, refresh=False, as_json=False):
+    """
+    Print the latest snapshots from the catalog
+    (used by `enacrestic snapshots`)
+    + refresh : sync the catalog with the repository first
+    """
+    catalog = SnapshotCatalog()
+    if refresh:
+        try:
+            p = subprocess.run(
+                [
+                    "restic",
+                    "snapshots",
+                    "--json",
+                    "--no-lock",
+                    "--password-file",
+                    const.RESTIC_USER_PREFS["PASSWORDFILE"],
+                ],
+                env={**os.environ, "LC_ALL": "C", **load_restic_env()},
+                stdout=subprocess.PIPE,
+                text=True,
+                check=True,
+            )
+            catalog.sync(json.loads(p.stdout))
+        except (OSError, subprocess.CalledProcessError, ValueError) as e:
+            print(f"Could not sync the catalog: {e}", file=sys.stderr)
+
+    snapshots = catalog.get_snapshots(nb_snapshots, hostname)
+    if as_json:
+
+        def _str_date(utc_dt):
+            return None if utc_dt is None else utc_to_local_str(utc_dt)
+
+        for snapshot in snapshots:
+            snapshot["time"] = _str_date(snapshot.pop("time_utc_dt"))
+        print(
+            json.dumps(
+                {
+                    "last_update": _str_date(catalog.last_update_utc_dt),
+                    "last_sync": _str_date(catalog.last_sync_utc_dt),
+                    "snapshots": snapshots,
+                },
+                indent=2,
+            )
+        )
+        return
+    for snapshot in reversed(snapshots):
+        print(snapshot_to_str(snapshot))
+    print(f"\n{catalog.count()} snapshots. {catalog.age_message()}")
@@ -20,6 +20,16 @@ class Conf:
     def __exit__(self, *args):
         self._save()
 
+    @classmethod
+    def read(cls):
+        """
+        return the conf as saved, without writing it back
+        (for the commands run beside the app)
+        """
+        conf = cls()
+        conf._load()
+        return conf
+
     def _load(self):
         conf_read = Dynaconf(
             settings_files=[const.RESTIC_CONFFILE],
@@ -34,6 +44,57 @@ class Conf:
             "check_new_version_every_n_days", const.DEF_CHECK_NEW_VERSION_EVERY_N_DAYS
         )
         self.gui_autostart = conf_read.get("gui_autostart", const.DEF_GUI_AUTOSTART)
+        self.stream_sources = conf_read.get("stream_sources", const.DEF_STREAM_SOURCES)
+        self.start_jitter_window_minutes = conf_read.get(
+            "start_jitter_window_minutes", const.DEF_START_JITTER_WINDOW_MINUTES
+        )
+        self.peak_start_jitter_window_minutes = conf_read.get(
+            "peak_start_jitter_window_minutes",
+            const.DEF_PEAK_START_JITTER_WINDOW_MINUTES,
+        )
+        self.peak_hours = conf_read.get("peak_hours", const.DEF_PEAK_HOURS)
+        self.bandwidth_profiles = conf_read.get(
+            "bandwidth_profiles", const.DEF_BANDWIDTH_PROFILES
+        )
+        self.file_index_enabled = conf_read.get(
+            "file_index_enabled", const.DEF_FILE_INDEX_ENABLED
+        )
+        self.repository_quota_gib = conf_read.get(
+            "repository_quota_gib", const.DEF_REPOSITORY_QUOTA_GIB
+        )
+        self.metrics_file = conf_read.get("metrics_file", const.DEF_METRICS_FILE)
+        self.backup_tuning = conf_read.get("backup_tuning", const.DEF_BACKUP_TUNING)
+        self.stall_after_n_minutes = conf_read.get(
+            "stall_after_n_minutes", const.DEF_STALL_AFTER_N_MINUTES
+        )
+        self.max_runtime_minutes = conf_read.get(
+            "max_runtime_minutes", const.DEF_MAX_RUNTIME_MINUTES
+        )
+        self.shutdown_deadline_seconds = conf_read.get(
+            "shutdown_deadline_seconds", const.DEF_SHUTDOWN_DEADLINE_SECONDS
+        )
+        self.backup_gating = conf_read.get("backup_gating", const.DEF_BACKUP_GATING)
+        self.restic_go_gc = conf_read.get("restic_go_gc", const.DEF_RESTIC_GO_GC)
+        self.release_check_url = conf_read.get(
+            "release_check_url", const.DEF_RELEASE_CHECK_URL
+        )
+        self.event_sinks = conf_read.get("event_sinks", const.DEF_EVENT_SINKS)
+        self.backup_estimation = conf_read.get(
+            "backup_estimation", const.DEF_BACKUP_ESTIMATION
+        )
+        self.path_groups = conf_read.get("path_groups", const.DEF_PATH_GROUPS)
+        self.trace_file = conf_read.get("trace_file", const.DEF_TRACE_FILE)
+        self.replication = conf_read.get("replication", const.DEF_REPLICATION)
+        self.offline_staging = conf_read.get(
+            "offline_staging", const.DEF_OFFLINE_STAGING
+        )
+        self.read_concurrency = conf_read.get(
+            "read_concurrency", const.DEF_READ_CONCURRENCY
+        )
+        self.backend_connections = conf_read.get(
+            "backend_connections", const.DEF_BACKEND_CONNECTIONS
+        )
+        self.quiet_hours = conf_read.get("quiet_hours", const.DEF_QUIET_HOURS)
 
     def _save(self):
         """
@@ -46,6 +107,30 @@ class Conf:
                     "forget_every_n_backups": self.forget_every_n_backups,
                     "check_new_version_every_n_days": self.check_new_version_every_n_days,
                     "gui_autostart": self.gui_autostart,
+                    "stream_sources": self.stream_sources,
+                    "start_jitter_window_minutes": self.start_jitter_window_minutes,
+                    "peak_start_jitter_window_minutes": self.peak_start_jitter_window_minutes,
+                    "peak_hours": self.peak_hours,
+                    "bandwidth_profiles": self.bandwidth_profiles,
+                    "file_index_enabled": self.file_index_enabled,
+                    "repository_quota_gib": self.repository_quota_gib,
+                    "metrics_file": self.metrics_file,
+                    "backup_tuning": self.backup_tuning,
+                    "stall_after_n_minutes": self.stall_after_n_minutes,
+                    "max_runtime_minutes": self.max_runtime_minutes,
+                    "shutdown_deadline_seconds": self.shutdown_deadline_seconds,
+                    "backup_gating": self.backup_gating,
+                    "restic_go_gc": self.restic_go_gc,
+                    "release_check_url": self.release_check_url,
+                    "event_sinks": self.event_sinks,
+                    "backup_estimation": self.backup_estimation,
+                    "path_groups": self.path_groups,
+                    "trace_file": self.trace_file,
+                    "replication": self.replication,
+                    "offline_staging": self.offline_staging,
+                    "read_concurrency": self.read_concurrency,
+                    "backend_connections": self.backend_connections,
+                    "quiet_hours": self.quiet_hours,
                     "version": __version__,
                 },
                 fh,
@@ -63,7 +148,46 @@ class Conf:
             "forget_every_n_backups",
             "check_new_version_every_n_days",
             "gui_autostart",
+            "stream_sources",
+            "start_jitter_window_minutes",
+            "peak_start_jitter_window_minutes",
+            "peak_hours",
+            "bandwidth_profiles",
+            "file_index_enabled",
+            "repository_quota_gib",
+            "metrics_file",
+            "backup_tuning",
+            "stall_after_n_minutes",
+            "max_runtime_minutes",
+            "shutdown_deadline_seconds",
+            "backup_gating",
+            "restic_go_gc",
+            "release_check_url",
+            "event_sinks",
+            "backup_estimation",
+            "path_groups",
+            "trace_file",
+            "replication",
+            "offline_staging",
+            "read_concurrency",
+            "backend_connections",
+            "quiet_hours",
         ):
             if kwargs.get(key) is not None:
                 setattr(self, key, kwargs[key])
         self._save()
+
+
+def update_conf_file(**kwargs):
+    """
+    Write kwargs into the conf file, keeping the rest of it as is
+    (for the commands run beside the app)
+    """
+    try:
+        with open(const.RESTIC_CONFFILE, "r") as fh:
+            conf = json.load(fh)
+    except FileNotFoundError:
+        conf = {}
+    conf.update(kwargs)
+    with open(const.RESTIC_CONFFILE, "w") as fh:
+        json.dump(conf, fh, sort_keys=True, indent=2)
@@ -0,0 +1,203 @@
+"""
+Number of concurrent connections to the backend of the repository
+(restic's -o <backend>.connections), tuned per backend and network
+from the past backups :
+
++ backend : from RESTIC_REPOSITORY (s3, rest, b2, azure, gs, swift, rclone)
++ network : interface of the default route, and Wi-Fi SSID or gateway
++ each backup records its backend, network and connections
++ the connections change by small steps, within
+  [BACKEND_CONNECTIONS_MIN, BACKEND_CONNECTIONS_MAX] :
+  + halved after a network timeout, if more than BACKEND_CONNECTIONS_MAX_TIMEOUT_RATE
+    of the recent backups with that many connections timed out (weak Wi-Fi)
+  + back to fewer connections if they uploaded as fast
+  + BACKEND_CONNECTIONS_STEP more, if that many did upload faster than fewer
+    (high-latency link), each value being tried BACKEND_CONNECTIONS_MIN_RUNS times
+
+"backend_connections" in prefs.json forces a value.
+"""
+
+import collections
+import socket
+import statistics
+import struct
+import subprocess
+
+from enacrestic import const
+from enacrestic.state import Status
+
+ROUTE_FILE = "/proc/net/route"
+# Tools are given that long to answer, not to delay the scheduler
+COMMAND_TIMEOUT_SECONDS = 2
+
+# restic's default number of connections, per backend having the option
+DEFAULT_CONNECTIONS = {
+    "s3": 5,
+    "rest": 5,
+    "b2": 5,
+    "azure": 5,
+    "gs": 5,
+    "swift": 5,
+    "rclone": 5,
+}
+
+
+def backend_of(repository):
+    """
+    return the backend of repository (e.g. "s3" for s3:https://host/bucket)
+    None if its connections can't be set (e.g. local, sftp)
+    """
+    if repository is None:
+        return None
+    backend = repository.partition(":")[0]
+    if backend in DEFAULT_CONNECTIONS:
+        return backend
+    return None
+
+
+def default_route(route_file=ROUTE_FILE):
+    """
+    return (interface, gateway IP) of the default route, None if there is none
+    """
+    try:
+        with open(route_file, "r") as f:
+            lines = f.readlines()[1:]
+    except OSError:
+        return None
+    best = None
+    for line in lines:
+        fields = line.split()
+        try:
+            if fields[1] != "00000000" or fields[7] != "00000000":
+                continue
+            metric = int(fields[6])
+            gateway = socket.inet_ntoa(struct.pack("<L", int(fields[2], 16)))
+        except (IndexError, ValueError):
+            continue
+        if best is None or metric < best[0]:
+            best = (metric, fields[0], gateway)
+    if best is None:
+        return None
+    return best[1], best[2]
+
+
+def wifi_ssid(interface):
+    """
+    return the SSID interface is connected to, None if it isn't Wi-Fi (or unknown)
+    """
+    try:
+        p = subprocess.run(
+            ["iwgetid", "--raw", interface],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+            timeout=COMMAND_TIMEOUT_SECONDS,
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    if p.returncode != 0 or p.stdout.strip() == "":
+        return None
+    return p.stdout.strip()
+
+
+def network_key():
+    """
+    return a name of the network we're on, e.g. "wlan0 ssid eduroam"
+    or "eth0 via 192.168.1.1". None if offline
+    """
+    route = default_route()
+    if route is None:
+        return None
+    interface, gateway = route
+    ssid = wifi_ssid(interface)
+    if ssid is not None:
+        return f"{interface} ssid {ssid}"
+    return f"{interface} via {gateway}"
+
+
+def upload_throughputs(runs):
+    """
+    return {connections: [upload throughput (bytes/s)]} of the successful runs
+    which uploaded enough to tell, without bandwidth limit
+    """
+    throughputs = collections.defaultdict(list)
+    for run in runs:
+        if (
+            run["status"] == Status.OK.value
+            and (run.get("bytes_uploaded") or 0)
+            >= const.BACKEND_CONNECTIONS_MIN_UPLOAD_BYTES
+            and run.get("limit_upload") is None
+            and run["seconds"] > 0
+        ):
+            throughputs[run["connections"]].append(
+                run["bytes_uploaded"] / run["seconds"]
+            )
+    return throughputs
+
+
+def choose_connections(backend, network, runs):
+    """
+    return the connections for the next backup to backend on network
+    given the past runs, newest first (see module docstring)
+    """
+    runs = [
+        run
+        for run in runs
+        if run.get("backend") == backend
+        and run.get("network") == network
+        and run.get("connections") is not None
+    ][: const.BACKEND_CONNECTIONS_HISTORY_RUNS]
+    if len(runs) == 0:
+        return DEFAULT_CONNECTIONS[backend]
+    current = min(
+        max(runs[0]["connections"], const.BACKEND_CONNECTIONS_MIN),
+        const.BACKEND_CONNECTIONS_MAX,
+    )
+
+    def _timeout_rate(value):
+        at_value = [run for run in runs if run["connections"] == value]
+        if len(at_value) == 0:
+            return 0
+        nb_timeouts = sum(run["status"] == Status.NO_NETWORK.value for run in at_value)
+        return nb_timeouts / len(at_value)
+
+    if (
+        runs[0]["status"] == Status.NO_NETWORK.value
+        and _timeout_rate(current) > const.BACKEND_CONNECTIONS_MAX_TIMEOUT_RATE
+    ):
+        return max(current // 2, const.BACKEND_CONNECTIONS_MIN)
+
+    throughputs = upload_throughputs(runs)
+
+    def _enough(value):
+        return len(throughputs[value]) >= const.BACKEND_CONNECTIONS_MIN_RUNS
+
+    def _gain(fewer, more):
+        return (
+            statistics.median(throughputs[more]) / statistics.median(throughputs[fewer])
+            - 1
+        )
+
+    if not _enough(current):
+        return current
+    lower = [value for value in list(throughputs) if value < current and _enough(value)]
+    if (
+        len(lower) > 0
+        and _gain(max(lower), current) < const.BACKEND_CONNECTIONS_MIN_GAIN
+    ):
+        # More connections don't pay
+        return max(lower)
+    higher = min(
+        current + const.BACKEND_CONNECTIONS_STEP, const.BACKEND_CONNECTIONS_MAX
+    )
+    if (
+        higher > current
+        # Not back to where the network timed out
+        and _timeout_rate(higher) <= const.BACKEND_CONNECTIONS_MAX_TIMEOUT_RATE
+        and (
+            not _enough(higher)
+            or _gain(current, higher) >= const.BACKEND_CONNECTIONS_MIN_GAIN
+        )
+    ):
+        return higher
+    return current
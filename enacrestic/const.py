@@ -13,6 +13,10 @@ VERSION_INFO = tuple(map(lambda x: int(x), __version__.split(".")))
 PYPI_PROJECT_URL = "https://pypi.org/pypi/enacrestic/json"
 UPGRADE_DOC = "https://github.com/EPFL-ENAC/ENACrestic#upgrade"
 DEF_CHECK_NEW_VERSION_EVERY_N_DAYS = 7
+# Answering {"info": {"version": ...}}, see release_check.py
+DEF_RELEASE_CHECK_URL = PYPI_PROJECT_URL
+RELEASE_CHECK_TIMEOUT_SECONDS = 10
+RELEASE_CHECK_MAX_BYTES = 4 * 1024**2
 
 # App related
 DEF_BACKUP_EVERY_N_MINUTES = 30
@@ -20,8 +24,208 @@ DEF_FORGET_EVERY_N_BACKUPS = 10
 
 DEF_GUI_AUTOSTART = False
 
+# List of {"name": ..., "command": [...], "filename": ...}
+# whose command's stdout is piped to `restic backup --stdin`
+DEF_STREAM_SOURCES = []
+
+# Named groups of paths, each with its own schedule, tags, exclude file
+# and retention, e.g.
+# [{"name": "documents", "paths": ["~/Documents"], "every_n_minutes": 15,
+#   "keep": {"hourly": 48}}]
+DEF_PATH_GROUPS = []
+# Retention of `restic forget` (--keep-<key> <value>),
+# a path group's "keep" overrides some of it
+DEF_KEEP_POLICY = {
+    "last": 3,
+    "hourly": 24,
+    "daily": 7,
+    "weekly": 4,
+    "monthly": 12,
+    "yearly": 5,
+}
+
 NB_CHRONOS_TO_SAVE = 10
 
+# The scheduler checks this often if a backup is due (wall-clock based)
+SCHEDULER_TICK_EVERY_N_SECONDS = 30
+# Delay before an overdue backup is started after launch or resume
+CATCH_UP_DELAY_SECONDS = 60
+# A backup which didn't succeed is due again that long after it started
+# (or one interval, if shorter)
+BACKUP_RETRY_DELAY_MINUTES = 10
+# Backups of a host start in its own slot (derived from hostname and UID)
+# within a window, to spread the load of many hosts on shared repositories
+DEF_START_JITTER_WINDOW_MINUTES = 10
+DEF_PEAK_START_JITTER_WINDOW_MINUTES = 60
+# List of time windows (see time_windows.py) when the load has to be spread
+# further. Forget/prune is postponed until peak hours are over
+# (at most that long).
+DEF_PEAK_HOURS = []
+MAX_FORGET_POSTPONEMENT_HOURS = 24
+# List of time windows when no backup (nor forget, replication...) starts,
+# postponed until they are over
+DEF_QUIET_HOURS = []
+
+# List of time windows (see time_windows.py) with
+# "limit_upload" and/or "limit_download" in KiB/s (0 : don't run)
+# and an optional "name"
+DEF_BANDWIDTH_PROFILES = []
+# Conditions deferring a due backup (see gating.py)
+DEF_BACKUP_GATING = {
+    "on_battery": {"max_age_hours": 4, "min_battery_percent": 10},
+}
+# Estimation of the volume of a due backup (`restic backup --dry-run`),
+# to defer large ones to off-peak windows (see README), {} : no estimation
+# e.g. {"defer_above_mib": 2048, "off_peak": [...], "max_age_hours": 24}
+DEF_BACKUP_ESTIMATION = {}
+# Wall-clock advancing that much more than monotonic clock means suspend
+SUSPEND_DETECTION_THRESHOLD_SECONDS = 60
+
+PROGRESS_LOG_EVERY_N_SECONDS = 60
+
+# The running operation is checked that often by the watchdog
+WATCHDOG_TICK_EVERY_N_SECONDS = 30
+# An operation reporting its progress (backup, file indexing)
+# without progress for that long is stalled (None : never)
+DEF_STALL_AFTER_N_MINUTES = 30
+# Any operation running longer than that (in minutes) is stalled
+# (per Operation value, None : no limit). Only for the operations reporting
+# no progress : a first multi-TB backup or a large dump in the pre-backup hook
+# may take long, a backup making no progress is stalled anyway
+DEF_MAX_RUNTIME_MINUTES = {
+    "init": 30,
+    "pre_backup": None,
+    "estimate": None,
+    "backup": None,
+    "stream_backup": None,
+    "group_backup": None,
+    "replicate": 720,
+    "init_staging": 30,
+    "stage_backup": None,
+    "upload_staged": 720,
+    "prune_staging": 120,
+    "forget": 720,
+    "forget_snapshot": 30,
+    "unlock": 30,
+    "sync_catalog": 30,
+    "index_files": None,
+    "stats": 60,
+}
+# A stalled process gets SIGINT, then SIGTERM, then SIGKILL that long apart,
+# and is abandoned if it still runs after that
+STALL_ESCALATION_SECONDS = 30
+
+# When quitting, the running operation is interrupted (SIGINT, SIGTERM, SIGKILL)
+# within that deadline, e.g. not to hang the logout
+DEF_SHUTDOWN_DEADLINE_SECONDS = 30
+# and abandoned if it still runs that long after it
+SHUTDOWN_ABANDON_AFTER_SECONDS = 2
+
+# The snapshot catalog is updated after each backup and forget,
+# and fully synced with the repository if it wasn't for that long
+CATALOG_SYNC_EVERY_N_HOURS = 24
+# Number of snapshots listed in the tray
+NB_SNAPSHOTS_IN_TRAY = 10
+
+# Size of the repository (restic stats --mode raw-data) is measured
+# that often, and around each prune
+STATS_EVERY_N_HOURS = 24
+# Unless it was measured that recently
+STATS_BEFORE_PRUNE_MAX_AGE_MINUTES = 60
+# Growth rate is computed over that period, if it spans at least that long
+STATS_GROWTH_WINDOW_DAYS = 30
+STATS_MIN_GROWTH_SPAN_HOURS = 12
+# Quota of the repository in GiB, to forecast when it will be reached
+DEF_REPOSITORY_QUOTA_GIB = None
+# Log an error when the quota is forecast to be reached that soon
+QUOTA_WARNING_DAYS = 30
+
+# restic --compression / --pack-size per bandwidth profile name
+# ("default" otherwise), as recommended by `enacrestic benchmark`
+# e.g. {"default": {"compression": "auto", "pack_size": 16}}
+DEF_BACKUP_TUNING = {}
+DEF_BENCHMARK_SAMPLE_MIB = 200
+# `enacrestic benchmark --read-concurrency` : size of the generated tree
+DEF_BENCHMARK_TREE_MIB = 512
+BENCHMARK_READ_CONCURRENCIES = (1, 2, 4, 8, 16)
+BENCHMARK_MAX_FILES_SCANNED = 20000
+BENCHMARK_COMPRESSIONS = ("off", "auto", "max")
+BENCHMARK_PACK_SIZES_MIB = (16, 32, 64)
+
+# Resources used by restic are sampled that often (see resources.py)
+RESOURCE_SAMPLE_EVERY_N_SECONDS = 2
+# GOGC / GOMEMLIMIT given to restic per operation ("default" otherwise)
+# e.g. {"forget": {"GOGC": 50, "GOMEMLIMIT": "1GiB"}} to prune on a small VM
+DEF_RESTIC_GO_GC = {}
+
+# Sinks of the lifecycle events (see events.py)
+DEF_EVENT_SINKS = []
+# Events queued per sink, the oldest are dropped beyond
+EVENT_QUEUE_SIZE = 100
+# A sink (notification, webhook, script) is given that long per event
+EVENT_SINK_TIMEOUT_SECONDS = 10
+# Progress events are published that often at most
+PROGRESS_EVENT_EVERY_N_SECONDS = 10
+# Pending events are delivered for that long at most when quitting
+EVENT_DRAIN_ON_QUIT_SECONDS = 2
+
+# Copy of the new snapshots to a secondary repository (`restic copy`),
+# {} : no replication, e.g. {"env_file": "~/.enacrestic/replica_env.sh",
+# "password_file": "~/.enacrestic/.pw_replica", "every_n_minutes": None,
+# "limit_upload": 1024} (every_n_minutes None : after every backup)
+DEF_REPLICATION = {}
+
+# Local repository the backups go to while the repository is unreachable,
+# copied to it when it's back (see README)
+# {} : no offline staging, e.g. {"repository": "~/.enacrestic/staging",
+# "max_size_mib": 10240}
+DEF_OFFLINE_STAGING = {}
+
+# restic's read concurrency (files read at once, see storage.py),
+# None : chosen from the storage of bkp_include, refined over the backups
+DEF_READ_CONCURRENCY = None
+# restic's default is 2. A network share is latency-bound : more reads
+# in flight hide the round trips
+READ_CONCURRENCY_PER_STORAGE = {"nvme": 8, "ssd": 4, "network": 4, "hdd": 1}
+READ_CONCURRENCY_MIN = 1
+READ_CONCURRENCY_MAX = 32
+# Past backups refining it : those which read at least that much,
+# and that many of them per value
+READ_CONCURRENCY_MIN_READ_BYTES = 256 * 1024**2
+READ_CONCURRENCY_MIN_RUNS = 3
+
+# Concurrent connections to the backend (see connections.py),
+# None : tuned per backend and network from the past backups
+DEF_BACKEND_CONNECTIONS = None
+BACKEND_CONNECTIONS_MIN = 1
+BACKEND_CONNECTIONS_MAX = 32
+BACKEND_CONNECTIONS_STEP = 2
+# Past backups tuning it : the last ones on the same backend and network,
+# those which uploaded at least that much tell the throughput
+BACKEND_CONNECTIONS_HISTORY_RUNS = 20
+BACKEND_CONNECTIONS_MIN_UPLOAD_BYTES = 64 * 1024**2
+BACKEND_CONNECTIONS_MIN_RUNS = 2
+# More connections must upload that much faster (+5%) to be kept
+BACKEND_CONNECTIONS_MIN_GAIN = 0.05
+# Fewer connections when more of the backups timed out
+BACKEND_CONNECTIONS_MAX_TIMEOUT_RATE = 0.25
+
+# Chrome trace-event file of the operations and their phases
+# (see tracing.py, "" : no tracing), e.g. "~/.enacrestic/trace.json"
+DEF_TRACE_FILE = ""
+TRACE_FILE_MAX_BYTES = 10 * 1024**2
+TRACE_FILE_BACKUP_COUNT = 3
+
+# Index the files of every snapshot (see file_index.py)
+DEF_FILE_INDEX_ENABLED = False
+# Snapshots indexed at most after each backup, to catch up the history gently
+FILE_INDEX_MAX_SNAPSHOTS_PER_RUN = 5
+# Number of files listed when searching from the tray
+NB_FILES_FOUND_IN_TRAY = 20
+
+# Same as restic : a lock not refreshed for that long is stale
+LOCK_STALE_AFTER_N_MINUTES = 30
+
 ENACRESTIC_PREF_FOLDER = os.path.expanduser("~/.enacrestic")
 
 RESTIC_USER_PREFS = {
@@ -33,17 +237,40 @@ RESTIC_USER_PREFS = {
 RESTIC_LOGFILE = os.path.join(ENACRESTIC_PREF_FOLDER, "last_backups.log")
 RESTIC_CONFFILE = os.path.join(ENACRESTIC_PREF_FOLDER, "prefs.json")
 RESTIC_STATEFILE = os.path.join(ENACRESTIC_PREF_FOLDER, "state.json")
+HISTORY_DB = os.path.join(ENACRESTIC_PREF_FOLDER, "history.sqlite")
+CATALOG_DB = os.path.join(ENACRESTIC_PREF_FOLDER, "catalog.sqlite")
+FILE_INDEX_DB = os.path.join(ENACRESTIC_PREF_FOLDER, "file_index.sqlite")
 PRE_BACKUP_HOOK = os.path.join(ENACRESTIC_PREF_FOLDER, "pre_backup")
+# Prometheus textfile, exported by default ("" : no metrics exported)
+DEF_METRICS_FILE = os.path.join(ENACRESTIC_PREF_FOLDER, "metrics.prom")
 RESTIC_AUTOSTART_FILE = os.path.expanduser("~/.config/autostart/enacrestic.desktop")
 
 LOGFILE_ROTATION_EVERY_N_DAYS = 30
 LOGFILE_ROTATION_BACKUP_COUNT = 5
 
 ENACRESTIC_BIN = os.path.abspath(sys.argv[0])
+# util-linux, runs the daemon's jobs with the privileges of their user
+SETPRIV_BIN = "setpriv"
 
 USERNAME = getpass.getuser()
 UID = pwd.getpwnam(USERNAME).pw_uid
 PID_FILE = os.path.join(ENACRESTIC_PREF_FOLDER, "enacrestic.pid")
+# Exit code of `enacrestic --run-once` when the user's instance is running
+EXIT_ALREADY_RUNNING = 75
+# Held by `enacrestic restore`, scheduled backups are paused meanwhile
+RESTORE_PID_FILE = os.path.join(ENACRESTIC_PREF_FOLDER, "enacrestic-restore.pid")
+# `enacrestic restore` waits for these operations (exclusive repository lock)
+RESTORE_WAIT_EVERY_N_SECONDS = 5
+
+# System daemon related
+DAEMON_PID_FILE = os.path.join(ENACRESTIC_PREF_FOLDER, "enacrestic-daemon.pid")
+DAEMON_STATUS_FILE = os.path.join(ENACRESTIC_PREF_FOLDER, "daemon_status.json")
+DEF_DAEMON_MAX_CONCURRENT_JOBS = 2
+DEF_DAEMON_MIN_UID = 1000
+DAEMON_DISCOVER_EVERY_N_SECONDS = 300
+DAEMON_SCHEDULE_EVERY_N_SECONDS = 10
+# The daemon reads at most that much of a user's prefs.json and state.json
+DAEMON_MAX_USER_FILE_BYTES = 1024 * 1024
 
 ICONS_FOLDER = os.path.abspath(f"{__file__}/../pixmaps")
 
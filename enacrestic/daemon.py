@@ -0,0 +1,359 @@
+"""
+System-wide daemon for shared servers.
+
+Instead of one `enacrestic --no-gui` per user, a single daemon (run as root)
+
++ discovers users having a ~/.enacrestic/bkp_include
++ schedules their backups through one queue
+  + with a global concurrency limit
+  + serving due users in a round-robin fashion
++ runs each job as `enacrestic --no-gui --run-once`
+  with the privileges of the user
++ reports the status of each user in const.DAEMON_STATUS_FILE
+"""
+
+import datetime
+import functools
+import json
+import os
+import pwd
+import signal
+import stat
+import sys
+
+from pidfile import AlreadyRunningError, PIDFile
+
+from enacrestic import const
+from enacrestic.engine import create_engine
+from enacrestic.logger import Logger
+from enacrestic.utils import local_str_to_utc, utc_to_local_str
+
+
+def _read_user_json(path, uid):
+    """
+    return the object of a user's JSON file, {} if there is none
+    raise ValueError if it isn't a JSON object
+
+    Read as root : a symlink is refused (OSError), and so is a file
+    not owned by the user, not regular (e.g. /dev/zero, a FIFO) or larger
+    than const.DAEMON_MAX_USER_FILE_BYTES
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW | os.O_NONBLOCK)
+    except FileNotFoundError:
+        return {}
+    with os.fdopen(fd, "rb") as f:
+        file_stat = os.fstat(f.fileno())
+        if not stat.S_ISREG(file_stat.st_mode):
+            raise ValueError(f"{path} should be a regular file")
+        if file_stat.st_uid != uid:
+            raise ValueError(f"{path} should be owned by its user")
+        data = f.read(const.DAEMON_MAX_USER_FILE_BYTES + 1)
+    if len(data) > const.DAEMON_MAX_USER_FILE_BYTES:
+        raise ValueError(
+            f"{path} is larger than {const.DAEMON_MAX_USER_FILE_BYTES} bytes"
+        )
+    content = json.loads(data)
+    if not isinstance(content, dict):
+        raise ValueError(f"{path} should contain a JSON object")
+    return content
+
+
+def _checked(content, key, expected_type, default):
+    """
+    return content[key] (default if missing or null)
+    raise ValueError if it isn't of expected_type
+    """
+    value = content.get(key)
+    if value is None:
+        return default
+    # bool is an int, but not a number of minutes
+    if not isinstance(value, expected_type) or isinstance(value, bool):
+        raise ValueError(f"{key} should be of type {expected_type.__name__}")
+    return value
+
+
+class UserJobs:
+    """
+    Scheduling information and status of one user
+    """
+
+    def __init__(self, pw):
+        self.pw = pw
+        self.pref_folder = os.path.join(pw.pw_dir, ".enacrestic")
+        self.process = None
+        self.last_started_utc_dt = None
+        self.last_finished_utc_dt = None
+        self.last_exit_code = None
+        self.start_error = None
+        self.backup_every_n_minutes = const.DEF_BACKUP_EVERY_N_MINUTES
+        self.next_due_utc_dt = datetime.datetime.utcnow()
+
+    @property
+    def name(self):
+        return self.pw.pw_name
+
+    def load(self):
+        """
+        Read the user's prefs and last backup time
+        to know when the next backup is due
+
+        The files belong to the user : they are parsed as plain JSON
+        (no Dynaconf, its includes could run the user's code as root),
+        only if they are regular files the user owns (see _read_user_json),
+        and each value used is type-checked (ValueError if wrong)
+        """
+        prefs = _read_user_json(
+            os.path.join(self.pref_folder, "prefs.json"), self.pw.pw_uid
+        )
+        self.backup_every_n_minutes = _checked(
+            prefs, "backup_every_n_minutes", int, const.DEF_BACKUP_EVERY_N_MINUTES
+        )
+        # Path groups may be backed up more often
+        path_groups = _checked(prefs, "path_groups", list, const.DEF_PATH_GROUPS)
+        for group in path_groups:
+            if not isinstance(group, dict):
+                raise ValueError("path_groups should be a list of objects")
+            self.backup_every_n_minutes = min(
+                self.backup_every_n_minutes,
+                _checked(group, "every_n_minutes", int, self.backup_every_n_minutes),
+            )
+        # and so may the replication
+        replication = _checked(prefs, "replication", dict, const.DEF_REPLICATION)
+        replication_every_n_minutes = _checked(
+            replication, "every_n_minutes", int, None
+        )
+        if replication_every_n_minutes is not None:
+            self.backup_every_n_minutes = min(
+                self.backup_every_n_minutes, replication_every_n_minutes
+            )
+        if self.last_started_utc_dt is None:
+            state = _read_user_json(
+                os.path.join(self.pref_folder, "state.json"), self.pw.pw_uid
+            )
+            prev_backup_chronos = _checked(state, "prev_backup_chronos", list, [])
+            next_backup_due = _checked(state, "next_backup_due_datetime", str, None)
+            if next_backup_due is not None:
+                self.next_due_utc_dt = local_str_to_utc(next_backup_due)
+            elif len(prev_backup_chronos) > 0:
+                if not (
+                    isinstance(prev_backup_chronos[0], list)
+                    and len(prev_backup_chronos[0]) > 0
+                    and isinstance(prev_backup_chronos[0][0], str)
+                ):
+                    raise ValueError("prev_backup_chronos should be [[date, ...]]")
+                self.next_due_utc_dt = local_str_to_utc(
+                    prev_backup_chronos[0][0]
+                ) + datetime.timedelta(minutes=self.backup_every_n_minutes)
+            # Path groups and forgets postponed by the peak hours
+            other_dues = list(
+                _checked(state, "next_group_backup_datetimes", dict, {}).values()
+            ) + list(_checked(state, "next_group_forget_datetimes", dict, {}).values())
+            next_forget_due = _checked(state, "next_forget_due_datetime", str, None)
+            if next_forget_due is not None:
+                other_dues.append(next_forget_due)
+            for other_due in other_dues:
+                if not isinstance(other_due, str):
+                    raise ValueError("next_group_*_datetimes should be dates")
+                self.next_due_utc_dt = min(
+                    self.next_due_utc_dt, local_str_to_utc(other_due)
+                )
+            next_replication_due = _checked(
+                state, "next_replication_due_datetime", str, None
+            )
+            if (
+                replication_every_n_minutes is not None
+                and next_replication_due is not None
+            ):
+                self.next_due_utc_dt = min(
+                    self.next_due_utc_dt, local_str_to_utc(next_replication_due)
+                )
+
+    def is_due(self, now_utc_dt):
+        return self.process is None and self.next_due_utc_dt <= now_utc_dt
+
+    def start(self, engine, on_finished):
+        """
+        Run the user's backup queue once, with the user's privileges
+        (setpriv), on_finished() being called back once the job is done
+        """
+        self.last_started_utc_dt = datetime.datetime.utcnow()
+        self.next_due_utc_dt = self.last_started_utc_dt + datetime.timedelta(
+            minutes=self.backup_every_n_minutes
+        )
+        self.start_error = None
+        self.process = engine.process()
+        # The job logs to the user's last_backups.log
+        self.process.on_stdout = lambda data: None
+        self.process.on_stderr = lambda data: None
+        self.process.on_failed_to_start = functools.partial(
+            self._job_finished, on_finished
+        )
+        self.process.on_finished = functools.partial(self._job_finished, on_finished)
+        self.process.start(
+            const.SETPRIV_BIN,
+            [
+                f"--reuid={self.pw.pw_uid}",
+                f"--regid={self.pw.pw_gid}",
+                "--init-groups",
+                "--",
+                const.ENACRESTIC_BIN,
+                "--no-gui",
+                "--run-once",
+            ],
+            env={
+                "HOME": self.pw.pw_dir,
+                "USER": self.pw.pw_name,
+                "LOGNAME": self.pw.pw_name,
+                "PATH": os.environ.get("PATH", os.defpath),
+            },
+            cwd=self.pw.pw_dir,
+        )
+
+    def _job_finished(self, on_finished, start_error=None):
+        if start_error is not None:
+            self.start_error = start_error
+            self.last_exit_code = None
+        elif self.process.crashed:
+            # Same as subprocess : minus the signal number
+            self.last_exit_code = -self.process.exit_code
+        else:
+            self.last_exit_code = self.process.exit_code
+        self.last_finished_utc_dt = datetime.datetime.utcnow()
+        self.process = None
+        on_finished()
+
+    def status(self):
+        def _str_date(utc_dt):
+            return None if utc_dt is None else utc_to_local_str(utc_dt)
+
+        if self.process is not None:
+            status = "running"
+        elif self.start_error is not None:
+            status = f"failed to start: {self.start_error}"
+        elif self.last_exit_code is None:
+            status = "waiting"
+        elif self.last_exit_code == const.EXIT_ALREADY_RUNNING:
+            status = "own instance running"
+        elif self.last_exit_code == 0:
+            status = "ok"
+        else:
+            status = "failed"
+        return {
+            "status": status,
+            "last_exit_code": self.last_exit_code,
+            "last_started": _str_date(self.last_started_utc_dt),
+            "last_finished": _str_date(self.last_finished_utc_dt),
+            "next_due": _str_date(self.next_due_utc_dt),
+            "log": os.path.join(self.pref_folder, "last_backups.log"),
+        }
+
+
+class Daemon:
+    def __init__(self, max_concurrent_jobs, min_uid):
+        self.max_concurrent_jobs = max_concurrent_jobs
+        self.min_uid = min_uid
+        self.users = {}
+        self.quitting = False
+        if not os.path.exists(const.ENACRESTIC_PREF_FOLDER):
+            os.makedirs(const.ENACRESTIC_PREF_FOLDER)
+
+        with Logger(gui_enabled=False) as self.logger:
+            if os.geteuid() != 0:
+                self.logger.error("The system daemon has to be run as root")
+                sys.exit(1)
+            try:
+                with PIDFile(const.DAEMON_PID_FILE):
+                    self._start_daemon()
+                    sys.exit(self.engine.exec())
+            except AlreadyRunningError:
+                self.logger.write("Already running -> quit")
+
+    def _start_daemon(self):
+        self.engine = create_engine()
+        self.engine.add_signal_handler(signal.SIGTERM, self.quit)
+        self.logger.write(
+            f"System daemon: up to {self.max_concurrent_jobs} concurrent jobs"
+        )
+
+        self.discover_timer = self.engine.timer(self._discover_users)
+        self.discover_timer.start(const.DAEMON_DISCOVER_EVERY_N_SECONDS * 1000)
+        self._discover_users()
+
+        self.schedule_timer = self.engine.timer(self._schedule)
+        self.schedule_timer.start(const.DAEMON_SCHEDULE_EVERY_N_SECONDS * 1000)
+
+    def _discover_users(self):
+        """
+        Find users having configured ENACrestic
+        """
+        found = set()
+        for pw in pwd.getpwall():
+            if pw.pw_uid < self.min_uid:
+                continue
+            bkp_include = os.path.join(pw.pw_dir, ".enacrestic", "bkp_include")
+            if not os.path.isfile(bkp_include):
+                continue
+            found.add(pw.pw_name)
+            if pw.pw_name not in self.users:
+                self.logger.write(f"Found ENACrestic config for {pw.pw_name}")
+                self.users[pw.pw_name] = UserJobs(pw)
+            try:
+                self.users[pw.pw_name].load()
+            except (OSError, ValueError) as e:
+                self.logger.error(f"Could not read {pw.pw_name}'s config: {e}")
+
+        for name in set(self.users) - found:
+            if self.users[name].process is None:
+                self.logger.write(f"ENACrestic config of {name} is gone")
+                del self.users[name]
+
+    def _schedule(self):
+        """
+        Start due jobs, least recently served users first,
+        within the concurrency limit
+        """
+        now_utc_dt = datetime.datetime.utcnow()
+        nb_running = sum(user.process is not None for user in self.users.values())
+        due_users = sorted(
+            (user for user in self.users.values() if user.is_due(now_utc_dt)),
+            key=lambda user: user.last_started_utc_dt or datetime.datetime.min,
+        )
+        if not self.quitting:
+            for user in due_users[: max(self.max_concurrent_jobs - nb_running, 0)]:
+                self.logger.write(f"Starting job of {user.name}")
+                user.start(self.engine, functools.partial(self._job_finished, user))
+
+        self._save_status()
+
+        if self.quitting and nb_running == 0:
+            self.engine.quit()
+
+    def _job_finished(self, user):
+        if user.start_error is not None:
+            self.logger.error(f"Could not start job of {user.name}: {user.start_error}")
+        else:
+            self.logger.write(f"Job of {user.name} finished ({user.last_exit_code})")
+        # Next due user (or quit) right away
+        self._schedule()
+
+    def _save_status(self):
+        with open(const.DAEMON_STATUS_FILE, "w") as fh:
+            json.dump(
+                {name: user.status() for name, user in self.users.items()},
+                fh,
+                sort_keys=True,
+                indent=2,
+            )
+
+    def quit(self):
+        """
+        triggered when the daemon is being closed
+        Let every running job close cleanly
+        """
+        self.quitting = True
+        for user in self.users.values():
+            if user.process is not None:
+                self.logger.write(f"Waiting for job of {user.name} to be finished")
+                user.process.send_signal(signal.SIGTERM)
+        self._schedule()
@@ -0,0 +1,178 @@
+"""
+Event loop, timers, signals and child processes behind one interface,
+with 2 implementations :
+
++ qt_engine.QtEngine : Qt's event loop (QTimer, QProcess),
+  needed by the GUI (system tray)
++ asyncio_engine.AsyncioEngine : asyncio only, used with --no-gui
+  and by the system daemon. Headless installs don't need PyQt5 at all.
+
+An engine provides :
+
++ timer(callback, single_shot=False) -> Timer
++ single_shot(msec, callback)
++ process() -> Process
++ add_signal_handler(signum, callback)
++ watch_resume(callback) : call back on resume from suspend,
+  return False if it can't be watched (wall-clock jumps are detected anyway)
++ run_in_thread(function, on_done) : run function in a thread,
+  then call on_done(its result) from the event loop
++ exec() : run the event loop until quit(exit_code), return exit_code
+"""
+
+import abc
+import os
+
+
+class Timer(abc.ABC):
+    """
+    Calls callback every msec (or once if single_shot) once started
+    """
+
+    def __init__(self, callback, single_shot=False):
+        self.callback = callback
+        self.single_shot = single_shot
+
+    @abc.abstractmethod
+    def start(self, msec):
+        """
+        (Re)start the timer
+        """
+
+    @abc.abstractmethod
+    def stop(self):
+        pass
+
+    @abc.abstractmethod
+    def is_active(self):
+        pass
+
+
+class Process(abc.ABC):
+    """
+    A child process. Its callbacks (all optional) are called from the event loop :
+
+    + on_started()
+    + on_stdout(data) / on_stderr(data) : data is bytes.
+      Without them, output is kept for read_all_stdout() / read_all_stderr()
+    + on_failed_to_start(error message) (on_finished isn't called then)
+    + on_finished() : exit_code and crashed are set
+    """
+
+    def __init__(self):
+        self.on_started = None
+        self.on_stdout = None
+        self.on_stderr = None
+        self.on_failed_to_start = None
+        self.on_finished = None
+        self.pid = None
+        self.running = False
+        self.exit_code = None
+        # Killed by a signal, exit_code is the signal number then
+        self.crashed = False
+        self._stdout = bytearray()
+        self._stderr = bytearray()
+        self.abandoned = False
+        self.pending_signal = None
+
+    @abc.abstractmethod
+    def pipe_to(self, process):
+        """
+        Pipe stdout to the stdin of process (both not started yet)
+        """
+
+    @abc.abstractmethod
+    def start(self, cmd, args, env=None, cwd=None):
+        """
+        Start cmd with args, in env (dict) or the current environment,
+        from the cwd folder or the current one
+        """
+
+    def send_signal(self, sig):
+        """
+        Send sig to the process, as soon as it's started
+        """
+        if self.pid is None:
+            self.pending_signal = sig
+        else:
+            self._kill(sig)
+
+    def succeeded(self):
+        return not self.running and not self.crashed and self.exit_code == 0
+
+    def read_all_stdout(self):
+        data = bytes(self._stdout)
+        self._stdout.clear()
+        return data
+
+    def read_all_stderr(self):
+        data = bytes(self._stderr)
+        self._stderr.clear()
+        return data
+
+    def abandon(self):
+        """
+        Don't call back anymore, whatever happens to the process
+        """
+        self.abandoned = True
+
+    def _kill(self, sig):
+        try:
+            os.kill(self.pid, sig)
+        except ProcessLookupError:
+            pass  # Exited, its on_finished is on its way
+
+    def _call(self, callback, *args):
+        if callback is not None and not self.abandoned:
+            callback(*args)
+
+    def _started(self, pid):
+        self.pid = pid
+        if self.pending_signal is not None:
+            self._kill(self.pending_signal)
+        self._call(self.on_started)
+
+    def _received_stdout(self, data):
+        if self.on_stdout is None:
+            self._stdout += data
+        else:
+            self._call(self.on_stdout, data)
+
+    def _received_stderr(self, data):
+        if self.on_stderr is None:
+            self._stderr += data
+        else:
+            self._call(self.on_stderr, data)
+
+    def _failed_to_start(self, message):
+        self.running = False
+        self._call(self.on_failed_to_start, message)
+
+    def _finished(self, exit_code, crashed):
+        self.running = False
+        self.exit_code = exit_code
+        self.crashed = crashed
+        self._call(self.on_finished)
+
+
+class NoGui:
+    """
+    Stands for the system tray when there is none
+    """
+
+    def update_system_tray(self):
+        pass  # no-gui
+
+
+def create_engine(qt_app=None):
+    """
+    return the engine driving qt_app if given (GUI),
+    the asyncio one otherwise (PyQt5 isn't imported then)
+    """
+    if qt_app is not None:
+        from enacrestic.qt_engine import QtEngine
+
+        return QtEngine(qt_app)
+    from enacrestic.asyncio_engine import AsyncioEngine
+
+    return AsyncioEngine()
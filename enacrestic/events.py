@@ -0,0 +1,311 @@
+"""
+Lifecycle events of the operations, published to pluggable sinks
+as set by "event_sinks" in prefs.json :
+
+[
+  {"type": "notify", "events": ["operation_finished", "stalled"]},
+  {"type": "webhook", "url": "http://localhost:8080/enacrestic"},
+  {"type": "script", "command": ["/home/me/bin/on_backup_event"]},
+  {"type": "metrics"}
+]
+
++ notify : desktop notification (notify-send)
++ webhook : event POSTed as JSON to url
++ script : command run with the event as JSON on its stdin
+  (and its type in $ENACRESTIC_EVENT)
++ metrics : number of events and time of the last one, per type,
+  exported with the other metrics
+
+Without "events", a sink gets every event type.
+
+Publishing never waits for a sink : each sink has a bounded queue
+(the oldest events are dropped when it's full) and is delivered
+from its own thread (metrics from the event loop, as the other metrics).
+"""
+
+import abc
+import collections
+import datetime
+import json
+import os
+import queue
+import socket
+import subprocess
+import threading
+import time
+from enum import Enum
+
+import requests
+
+from enacrestic import const
+from enacrestic.utils import bytes_to_human
+
+
+class EventType(Enum):
+    """
+    Enumerate all events published
+    """
+
+    OPERATION_STARTED = "operation_started"
+    PROGRESS = "progress"
+    OPERATION_FINISHED = "operation_finished"
+    LOCK_DETECTED = "lock_detected"
+    STALLED = "stalled"
+
+
+def event_to_str(event):
+    """
+    return a one-line human summary of event
+    """
+    operation = event.get("operation")
+    if event["type"] == EventType.OPERATION_STARTED.value:
+        return f"{operation} started"
+    if event["type"] == EventType.PROGRESS.value:
+        msg = f"{operation}: {bytes_to_human(event.get('bytes_done') or 0)} read"
+        if event.get("percent_done") is not None:
+            msg += f" ({100 * event['percent_done']:.0f}%)"
+        return msg
+    if event["type"] == EventType.OPERATION_FINISHED.value:
+        return f"{operation} finished in {event['seconds']:.0f} s: {event['status']}"
+    if event["type"] == EventType.LOCK_DETECTED.value:
+        nb_stale = sum(lock["stale"] for lock in event["locks"])
+        return f"Repository locked: {len(event['locks'])} locks, {nb_stale} stale"
+    if event["type"] == EventType.STALLED.value:
+        return f"{operation} stalled ({event['reason']}), interrupting it"
+    return event["type"]
+
+
+class Sink(abc.ABC):
+    """
+    Receives the events of the types it subscribed to
+    deliver() is called from the sink's thread (unless in_thread is False),
+    it may be slow or raise
+    """
+
+    in_thread = True
+
+    def __init__(self, spec):
+        self.name = spec["type"]
+        self.event_types = spec.get("events")
+
+    def accepts(self, event):
+        return self.event_types is None or event["type"] in self.event_types
+
+    @abc.abstractmethod
+    def deliver(self, event):
+        pass
+
+
+class NotifySink(Sink):
+    def deliver(self, event):
+        subprocess.run(
+            [
+                "notify-send",
+                "--app-name",
+                "ENACrestic",
+                "ENACrestic",
+                event_to_str(event),
+            ],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            timeout=const.EVENT_SINK_TIMEOUT_SECONDS,
+            check=True,
+        )
+
+
+class WebhookSink(Sink):
+    def __init__(self, spec):
+        super().__init__(spec)
+        self.name = f"webhook {spec['url']}"
+        self.url = spec["url"]
+
+    def deliver(self, event):
+        response = requests.post(
+            self.url, json=event, timeout=const.EVENT_SINK_TIMEOUT_SECONDS
+        )
+        response.raise_for_status()
+
+
+class ScriptSink(Sink):
+    def __init__(self, spec):
+        super().__init__(spec)
+        self.command = list(spec["command"])
+        self.name = f"script {self.command[0]}"
+
+    def deliver(self, event):
+        subprocess.run(
+            self.command,
+            input=json.dumps(event),
+            text=True,
+            env={**os.environ, "ENACRESTIC_EVENT": event["type"]},
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            timeout=const.EVENT_SINK_TIMEOUT_SECONDS,
+            check=True,
+        )
+
+
+class MetricsSink(Sink):
+    in_thread = False
+
+    def __init__(self, spec, metrics):
+        super().__init__(spec)
+        self.metrics = metrics
+        self.counts = collections.Counter()
+
+    def deliver(self, event):
+        self.counts[event["type"]] += 1
+        self.metrics.set(
+            "events_total",
+            self.counts[event["type"]],
+            "Events published since ENACrestic started",
+            type=event["type"],
+        )
+        self.metrics.set(
+            "last_event_timestamp_seconds",
+            event["timestamp"],
+            "Time of the last event",
+            type=event["type"],
+        )
+        self.metrics.write()
+
+
+class SinkQueue:
+    """
+    Bounded queue of the events to deliver to a sink,
+    and the thread delivering them
+    """
+
+    def __init__(self, sink, engine):
+        self.sink = sink
+        self.engine = engine
+        self.events = queue.Queue(const.EVENT_QUEUE_SIZE)
+        # Updated by the thread, reported by EventBus.publish
+        self.nb_dropped = 0
+        self.nb_failed = 0
+        self.last_error = None
+        self.flush_scheduled = False
+        if sink.in_thread:
+            threading.Thread(target=self._deliver_forever, daemon=True).start()
+
+    def push(self, event):
+        while True:
+            try:
+                self.events.put_nowait(event)
+                break
+            except queue.Full:
+                try:
+                    self.events.get_nowait()
+                    self.events.task_done()
+                    self.nb_dropped += 1
+                except queue.Empty:
+                    pass
+        if not self.sink.in_thread and not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.engine.single_shot(0, self._flush)
+
+    def pending(self):
+        """
+        return the number of events not delivered yet (being delivered included)
+        """
+        return self.events.unfinished_tasks
+
+    def _deliver(self, event):
+        try:
+            self.sink.deliver(event)
+        except Exception as e:  # whatever a sink raises, it must go on
+            self.nb_failed += 1
+            self.last_error = str(e) or e.__class__.__name__
+        self.events.task_done()
+
+    def _deliver_forever(self):
+        while True:
+            self._deliver(self.events.get())
+
+    def _flush(self):
+        self.flush_scheduled = False
+        while not self.events.empty():
+            self._deliver(self.events.get_nowait())
+
+
+class EventBus:
+    def __init__(self, engine, logger):
+        self.engine = engine
+        self.logger = logger
+        self.sink_queues = []
+        # (dropped, failed) already reported, per sink queue
+        self.reported = {}
+
+    def add_sinks(self, specs, metrics):
+        """
+        Add the sinks described in prefs.json (see module docstring)
+        """
+        for spec in specs:
+            try:
+                if spec["type"] == "notify":
+                    sink = NotifySink(spec)
+                elif spec["type"] == "webhook":
+                    sink = WebhookSink(spec)
+                elif spec["type"] == "script":
+                    sink = ScriptSink(spec)
+                elif spec["type"] == "metrics":
+                    sink = MetricsSink(spec, metrics)
+                else:
+                    self.logger.error(f"Unknown event sink type '{spec['type']}'")
+                    continue
+            except (KeyError, IndexError, TypeError) as e:
+                self.logger.error(f"Event sink {spec} misconfigured ({e})")
+                continue
+            self.sink_queues.append(SinkQueue(sink, self.engine))
+
+    def publish(self, event_type, **payload):
+        """
+        Queue the event for every sink subscribed to event_type
+        """
+        now = time.time()
+        event = {
+            "type": event_type.value,
+            "time": datetime.datetime.utcfromtimestamp(now).strftime(
+                "%Y-%m-%dT%H:%M:%SZ"
+            ),
+            "timestamp": now,
+            "hostname": socket.gethostname(),
+            "username": const.USERNAME,
+            **payload,
+        }
+        for sink_queue in self.sink_queues:
+            self._report_problems(sink_queue)
+            if sink_queue.sink.accepts(event):
+                sink_queue.push(event)
+
+    def _report_problems(self, sink_queue):
+        """
+        Log what went wrong with a sink since last time (from the event loop)
+        """
+        dropped, failed = self.reported.get(id(sink_queue), (0, 0))
+        if sink_queue.nb_dropped > dropped:
+            self.logger.error(
+                f"Event sink {sink_queue.sink.name} too slow: "
+                f"{sink_queue.nb_dropped - dropped} events dropped"
+            )
+        if sink_queue.nb_failed > failed:
+            self.logger.error(
+                f"Event sink {sink_queue.sink.name} failed "
+                f"{sink_queue.nb_failed - failed} times ({sink_queue.last_error})"
+            )
+        self.reported[id(sink_queue)] = (sink_queue.nb_dropped, sink_queue.nb_failed)
+
+    def drain(self, timeout):
+        """
+        Give the sinks at most timeout seconds to deliver pending events
+        (when quitting)
+        """
+        deadline = time.monotonic() + timeout
+        for sink_queue in self.sink_queues:
+            if not sink_queue.sink.in_thread:
+                sink_queue._flush()
+        while time.monotonic() < deadline and any(
+            sink_queue.pending() > 0 for sink_queue in self.sink_queues
+        ):
+            time.sleep(0.05)
@@ -0,0 +1,351 @@
+"""
+Optional index of the files of every snapshot, stored in a SQLite database
+(~/.enacrestic/file_index.sqlite), to find in which snapshots a file is
+without walking the repository trees.
+
++ built from `restic ls --json` of the snapshots not indexed yet only
++ compact :
+  + each path is stored once (paths table)
+  + a version of a file (same size, mtime and type) is a single row,
+    spanning the range of consecutive snapshots of a series holding it.
+    A series is the snapshots of a host with the same tags
+    (same grouping as forget)
++ pruned when snapshots are forgotten
+"""
+
+import datetime
+import json
+import os
+import sqlite3
+
+from enacrestic import const
+from enacrestic.utils import bytes_to_human, parse_restic_time, utc_to_local_str
+
+DB_DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def series_of(snapshot):
+    """
+    return the series of a snapshot (as given by the catalog)
+    """
+    return json.dumps([snapshot["hostname"], sorted(snapshot["tags"])])
+
+
+def glob_condition(pattern):
+    """
+    return the SQL condition (and its parameter) matching paths
+    for a shell-like pattern
+    + with a "/" : matched against the whole path
+    + otherwise : matched against the file name (e.g. "thesis*.docx"),
+      using the index on names
+    """
+    if "/" in pattern:
+        return "paths.path GLOB ?", pattern
+    return "paths.name GLOB ?", pattern
+
+
+class FileIndex:
+    def __init__(self, db_path=const.FILE_INDEX_DB):
+        self.db = sqlite3.connect(db_path)
+        self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS snapshots (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                id TEXT NOT NULL UNIQUE,
+                series TEXT NOT NULL,
+                time_utc TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS paths (
+                id INTEGER PRIMARY KEY,
+                path TEXT NOT NULL UNIQUE,
+                name TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS paths_name ON paths (name);
+            CREATE TABLE IF NOT EXISTS versions (
+                path_id INTEGER NOT NULL,
+                series TEXT NOT NULL,
+                first_seq INTEGER NOT NULL,
+                last_seq INTEGER NOT NULL,
+                type TEXT,
+                size INTEGER,
+                mtime TEXT
+            );
+            CREATE INDEX IF NOT EXISTS versions_path ON versions (path_id);
+            CREATE INDEX IF NOT EXISTS versions_series
+                ON versions (series, last_seq);
+            """
+        )
+        self.db.commit()
+        self.current = None
+
+    def indexed_ids(self):
+        return {row[0] for row in self.db.execute("SELECT id FROM snapshots")}
+
+    def snapshots_to_index(self, catalog, limit):
+        """
+        return the ids of (at most limit) snapshots of the catalog
+        not indexed yet, oldest first
+        """
+        indexed_ids = self.indexed_ids()
+        snapshots = catalog.get_snapshots(limit=-1)
+        return [
+            snapshot["id"]
+            for snapshot in reversed(snapshots)
+            if snapshot["id"] not in indexed_ids
+        ][:limit]
+
+    def begin_snapshot(self, snapshot):
+        """
+        Start indexing a snapshot (as given by the catalog)
+        its files are then given one by one to add_node
+        """
+        series = series_of(snapshot)
+        row = self.db.execute(
+            "SELECT MAX(seq) FROM snapshots WHERE series = ?", (series,)
+        ).fetchone()
+        prev_seq = row[0]
+        cursor = self.db.execute(
+            "INSERT INTO snapshots (id, series, time_utc) VALUES (?, ?, ?)",
+            (
+                snapshot["id"],
+                series,
+                snapshot["time_utc_dt"].strftime(DB_DATE_FORMAT),
+            ),
+        )
+        # Versions of the previous snapshot of the series,
+        # extended to this one if the file didn't change
+        prev_versions = {}
+        if prev_seq is not None:
+            for path, rowid, node_type, size, mtime in self.db.execute(
+                """
+                SELECT paths.path, versions.rowid, type, size, mtime
+                FROM versions JOIN paths ON paths.id = versions.path_id
+                WHERE series = ? AND last_seq = ?
+                """,
+                (series, prev_seq),
+            ):
+                prev_versions[path] = (rowid, (node_type, size, mtime))
+        self.current = {
+            "seq": cursor.lastrowid,
+            "series": series,
+            "prev_versions": prev_versions,
+            "extended": [],
+            "nb_files": 0,
+            "nb_new_versions": 0,
+        }
+
+    def add_node(self, node):
+        """
+        Add one line of `restic ls --json` to the snapshot being indexed
+        """
+        if self.current is None:
+            return
+        # "struct_type" before restic 0.17
+        if node.get("message_type", node.get("struct_type")) != "node":
+            return
+        path = node["path"]
+        version = (node.get("type"), node.get("size"), node.get("mtime"))
+        self.current["nb_files"] += 1
+        prev_version = self.current["prev_versions"].get(path)
+        if prev_version is not None and prev_version[1] == version:
+            self.current["extended"].append((self.current["seq"], prev_version[0]))
+            return
+        self.db.execute(
+            "INSERT OR IGNORE INTO paths (path, name) VALUES (?, ?)",
+            (path, node.get("name", os.path.basename(path))),
+        )
+        path_id = self.db.execute(
+            "SELECT id FROM paths WHERE path = ?", (path,)
+        ).fetchone()[0]
+        self.db.execute(
+            "INSERT INTO versions (path_id, series, first_seq, last_seq, "
+            "type, size, mtime) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                path_id,
+                self.current["series"],
+                self.current["seq"],
+                self.current["seq"],
+            )
+            + version,
+        )
+        self.current["nb_new_versions"] += 1
+
+    def end_snapshot(self, success):
+        """
+        Finish indexing the current snapshot
+        return (nb files, nb new versions) or None if not successful
+        """
+        if self.current is None:
+            return None
+        if not success:
+            self.db.rollback()
+            self.current = None
+            return None
+        self.db.executemany(
+            "UPDATE versions SET last_seq = ? WHERE rowid = ?",
+            self.current["extended"],
+        )
+        self.db.commit()
+        result = (self.current["nb_files"], self.current["nb_new_versions"])
+        self.current = None
+        return result
+
+    def prune(self, snapshot_ids):
+        """
+        Forget the snapshots not in snapshot_ids (the ones still in the repository)
+        and the versions of files only they were holding
+        """
+        with self.db:
+            self.db.execute("CREATE TEMP TABLE IF NOT EXISTS kept (id TEXT)")
+            self.db.execute("DELETE FROM kept")
+            self.db.executemany(
+                "INSERT INTO kept (id) VALUES (?)", [(id,) for id in snapshot_ids]
+            )
+            nb_removed = self.db.execute(
+                "DELETE FROM snapshots WHERE id NOT IN (SELECT id FROM kept)"
+            ).rowcount
+            if nb_removed > 0:
+                self._delete_orphan_versions()
+        return nb_removed
+
+    def remove(self, snapshot_ids):
+        """
+        Forget the snapshots of snapshot_ids (forgotten from the repository)
+        and the versions of files only they were holding
+        """
+        with self.db:
+            nb_removed = 0
+            for snapshot_id in snapshot_ids:
+                nb_removed += self.db.execute(
+                    "DELETE FROM snapshots WHERE id = ?", (snapshot_id,)
+                ).rowcount
+            if nb_removed > 0:
+                self._delete_orphan_versions()
+        return nb_removed
+
+    def _delete_orphan_versions(self):
+        self.db.execute(
+            """
+            DELETE FROM versions WHERE NOT EXISTS (
+                SELECT 1 FROM snapshots
+                WHERE snapshots.series = versions.series
+                AND snapshots.seq BETWEEN versions.first_seq AND versions.last_seq
+            )
+            """
+        )
+        self.db.execute(
+            "DELETE FROM paths WHERE id NOT IN (SELECT path_id FROM versions)"
+        )
+
+    def find(self, pattern, limit=100):
+        """
+        return the versions of files matching pattern (shell-like)
+        as dicts with the snapshots holding them (oldest first)
+        limit=-1 : no limit
+        """
+        results = []
+        condition, param = glob_condition(pattern)
+        for (
+            path,
+            series,
+            first_seq,
+            last_seq,
+            node_type,
+            size,
+            mtime,
+        ) in self.db.execute(
+            f"""
+            SELECT paths.path, series, first_seq, last_seq, type, size, mtime
+            FROM paths JOIN versions ON versions.path_id = paths.id
+            WHERE {condition}
+            ORDER BY paths.path, first_seq
+            LIMIT ?
+            """,
+            (param, limit),
+        ):
+            snapshots = [
+                {
+                    "id": row[0],
+                    "time_utc_dt": datetime.datetime.strptime(row[1], DB_DATE_FORMAT),
+                }
+                for row in self.db.execute(
+                    """
+                    SELECT id, time_utc FROM snapshots
+                    WHERE series = ? AND seq BETWEEN ? AND ?
+                    ORDER BY seq
+                    """,
+                    (series, first_seq, last_seq),
+                )
+            ]
+            results.append(
+                {
+                    "path": path,
+                    "type": node_type,
+                    "size": size,
+                    "mtime": mtime,
+                    "snapshots": snapshots,
+                }
+            )
+        return results
+
+    def latest_snapshot_holding(self, pattern):
+        """
+        return (snapshot id, [matching paths]) of the most recent snapshot
+        holding a file matching pattern, None if there is none
+        """
+        versions = self.find(pattern, limit=-1)
+        if len(versions) == 0:
+            return None
+        latest = max(
+            (version["snapshots"][-1] for version in versions),
+            key=lambda snapshot: snapshot["time_utc_dt"],
+        )
+        paths = [
+            version["path"]
+            for version in versions
+            if latest["id"] in (snapshot["id"] for snapshot in version["snapshots"])
+        ]
+        return latest["id"], paths
+
+
+def version_to_str(version):
+    """
+    return one line describing a version of a file and where it is
+    """
+    snapshots = version["snapshots"]
+    line = version["path"]
+    if version["type"] == "file" and version["size"] is not None:
+        line += f"  {bytes_to_human(version['size'])}"
+    if version["mtime"] is not None:
+        line += f"  modified {utc_to_local_str(parse_restic_time(version['mtime']))}"
+    line += (
+        f"\n    in {len(snapshots)} snapshots, "
+        f"from {utc_to_local_str(snapshots[0]['time_utc_dt'])} ({snapshots[0]['id'][:8]})"
+        f" to {utc_to_local_str(snapshots[-1]['time_utc_dt'])} ({snapshots[-1]['id'][:8]})"
+    )
+    return line
+
+
+def print_find(pattern, limit, as_json=False):
+    """
+    Print the versions of files matching pattern
+    (used by `enacrestic find`)
+    """
+    if not os.path.exists(const.FILE_INDEX_DB):
+        print(
+            'The file index is not built. Set "file_index_enabled": true '
+            f"in {const.RESTIC_CONFFILE} to build it after the next backups."
+        )
+        return 1
+    versions = FileIndex().find(pattern, limit)
+    if as_json:
+        for version in versions:
+            for snapshot in version["snapshots"]:
+                snapshot["time"] = utc_to_local_str(snapshot.pop("time_utc_dt"))
+        print(json.dumps(versions, indent=2))
+        return 0
+    for version in versions:
+        print(version_to_str(version))
+    if len(versions) == 0:
+        print(f"No file matching {pattern}")
+    return 0
@@ -0,0 +1,231 @@
+"""
+Decide if a due backup can start now, or has to be deferred,
+according to the "backup_gating" policies set in prefs.json :
+
+{
+  "on_battery": {"max_age_hours": 4, "min_battery_percent": 10},
+  "metered": {"max_age_hours": 24},
+  "user_active": {"min_idle_minutes": 5, "max_age_hours": 2}
+}
+
++ on_battery : the laptop runs on battery
+  (below min_battery_percent, the backup is always deferred)
++ metered : the network connection is metered (as told by NetworkManager)
++ user_active : the session was idle for less than min_idle_minutes
+  (as told by systemd-logind, not every desktop reports it)
+
+While a condition holds, the backup is deferred
+unless the last successful one is older than max_age_hours
+(null : deferred as long as the condition holds).
+A policy missing from backup_gating is not checked.
+"""
+
+import datetime
+import os
+import subprocess
+import time
+
+POWER_SUPPLY_FOLDER = "/sys/class/power_supply"
+# Tools are given that long to answer, not to delay the scheduler
+COMMAND_TIMEOUT_SECONDS = 2
+
+
+def _read(path):
+    try:
+        with open(path, "r") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def power_status(folder=POWER_SUPPLY_FOLDER):
+    """
+    return (on battery, battery capacity in %)
+    None if there is no system battery (e.g. a desktop)
+    """
+    try:
+        supplies = os.listdir(folder)
+    except OSError:
+        return None
+    on_ac = False
+    discharging = False
+    capacities = []
+    for supply in supplies:
+        path = os.path.join(folder, supply)
+        supply_type = _read(os.path.join(path, "type"))
+        if supply_type == "Battery":
+            # Batteries of a mouse, a keyboard ... don't count
+            if _read(os.path.join(path, "scope")) == "Device":
+                continue
+            if _read(os.path.join(path, "status")) == "Discharging":
+                discharging = True
+            capacity = _read(os.path.join(path, "capacity"))
+            if capacity is not None and capacity.isdigit():
+                capacities.append(int(capacity))
+        elif _read(os.path.join(path, "online")) == "1":
+            on_ac = True
+    if not discharging and len(capacities) == 0:
+        return None
+    return discharging and not on_ac, min(capacities) if capacities else None
+
+
+def _run(args):
+    """
+    return stdout of a command, None if it fails
+    """
+    try:
+        p = subprocess.run(
+            args,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+            timeout=COMMAND_TIMEOUT_SECONDS,
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    if p.returncode != 0:
+        return None
+    return p.stdout
+
+
+def metered_connection():
+    """
+    return True if NetworkManager considers the connection as metered,
+    None if unknown
+    """
+    stdout = _run(
+        [
+            "busctl",
+            "--system",
+            "get-property",
+            "org.freedesktop.NetworkManager",
+            "/org/freedesktop/NetworkManager",
+            "org.freedesktop.NetworkManager",
+            "Metered",
+        ]
+    )
+    if stdout is None:
+        return None
+    # "u 3" : NMMetered enum (unknown, yes, no, guess-yes, guess-no)
+    metered = stdout.split()[-1]
+    if metered in ("1", "3"):
+        return True
+    if metered in ("2", "4"):
+        return False
+    return None
+
+
+def user_idle_seconds():
+    """
+    return for how long the user's session is idle (0 if active),
+    None if unknown
+    """
+    stdout = _run(
+        [
+            "loginctl",
+            "show-session",
+            os.environ.get("XDG_SESSION_ID", "auto"),
+            "-p",
+            "IdleHint",
+            "-p",
+            "IdleSinceHint",
+        ]
+    )
+    if stdout is None:
+        return None
+    properties = dict(line.split("=", 1) for line in stdout.splitlines() if "=" in line)
+    if properties.get("IdleHint") != "yes":
+        return 0
+    try:
+        # Wall-clock time, in µs since the epoch
+        idle_since_seconds = int(properties["IdleSinceHint"]) / 1e6
+    except (KeyError, ValueError):
+        return None
+    return max(time.time() - idle_since_seconds, 0)
+
+
+def check_conditions(policies):
+    """
+    return the conditions the policies depend on (only those)
+    """
+    result = {}
+    if "on_battery" in policies:
+        power = power_status()
+        result["on_battery"] = None if power is None else power[0]
+        result["battery_percent"] = None if power is None else power[1]
+    if "metered" in policies:
+        result["metered"] = metered_connection()
+    if "user_active" in policies:
+        result["idle_seconds"] = user_idle_seconds()
+    return result
+
+
+def deferral_reason(policies, conditions, last_success_utc_dt, now_utc_dt=None):
+    """
+    return why the backup has to be deferred, None if it can start
+    """
+    if now_utc_dt is None:
+        now_utc_dt = datetime.datetime.utcnow()
+
+    def _recent_enough(policy):
+        max_age_hours = policy.get("max_age_hours")
+        if max_age_hours is None:
+            return True
+        if last_success_utc_dt is None:
+            return False
+        return now_utc_dt - last_success_utc_dt < datetime.timedelta(
+            hours=max_age_hours
+        )
+
+    policy = policies.get("on_battery")
+    if policy is not None and conditions.get("on_battery"):
+        battery_percent = conditions.get("battery_percent")
+        min_battery_percent = policy.get("min_battery_percent")
+        if (
+            min_battery_percent is not None
+            and battery_percent is not None
+            and battery_percent < min_battery_percent
+        ):
+            return f"battery low ({battery_percent}%)"
+        if _recent_enough(policy):
+            return "on battery"
+
+    policy = policies.get("metered")
+    if policy is not None and conditions.get("metered") and _recent_enough(policy):
+        return "metered connection"
+
+    policy = policies.get("user_active")
+    idle_seconds = conditions.get("idle_seconds")
+    if (
+        policy is not None
+        and idle_seconds is not None
+        and idle_seconds < policy.get("min_idle_minutes", 5) * 60
+        and _recent_enough(policy)
+    ):
+        return "user active"
+    return None
+
+
+def publish_gating_metrics(metrics, conditions, deferred, deferred_seconds):
+    """
+    Export the conditions checked and the current (or last) deferral
+    """
+    metrics.set("on_battery", conditions.get("on_battery"), "Running on battery")
+    metrics.set(
+        "battery_percent", conditions.get("battery_percent"), "Battery capacity"
+    )
+    metrics.set(
+        "metered_connection", conditions.get("metered"), "Connection is metered"
+    )
+    metrics.set(
+        "user_idle_seconds",
+        conditions.get("idle_seconds"),
+        "For how long the user's session is idle",
+    )
+    metrics.set("backup_deferred", deferred, "Due backup deferred by the gating")
+    metrics.set(
+        "backup_deferred_seconds",
+        deferred_seconds,
+        "For how long the current (or last) due backup was deferred",
+    )
+    metrics.write()
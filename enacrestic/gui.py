@@ -0,0 +1,405 @@
+"""
+System tray of ENACrestic, the only part needing PyQt5's widgets
+"""
+
+import datetime
+import os
+import webbrowser
+
+from PyQt5.QtCore import QTimer
+from PyQt5.QtGui import QIcon
+from PyQt5.QtWidgets import (
+    QAction,
+    QApplication,
+    QInputDialog,
+    QMenu,
+    QMessageBox,
+    QSystemTrayIcon,
+)
+
+from enacrestic import __version__, const
+from enacrestic.catalog import snapshot_to_str
+from enacrestic.file_index import version_to_str
+from enacrestic.repo_stats import analysis_to_str
+from enacrestic.state import CurrentOperation, Status
+from enacrestic.utils import utc_to_local
+
+
+class QTGuiApp(QApplication):
+    """
+    Main app, starting QApplication and QSystemTrayIcon when it's ready.
+    """
+
+    def __init__(self, argv, app):
+        super().__init__(argv)
+        self.tray_icon = None
+        self.app = app
+
+        # start app when systray is available
+        # workaround to fix automatic start when ENACrestic is launched at the session opening
+        QTimer.singleShot(2000, self._start_app)
+
+    def _start_app(self):
+        """
+        Start Qt System tray when everything is ready
+        """
+        icon_path = self.app.state.get_icon()
+        self.tray_icon = QSystemTrayIcon(QIcon(icon_path), parent=self)
+        self.tray_icon.show()
+
+        menu = QMenu()
+        # Entry to display informations to the user
+        self.info_action = menu.addAction("ENACrestic launched")
+
+        # Entry to display informations when an upgrade is available
+        self.upgrade_action = menu.addAction(
+            "New version is available.\nClick here to read the upgrade instructions."
+        )
+        self.upgrade_action.triggered.connect(self.open_upgrade_instructions)
+        self.upgrade_action.setVisible(False)
+
+        # Submenu listing the latest snapshots, from the local catalog
+        self.snapshots_menu = menu.addMenu("Recent snapshots")
+        self.snapshots_menu.aboutToShow.connect(self._fill_snapshots_menu)
+
+        # Entry to search a file in every snapshot
+        if self.app.file_index is not None:
+            find_action = menu.addAction("Find a file in the snapshots ...")
+            find_action.triggered.connect(self._find_file)
+
+        menu.addSection("Actions")
+
+        # Entry to set if the application has
+        # to auto-start with the session
+        self.autostart_action = QAction("Auto-start", checkable=True)
+        self.autostart_action.triggered.connect(self._toggle_autostart)
+        self.autostart_action.setChecked(self.app.conf.gui_autostart)
+        menu.addAction(self.autostart_action)
+
+        # Entry to exit the application by the user
+        exit_action = menu.addAction("Exit")
+        exit_action.triggered.connect(self.app.quit)
+
+        self.tray_icon.setContextMenu(menu)
+
+        self.update_system_tray()
+
+    def _fill_snapshots_menu(self):
+        """
+        List the latest snapshots known by the catalog (works offline)
+        """
+        self.snapshots_menu.clear()
+        age_action = self.snapshots_menu.addAction(self.app.catalog.age_message())
+        age_action.setEnabled(False)
+        snapshots = self.app.catalog.get_snapshots(const.NB_SNAPSHOTS_IN_TRAY)
+        if len(snapshots) == 0:
+            self.snapshots_menu.addAction("No snapshot known yet").setEnabled(False)
+        for snapshot in snapshots:
+            self.snapshots_menu.addAction(snapshot_to_str(snapshot))
+
+    def _find_file(self):
+        """
+        Ask for a file name pattern and show the snapshots holding it
+        """
+        pattern, ok = QInputDialog.getText(
+            None, "ENACrestic", "File name or path (wildcards allowed):"
+        )
+        if not ok or pattern.strip() == "":
+            return
+        versions = self.app.file_index.find(
+            pattern.strip(), const.NB_FILES_FOUND_IN_TRAY
+        )
+        if len(versions) == 0:
+            text = f"No file matching {pattern} in the indexed snapshots."
+        else:
+            text = "\n".join(version_to_str(version) for version in versions)
+            text += (
+                "\n\nRestore with:\n"
+                f"enacrestic restore --find '{pattern.strip()}' --target <folder>"
+            )
+        QMessageBox.information(None, "ENACrestic", text)
+
+    def open_upgrade_instructions(self):
+        webbrowser.open(const.UPGRADE_DOC)
+
+    def update_system_tray(self):
+        """
+        update system tray according to the state
+        + icon to current state
+        + info_action with current state infos
+        + Show upgrade_action if needed
+        """
+
+        def _str_date(utc_dt):
+            """
+            return nice date (with only h:m:s if it's in the last 24h)
+            """
+
+            if datetime.datetime.utcnow() - utc_dt < datetime.timedelta(days=1):
+                return "at %s" % utc_to_local(utc_dt).strftime("%H:%M:%S")
+            else:
+                return "on %s" % utc_to_local(utc_dt).strftime("%Y-%m-%d %H:%M:%S")
+
+        def _str_duration(seconds, shortest=False):
+            """
+            return nice duration as __h __m __s
+            if not shortest :
+                __s | __m __s | __h __m __s
+            if shortest :
+                __h | __m | __s |
+                __h __m | __m __s |
+                __h __m __s
+            """
+            seconds = int(seconds)
+            hours, seconds = divmod(seconds, 3600)
+            minutes, seconds = divmod(seconds, 60)
+            if shortest:
+                if hours > 0:
+                    if minutes > 0:
+                        if seconds > 0:
+                            return f"{hours}h {minutes}m {seconds}s"
+                        else:
+                            return f"{hours}h {minutes}m"
+                    else:
+                        if seconds > 0:
+                            return f"{hours}h {minutes}m {seconds}s"
+                        else:
+                            return f"{hours}h"
+                else:
+                    if minutes > 0:
+                        if seconds > 0:
+                            return f"{minutes}m {seconds}s"
+                        else:
+                            return f"{minutes}m"
+                    else:
+                        return f"{seconds}s"
+            else:
+                if hours > 0:
+                    return f"{hours}h {minutes}m {seconds}s"
+                elif minutes > 0:
+                    return f"{minutes}m {seconds}s"
+                else:
+                    return f"{seconds}s"
+
+        def _str_last_chronos(subject, list_chronos):
+            """
+            return msg with latest chrono and average over the last n
+            """
+            nb_chronos = len(list_chronos)
+            if nb_chronos == 0:
+                return ""
+            msg = """
+-> latest %s %s : %s""" % (
+                subject,
+                _str_date(list_chronos[0][0]),
+                _str_duration(list_chronos[0][1]),
+            )
+            if nb_chronos >= 2:
+                sum_chronos = sum([chrono[1] for chrono in list_chronos])
+                average_chrono = sum_chronos / nb_chronos
+                msg += """
+average over the last %d : %s""" % (
+                    nb_chronos,
+                    _str_duration(average_chrono),
+                )
+            return msg
+
+        if self.tray_icon is None:
+            return
+
+        icon_path = self.app.state.get_icon()
+        self.tray_icon.setIcon(QIcon(icon_path))
+
+        state_msg = f"ENACrestic {__version__}\n\n"
+
+        if self.app.state.current_operation == CurrentOperation.JUST_LAUNCHED:
+            state_msg += (
+                "Just launched,\n"
+                "a backup will be done every "
+                f"{_str_duration(self.app.conf.backup_every_n_minutes * 60, True)}.\n"
+                f"Next backup {_str_date(self.app.state.next_backup_due_utc_dt)}"
+            )
+        elif self.app.state.current_operation == CurrentOperation.IDLE:
+            if self.app.state.current_status == Status.OK:
+                state_msg += "Last backup was successful"
+                if self.app.state.pre_backup_failed:
+                    state_msg += " but pre-backup hook failed"
+            elif self.app.state.current_status == Status.LAST_OPERATION_FAILED:
+                state_msg += (
+                    f"Last operation failed, {_str_date(self.app.state.last_failed_utc_dt)}\n"
+                    f"see {const.RESTIC_LOGFILE} for details."
+                )
+            elif self.app.state.current_status == Status.STALLED:
+                state_msg += (
+                    f"Last operation stalled and was interrupted, "
+                    f"{_str_date(self.app.state.last_failed_utc_dt)}\n"
+                    f"see {const.RESTIC_LOGFILE} for details."
+                )
+            elif self.app.state.current_status == Status.NO_NETWORK:
+                state_msg += (
+                    f"Network timeout {_str_date(self.app.state.last_failed_utc_dt)}"
+                )
+            if self.app.state.nb_staged_snapshots > 0:
+                state_msg += (
+                    f"\n{self.app.state.nb_staged_snapshots} snapshots staged locally, "
+                    "uploaded once the repository is reachable"
+                )
+            elif self.app.state.current_status == Status.REPO_NOT_INITIALIZED:
+                state_msg += "Repository not initialized"
+            state_msg += (
+                f"\nNext backup {_str_date(self.app.state.next_backup_due_utc_dt)}"
+            )
+            if self.app.restic_backup.deferral is not None:
+                state_msg += f" (deferred: {self.app.restic_backup.deferral['reason']})"
+            elif self.app.restic_backup.off_peak_deferral is not None:
+                state_msg += (
+                    f" (deferred: {self.app.restic_backup.off_peak_deferral['reason']})"
+                )
+            for name, utc_dt in self.app.state.next_group_backup_utc_dts.items():
+                state_msg += f"\nNext backup of '{name}' {_str_date(utc_dt)}"
+        elif self.app.state.current_operation == CurrentOperation.INIT_IN_PROGRESS:
+            state_msg += "Repo init in progress"
+            if self.app.restic_backup.current_utc_dt_starting is not None:
+                state_msg += f" (started {_str_date(self.app.restic_backup.current_utc_dt_starting)})"
+        elif (
+            self.app.state.current_operation == CurrentOperation.PRE_BACKUP_IN_PROGRESS
+        ):
+            state_msg += "Pre-backup in progress"
+            if self.app.restic_backup.current_utc_dt_starting is not None:
+                state_msg += f" (started {_str_date(self.app.restic_backup.current_utc_dt_starting)})"
+        elif self.app.state.current_operation == CurrentOperation.ESTIMATE_IN_PROGRESS:
+            state_msg += "Estimating the backup volume"
+            if self.app.restic_backup.current_utc_dt_starting is not None:
+                state_msg += f" (started {_str_date(self.app.restic_backup.current_utc_dt_starting)})"
+        elif self.app.state.current_operation == CurrentOperation.BACKUP_IN_PROGRESS:
+            state_msg += "Backup in progress"
+            if self.app.restic_backup.current_utc_dt_starting is not None:
+                state_msg += f" (started {_str_date(self.app.restic_backup.current_utc_dt_starting)})"
+        elif (
+            self.app.state.current_operation
+            == CurrentOperation.STREAM_BACKUP_IN_PROGRESS
+        ):
+            state_msg += f"Backup of '{self.app.state.current_target}' in progress"
+            if self.app.restic_backup.current_utc_dt_starting is not None:
+                state_msg += f" (started {_str_date(self.app.restic_backup.current_utc_dt_starting)})"
+        elif (
+            self.app.state.current_operation
+            == CurrentOperation.GROUP_BACKUP_IN_PROGRESS
+        ):
+            state_msg += (
+                f"Backup of group '{self.app.state.current_target}' in progress"
+            )
+            if self.app.restic_backup.current_utc_dt_starting is not None:
+                state_msg += f" (started {_str_date(self.app.restic_backup.current_utc_dt_starting)})"
+        elif self.app.state.current_operation == CurrentOperation.FORGET_IN_PROGRESS:
+            state_msg += "Cleanup in progress"
+            if self.app.restic_backup.current_utc_dt_starting is not None:
+                state_msg += f" (started {_str_date(self.app.restic_backup.current_utc_dt_starting)})"
+        elif (
+            self.app.state.current_operation
+            == CurrentOperation.FORGET_SNAPSHOT_IN_PROGRESS
+        ):
+            state_msg += "Removal of a truncated stream snapshot in progress"
+            if self.app.restic_backup.current_utc_dt_starting is not None:
+                state_msg += f" (started {_str_date(self.app.restic_backup.current_utc_dt_starting)})"
+        elif (
+            self.app.state.current_operation
+            == CurrentOperation.INIT_STAGING_IN_PROGRESS
+        ):
+            state_msg += "Staging repository init in progress"
+            if self.app.restic_backup.current_utc_dt_starting is not None:
+                state_msg += f" (started {_str_date(self.app.restic_backup.current_utc_dt_starting)})"
+        elif (
+            self.app.state.current_operation
+            == CurrentOperation.STAGE_BACKUP_IN_PROGRESS
+        ):
+            state_msg += "Repository unreachable, local backup in progress"
+            if self.app.restic_backup.current_utc_dt_starting is not None:
+                state_msg += f" (started {_str_date(self.app.restic_backup.current_utc_dt_starting)})"
+        elif (
+            self.app.state.current_operation
+            == CurrentOperation.UPLOAD_STAGED_IN_PROGRESS
+        ):
+            state_msg += "Upload of the staged snapshots in progress"
+            if self.app.restic_backup.current_utc_dt_starting is not None:
+                state_msg += f" (started {_str_date(self.app.restic_backup.current_utc_dt_starting)})"
+        elif (
+            self.app.state.current_operation
+            == CurrentOperation.PRUNE_STAGING_IN_PROGRESS
+        ):
+            state_msg += "Cleanup of the staging repository in progress"
+            if self.app.restic_backup.current_utc_dt_starting is not None:
+                state_msg += f" (started {_str_date(self.app.restic_backup.current_utc_dt_starting)})"
+        elif self.app.state.current_operation == CurrentOperation.REPLICATE_IN_PROGRESS:
+            state_msg += "Replication to the secondary repository in progress"
+            if self.app.restic_backup.current_utc_dt_starting is not None:
+                state_msg += f" (started {_str_date(self.app.restic_backup.current_utc_dt_starting)})"
+        elif self.app.state.current_operation == CurrentOperation.UNLOCK_IN_PROGRESS:
+            state_msg += "Unlock in progress"
+            if self.app.restic_backup.current_utc_dt_starting is not None:
+                state_msg += f" (started {_str_date(self.app.restic_backup.current_utc_dt_starting)})"
+        elif (
+            self.app.state.current_operation
+            == CurrentOperation.SYNC_CATALOG_IN_PROGRESS
+        ):
+            state_msg += "Snapshot catalog sync in progress"
+            if self.app.restic_backup.current_utc_dt_starting is not None:
+                state_msg += f" (started {_str_date(self.app.restic_backup.current_utc_dt_starting)})"
+        elif (
+            self.app.state.current_operation == CurrentOperation.INDEX_FILES_IN_PROGRESS
+        ):
+            state_msg += "File indexing in progress"
+            if self.app.restic_backup.current_utc_dt_starting is not None:
+                state_msg += f" (started {_str_date(self.app.restic_backup.current_utc_dt_starting)})"
+        elif self.app.state.current_operation == CurrentOperation.STATS_IN_PROGRESS:
+            state_msg += "Measuring the repository size"
+            if self.app.restic_backup.current_utc_dt_starting is not None:
+                state_msg += f" (started {_str_date(self.app.restic_backup.current_utc_dt_starting)})"
+
+        # Add conditionnal stats on last backups and last cleanups
+        last_chronos = _str_last_chronos("backup", self.app.state.prev_backup_chronos)
+        last_chronos += _str_last_chronos("cleanup", self.app.state.prev_forget_chronos)
+        if last_chronos != "":
+            state_msg += "\n"
+            state_msg += last_chronos
+        if self.app.repo_analysis is not None:
+            state_msg += f"\n\n{analysis_to_str(self.app.repo_analysis)}"
+        self.info_action.setText(state_msg)
+
+        # show / hide upgrade_action
+        self.upgrade_action.setVisible(self.app.state.version_need_upgrade())
+
+    def _toggle_autostart(self):
+        """
+        Save and apply user's choice to autostart or not
+        """
+
+        gui_autostart = self.autostart_action.isChecked()
+        self.app.conf.set(gui_autostart=gui_autostart)
+        if gui_autostart:
+            # Want the app to autostart with user's session
+            autostart_folder = os.path.dirname(const.RESTIC_AUTOSTART_FILE)
+            os.makedirs(autostart_folder, exist_ok=True)
+            with open(const.RESTIC_AUTOSTART_FILE, "w") as f:
+                f.write(
+                    f"""\
+[Desktop Entry]
+Name=ENACrestic
+Comment=Automated Backup with restic
+Exec={const.ENACRESTIC_BIN}
+Icon=enacrestic
+Terminal=false
+Type=Application
+Encoding=UTF-8
+Categories=Utility;Archiving;
+Keywords=backup;enac;restic
+Name[en_US]=ENACrestic
+X-GNOME-Autostart-enabled=true
+"""
+                )
+        else:
+            # Users doesn't want ENACrestic to autostart
+            try:
+                os.remove(const.RESTIC_AUTOSTART_FILE)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,212 @@
+"""
+History of every operation run, stored in a SQLite database
+(~/.enacrestic/history.sqlite), with the details collected during the run
+(throughput, ...) stored as JSON.
+The size of the repository measured over time is stored as well.
+"""
+
+import datetime
+import json
+import sqlite3
+
+from enacrestic import const
+from enacrestic.state import Operation
+from enacrestic.utils import bytes_to_human, utc_to_local_str
+
+DB_DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+class RunHistory:
+    def __init__(self, db_path=const.HISTORY_DB):
+        self.db = sqlite3.connect(db_path)
+        self.db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS runs (
+                id INTEGER PRIMARY KEY,
+                operation TEXT NOT NULL,
+                target TEXT,
+                start_utc TEXT NOT NULL,
+                seconds REAL NOT NULL,
+                status TEXT NOT NULL,
+                details TEXT NOT NULL
+            )
+            """
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS runs_operation ON runs (operation, start_utc)"
+        )
+        self.db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS repo_stats (
+                id INTEGER PRIMARY KEY,
+                time_utc TEXT NOT NULL,
+                context TEXT NOT NULL,
+                total_size INTEGER NOT NULL,
+                total_uncompressed_size INTEGER,
+                total_blob_count INTEGER,
+                snapshots_count INTEGER
+            )
+            """
+        )
+        self.db.commit()
+
+    def add_run(self, operation, target, start_utc_dt, seconds, status, details):
+        """
+        Record a finished operation
+        """
+        with self.db:
+            self.db.execute(
+                "INSERT INTO runs (operation, target, start_utc, seconds, status, details) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    operation.value,
+                    target,
+                    start_utc_dt.strftime(DB_DATE_FORMAT),
+                    seconds,
+                    status.value,
+                    json.dumps(details, sort_keys=True),
+                ),
+            )
+
+    def get_runs(self, operations=None, limit=100):
+        """
+        return the most recent runs (newest first) as dicts
+        optionally only the given operations
+        """
+        query = (
+            "SELECT operation, target, start_utc, seconds, status, details FROM runs"
+        )
+        params = []
+        if operations is not None:
+            query += f" WHERE operation IN ({', '.join('?' * len(operations))})"
+            params = [operation.value for operation in operations]
+        query += " ORDER BY start_utc DESC, id DESC LIMIT ?"
+        params.append(limit)
+        runs = []
+        for row in self.db.execute(query, params):
+            run = json.loads(row[5])
+            run.update(
+                {
+                    "operation": row[0],
+                    "target": row[1],
+                    "start_utc_dt": datetime.datetime.strptime(row[2], DB_DATE_FORMAT),
+                    "seconds": row[3],
+                    "status": row[4],
+                }
+            )
+            runs.append(run)
+        return runs
+
+    def add_repo_stats(self, time_utc_dt, context, stats):
+        """
+        Record the repository size (as given by `restic stats --mode raw-data`)
+        context tells when it was measured (periodic, before_prune, after_prune)
+        """
+        with self.db:
+            self.db.execute(
+                "INSERT INTO repo_stats (time_utc, context, total_size, "
+                "total_uncompressed_size, total_blob_count, snapshots_count) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    time_utc_dt.strftime(DB_DATE_FORMAT),
+                    context,
+                    stats["total_size"],
+                    stats.get("total_uncompressed_size"),
+                    stats.get("total_blob_count"),
+                    stats.get("snapshots_count"),
+                ),
+            )
+
+    def get_repo_stats(self, since_utc_dt=None):
+        """
+        return the repository sizes recorded since since_utc_dt (oldest first)
+        """
+        query = (
+            "SELECT time_utc, context, total_size, total_uncompressed_size, "
+            "total_blob_count, snapshots_count FROM repo_stats"
+        )
+        params = []
+        if since_utc_dt is not None:
+            query += " WHERE time_utc >= ?"
+            params.append(since_utc_dt.strftime(DB_DATE_FORMAT))
+        query += " ORDER BY time_utc, id"
+        return [
+            {
+                "time_utc_dt": datetime.datetime.strptime(row[0], DB_DATE_FORMAT),
+                "context": row[1],
+                "total_size": row[2],
+                "total_uncompressed_size": row[3],
+                "total_blob_count": row[4],
+                "snapshots_count": row[5],
+            }
+            for row in self.db.execute(query, params)
+        ]
+
+    def last_repo_stats_utc_dt(self):
+        """
+        return when the repository size was last measured, None if never
+        """
+        row = self.db.execute("SELECT MAX(time_utc) FROM repo_stats").fetchone()
+        if row[0] is None:
+            return None
+        return datetime.datetime.strptime(row[0], DB_DATE_FORMAT)
+
+    def throughput_per_window(self, operations):
+        """
+        return {bandwidth window name: (nb runs, average uploaded bytes/s)}
+        for successful runs that uploaded something
+        """
+        per_window = {}
+        for run in self.get_runs(operations, limit=1000):
+            if run["status"] != "ok" or run.get("bytes_uploaded") is None:
+                continue
+            if run["seconds"] <= 0:
+                continue
+            window = run.get("bandwidth_window") or "unlimited"
+            per_window.setdefault(window, []).append(
+                run["bytes_uploaded"] / run["seconds"]
+            )
+        return {
+            window: (len(throughputs), sum(throughputs) / len(throughputs))
+            for window, throughputs in per_window.items()
+        }
+
+
+def print_history(nb_runs):
+    """
+    Print the latest runs and the achieved upload throughput per bandwidth window
+    (used by `enacrestic history`)
+    """
+    history = RunHistory()
+    for run in reversed(history.get_runs(limit=nb_runs)):
+        line = (
+            f"{utc_to_local_str(run['start_utc_dt'])}  {run['operation']:<14}"
+            f"{run['seconds']:>10.1f} s  {run['status']}"
+        )
+        if run.get("bytes_uploaded") is not None:
+            line += f", {bytes_to_human(run['bytes_uploaded'])} uploaded"
+        if run.get("estimated_bytes") is not None:
+            line += f", {bytes_to_human(run['estimated_bytes'])} estimated"
+            if run.get("data_added") is not None:
+                line += f" ({bytes_to_human(run['data_added'])} added)"
+        if run.get("bytes_restored") is not None:
+            line += f", {bytes_to_human(run['bytes_restored'])} restored"
+        if run.get("peak_rss_bytes") is not None:
+            line += (
+                f", CPU {run['cpu_user_seconds'] + run['cpu_system_seconds']:.1f} s"
+                f", peak RSS {bytes_to_human(run['peak_rss_bytes'])}"
+            )
+        if run.get("deferred_seconds") is not None:
+            line += (
+                f", deferred {run['deferred_seconds'] / 60:.0f} min"
+                f" ({run['deferred_reason']})"
+            )
+        print(line)
+
+    per_window = history.throughput_per_window(
+        (Operation.BACKUP, Operation.STREAM_BACKUP, Operation.GROUP_BACKUP)
+    )
+    if len(per_window) > 0:
+        print("\nAverage upload throughput per bandwidth window:")
+        for window, (nb_runs, throughput) in sorted(per_window.items()):
+            print(f"  {window}: {bytes_to_human(throughput)}/s ({nb_runs} runs)")
@@ -0,0 +1,145 @@
+"""
+Inspects the locks of the restic repository
+to know which ones are stale, from restic's lock metadata :
+
++ `restic list locks` to get the lock ids
++ `restic cat lock <id>` to get hostname, PID and creation time of each
+"""
+
+import datetime
+import json
+import os
+import re
+import socket
+from enum import Enum
+
+from enacrestic import const
+from enacrestic.utils import parse_restic_time
+
+
+class LockVerdict(Enum):
+    """
+    Enumerate all verdicts about a lock
+    """
+
+    ALIVE = "held by a running restic process"
+    TOO_NEW = "created on another host, too recently to be considered stale"
+    PROCESS_DEAD = "its process is not running anymore"
+    PID_REUSED = "its PID is now used by another program"
+    TOO_OLD = "created on another host, too long ago to still be held"
+
+
+STALE_LOCK_VERDICTS = (
+    LockVerdict.PROCESS_DEAD,
+    LockVerdict.PID_REUSED,
+    LockVerdict.TOO_OLD,
+)
+
+
+def pid_is_restic(pid):
+    """
+    return True if pid is a running restic process on this host
+    """
+    try:
+        with open(f"/proc/{pid}/comm", "r") as f:
+            return f.read().strip() == "restic"
+    except (FileNotFoundError, ProcessLookupError):
+        return False
+    except PermissionError:
+        # Not ours to judge, consider it is still running
+        return True
+
+
+def judge_lock(lock, now_utc_dt):
+    """
+    return the LockVerdict of a lock (as read from `restic cat lock`)
+    + same host : stale as soon as its process is gone
+    + other hosts : stale only when older than LOCK_STALE_AFTER_N_MINUTES
+    """
+    if lock.get("hostname") == socket.gethostname():
+        if not os.path.exists(f"/proc/{lock.get('pid')}"):
+            return LockVerdict.PROCESS_DEAD
+        if not pid_is_restic(lock.get("pid")):
+            return LockVerdict.PID_REUSED
+        return LockVerdict.ALIVE
+
+    age = now_utc_dt - parse_restic_time(lock["time"])
+    if age > datetime.timedelta(minutes=const.LOCK_STALE_AFTER_N_MINUTES):
+        return LockVerdict.TOO_OLD
+    return LockVerdict.TOO_NEW
+
+
+class LockInspector:
+    """
+    List the repository locks and judge each of them.
+    Runs asynchronously, calling back with the list of locks
+    (dict as given by restic + "id" + "verdict")
+    or None if the locks could not be read.
+    """
+
+    def __init__(self, app, env):
+        self.app = app
+        self.env = env
+        self.p = None
+        self.callback = None
+
+    def inspect(self, callback):
+        self.callback = callback
+        self.locks = []
+        self.lock_ids = []
+        self.unreadable_lock = False
+        self._run(["list", "locks"], self._locks_listed)
+
+    def _run(self, args, on_finished):
+        self.p = self.app.engine.process()
+        self.p.on_finished = on_finished
+        self.p.on_failed_to_start = lambda message: self._failed_to_start(
+            message, on_finished
+        )
+        self.p.start(
+            "restic",
+            args
+            + [
+                "--no-lock",
+                "--password-file",
+                const.RESTIC_USER_PREFS["PASSWORDFILE"],
+            ],
+            self.env,
+        )
+
+    def _failed_to_start(self, message, on_finished):
+        self.app.logger.error(f"Failed to start: {message}")
+        on_finished()
+
+    def _locks_listed(self):
+        if not self.p.succeeded():
+            stderr = self.p.read_all_stderr().decode("utf8")
+            self.app.logger.error(stderr)
+            self.p = None
+            self.callback(None)
+            return
+        stdout = self.p.read_all_stdout().decode("utf8")
+        self.lock_ids = re.findall(r"^[0-9a-f]{64}$", stdout, re.MULTILINE)
+        self._cat_next_lock()
+
+    def _cat_next_lock(self):
+        if len(self.lock_ids) == 0:
+            self.p = None
+            # Can't judge the repo's locks if one of them is unknown
+            self.callback(None if self.unreadable_lock else self.locks)
+            return
+        self._run(["cat", "lock", self.lock_ids[0]], self._lock_read)
+
+    def _lock_read(self):
+        lock_id = self.lock_ids.pop(0)
+        # The lock may have been released in the meantime
+        if self.p.succeeded():
+            try:
+                lock = json.loads(self.p.read_all_stdout().decode("utf8"))
+                lock["id"] = lock_id
+                lock["verdict"] = judge_lock(lock, datetime.datetime.utcnow())
+                self.locks.append(lock)
+            except (json.decoder.JSONDecodeError, KeyError, ValueError):
+                self.app.logger.error(f"Could not read lock {lock_id[:8]}")
+                self.unreadable_lock = True
+        self._cat_next_lock()
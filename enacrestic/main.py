@@ -1,8 +1,9 @@
 #!/usr/bin/env python3
 
 import argparse
+import sys
 
-from enacrestic import __version__, app
+from enacrestic import __version__, const
 
 
 def main():
@@ -18,9 +19,210 @@ def main():
         default=True,
         help="disable GUI integration (system tray ++)",
     )
+    parser.add_argument(
+        "--run-once",
+        action="store_true",
+        help="run the backup queue once and quit (used by the system daemon)",
+    )
+    subparsers = parser.add_subparsers(dest="command")
+
+    parser_daemon = subparsers.add_parser(
+        "daemon",
+        help="run as root, scheduling the backups of every user of the server",
+    )
+    parser_daemon.add_argument(
+        "--max-concurrent-jobs",
+        type=int,
+        default=const.DEF_DAEMON_MAX_CONCURRENT_JOBS,
+        help="maximum number of users being backed up at the same time "
+        f"(default: {const.DEF_DAEMON_MAX_CONCURRENT_JOBS})",
+    )
+    parser_daemon.add_argument(
+        "--min-uid",
+        type=int,
+        default=const.DEF_DAEMON_MIN_UID,
+        help=f"ignore users below this UID (default: {const.DEF_DAEMON_MIN_UID})",
+    )
+
+    parser_history = subparsers.add_parser(
+        "history", help="show the latest operations and achieved throughput"
+    )
+    parser_history.add_argument(
+        "-n",
+        dest="nb_runs",
+        type=int,
+        default=20,
+        help="number of operations to show (default: 20)",
+    )
+
+    parser_snapshots = subparsers.add_parser(
+        "snapshots", help="list the latest snapshots from the local catalog"
+    )
+    parser_snapshots.add_argument(
+        "-n",
+        dest="nb_snapshots",
+        type=int,
+        default=20,
+        help="number of snapshots to show (default: 20)",
+    )
+    parser_snapshots.add_argument("--host", help="only show snapshots of this host")
+    parser_snapshots.add_argument(
+        "--refresh",
+        action="store_true",
+        help="sync the catalog with the repository first (needs network)",
+    )
+    parser_snapshots.add_argument("--json", action="store_true", help="output as JSON")
+
+    parser_find = subparsers.add_parser(
+        "find", help="find in which snapshots files are, from the file index"
+    )
+    parser_find.add_argument(
+        "pattern",
+        help="file name (e.g. 'thesis*.docx') or path pattern (with a '/')",
+    )
+    parser_find.add_argument(
+        "-n",
+        dest="nb_versions",
+        type=int,
+        default=100,
+        help="maximum number of file versions to show (default: 100)",
+    )
+    parser_find.add_argument("--json", action="store_true", help="output as JSON")
+
+    parser_benchmark = subparsers.add_parser(
+        "benchmark",
+        help="find the best compression and pack size for this machine",
+    )
+    parser_benchmark.add_argument(
+        "--sample-mib",
+        type=int,
+        default=const.DEF_BENCHMARK_SAMPLE_MIB,
+        help="size of the sample of bkp_include to back up "
+        f"(default: {const.DEF_BENCHMARK_SAMPLE_MIB})",
+    )
+    parser_benchmark.add_argument(
+        "--uplink-mbps",
+        type=float,
+        help="uplink speed in Mbit/s (default: estimated from past backups)",
+    )
+    parser_benchmark.add_argument(
+        "--scratch-dir",
+        help="where to create the scratch repository (default: temp folder)",
+    )
+    parser_benchmark.add_argument(
+        "--read-concurrency",
+        action="store_true",
+        help="benchmark how many files to read at once on the storage "
+        "of --scratch-dir (default: ~/.enacrestic) instead",
+    )
+    parser_benchmark.add_argument(
+        "--tree-mib",
+        type=int,
+        default=const.DEF_BENCHMARK_TREE_MIB,
+        help="size of the tree of files generated for --read-concurrency "
+        f"(default: {const.DEF_BENCHMARK_TREE_MIB})",
+    )
+    parser_benchmark.add_argument(
+        "--save",
+        action="store_true",
+        help="use the recommended settings for the next backups",
+    )
+
+    parser_restore = subparsers.add_parser(
+        "restore",
+        help="restore a snapshot, pausing scheduled backups meanwhile",
+    )
+    parser_restore.add_argument(
+        "snapshot",
+        nargs="?",
+        default="latest",
+        help="snapshot ID to restore (default: latest)",
+    )
+    parser_restore.add_argument(
+        "-t", "--target", required=True, help="directory to restore to"
+    )
+    parser_restore.add_argument(
+        "--path",
+        dest="paths",
+        action="append",
+        default=[],
+        help="with latest, only consider snapshots including this path",
+    )
+    parser_restore.add_argument(
+        "--host", help="with latest, only consider snapshots of this host"
+    )
+    parser_restore.add_argument(
+        "-i",
+        "--include",
+        dest="includes",
+        action="append",
+        default=[],
+        help="only restore files matching this pattern",
+    )
+    parser_restore.add_argument(
+        "-e",
+        "--exclude",
+        dest="excludes",
+        action="append",
+        default=[],
+        help="don't restore files matching this pattern",
+    )
+    parser_restore.add_argument(
+        "--find",
+        metavar="PATTERN",
+        help="restore the files matching PATTERN in the file index, "
+        "from the latest snapshot holding one",
+    )
+    parser_restore.add_argument(
+        "--sparse", action="store_true", help="restore files as sparse files"
+    )
+    parser_restore.add_argument(
+        "--verify", action="store_true", help="verify restored files content"
+    )
+    parser_restore.add_argument(
+        "--json",
+        action="store_true",
+        help="output progress as JSON lines (with throughput and ETA)",
+    )
     args = parser.parse_args()
 
-    app.App(gui_enabled=args.gui)
+    if args.command == "daemon":
+        from enacrestic import daemon
+
+        daemon.Daemon(
+            max_concurrent_jobs=args.max_concurrent_jobs, min_uid=args.min_uid
+        )
+    elif args.command == "history":
+        from enacrestic import history
+
+        history.print_history(args.nb_runs)
+    elif args.command == "snapshots":
+        from enacrestic import catalog
+
+        catalog.print_snapshots(
+            args.nb_snapshots,
+            hostname=args.host,
+            refresh=args.refresh,
+            as_json=args.json,
+        )
+    elif args.command == "find":
+        from enacrestic import file_index
+
+        sys.exit(file_index.print_find(args.pattern, args.nb_versions, args.json))
+    elif args.command == "benchmark":
+        from enacrestic import benchmark
+
+        if args.read_concurrency:
+            sys.exit(benchmark.ReadConcurrencyBenchmark(args).run())
+        sys.exit(benchmark.Benchmark(args).run())
+    elif args.command == "restore":
+        from enacrestic import restore
+
+        sys.exit(restore.Restore(args).run())
+    else:
+        from enacrestic import app
+
+        app.App(gui_enabled=args.gui and not args.run_once, run_once=args.run_once)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,66 @@
+"""
+Exports metrics in the Prometheus text format, to a file
+to be collected by node_exporter's textfile collector.
+(by default ~/.enacrestic/metrics.prom, see "metrics_file" in prefs.json)
+"""
+
+import os
+
+
+def _format_value(value):
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    return repr(float(value))
+
+
+def _format_labels(labels):
+    if len(labels) == 0:
+        return ""
+    pairs = ",".join(
+        '%s="%s"' % (key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for key, value in labels
+    )
+    return "{" + pairs + "}"
+
+
+class Metrics:
+    """
+    Gauges, written to the metrics file as a whole each time they change
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # name -> (help, {labels: value})
+        self.gauges = {}
+
+    def set(self, name, value, help_text, **labels):
+        """
+        Set gauge enacrestic_<name> (with labels) to value
+        None removes it
+        """
+        name = f"enacrestic_{name}"
+        samples = self.gauges.setdefault(name, (help_text, {}))[1]
+        key = tuple(sorted(labels.items()))
+        if value is None:
+            samples.pop(key, None)
+        else:
+            samples[key] = value
+
+    def write(self):
+        """
+        Write the metrics file atomically (the collector never reads half of it)
+        """
+        if not self.path:
+            return
+        lines = []
+        for name, (help_text, samples) in sorted(self.gauges.items()):
+            if len(samples) == 0:
+                continue
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in sorted(samples.items()):
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, self.path)
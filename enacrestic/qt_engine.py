@@ -0,0 +1,176 @@
+"""
+Engine (see engine.py) running on Qt's event loop, used by the GUI
+"""
+
+import signal
+import socket
+import threading
+
+from PyQt5.QtCore import (
+    QObject,
+    QProcess,
+    QProcessEnvironment,
+    QTimer,
+    pyqtSignal,
+    pyqtSlot,
+)
+from PyQt5.QtNetwork import QAbstractSocket
+
+from enacrestic.engine import Process, Timer
+
+try:
+    from PyQt5.QtDBus import QDBusConnection
+except ImportError:
+    QDBusConnection = None
+
+
+class SignalWatchdog(QAbstractSocket):
+    """
+    Watchdog to propagates system signals from Python to QEventLoop
+    https://stackoverflow.com/a/65802260/446302
+    This is necessary to handle SIGINT signals
+    """
+
+    def __init__(self):
+        super().__init__(QAbstractSocket.SctpSocket, None)
+        self.writer, self.reader = socket.socketpair()
+        self.writer.setblocking(False)
+        signal.set_wakeup_fd(self.writer.fileno())  # Python hook
+        self.setSocketDescriptor(self.reader.fileno())  # Qt hook
+        self.readyRead.connect(lambda: None)  # Dummy function call
+
+
+class SleepWatcher(QObject):
+    """
+    Calls back when the system resumes from suspend,
+    as announced by logind's PrepareForSleep signal (if available)
+    """
+
+    def __init__(self, on_resume):
+        super().__init__()
+        self.on_resume = on_resume
+        self.connected = False
+        if QDBusConnection is None:
+            return
+        self.connected = QDBusConnection.systemBus().connect(
+            "org.freedesktop.login1",
+            "/org/freedesktop/login1",
+            "org.freedesktop.login1.Manager",
+            "PrepareForSleep",
+            self.prepare_for_sleep,
+        )
+
+    @pyqtSlot(bool)
+    def prepare_for_sleep(self, going_to_sleep):
+        if not going_to_sleep:
+            self.on_resume()
+
+
+class ThreadResult(QObject):
+    """
+    Carries the result of a thread to Qt's event loop
+    (emitted from the thread, received in the main one)
+    """
+
+    done = pyqtSignal(object)
+
+
+class QtTimer(Timer):
+    def __init__(self, callback, single_shot=False):
+        super().__init__(callback, single_shot)
+        self.timer = QTimer()
+        self.timer.setSingleShot(single_shot)
+        self.timer.timeout.connect(callback)
+
+    def start(self, msec):
+        self.timer.start(msec)
+
+    def stop(self):
+        self.timer.stop()
+
+    def is_active(self):
+        return self.timer.isActive()
+
+
+class QtProcess(Process):
+    def __init__(self):
+        super().__init__()
+        self.p = QProcess()
+        self.p.readyReadStandardOutput.connect(
+            lambda: self._received_stdout(bytes(self.p.readAllStandardOutput()))
+        )
+        self.p.readyReadStandardError.connect(
+            lambda: self._received_stderr(bytes(self.p.readAllStandardError()))
+        )
+        self.p.started.connect(lambda: self._started(self.p.processId()))
+        self.p.errorOccurred.connect(self._error_occurred)
+        self.p.finished.connect(self._process_finished)
+
+    def pipe_to(self, process):
+        self.p.setStandardOutputProcess(process.p)
+
+    def start(self, cmd, args, env=None, cwd=None):
+        if cwd is not None:
+            self.p.setWorkingDirectory(cwd)
+        if env is not None:
+            process_env = QProcessEnvironment()
+            for key, value in env.items():
+                process_env.insert(key, value)
+            self.p.setProcessEnvironment(process_env)
+        self.running = True
+        self.p.start(cmd, args)
+        # Known right away on Unix, signals can be sent before "started"
+        if self.p.processId() > 0:
+            self.pid = self.p.processId()
+
+    def _error_occurred(self, error):
+        if error == QProcess.FailedToStart:
+            self._failed_to_start(self.p.errorString())
+
+    def _process_finished(self):
+        self._finished(self.p.exitCode(), self.p.exitStatus() != QProcess.NormalExit)
+
+
+class QtEngine:
+    def __init__(self, qt_app):
+        self.qt_app = qt_app
+        self.signal_watchdog = None
+        self.sleep_watcher = None
+        # Kept referenced until their thread is done
+        self.thread_results = set()
+
+    def timer(self, callback, single_shot=False):
+        return QtTimer(callback, single_shot)
+
+    def single_shot(self, msec, callback):
+        QTimer.singleShot(msec, callback)
+
+    def process(self):
+        return QtProcess()
+
+    def add_signal_handler(self, signum, callback):
+        signal.signal(signum, lambda signum, frame: callback())
+        if self.signal_watchdog is None:
+            self.signal_watchdog = SignalWatchdog()
+
+    def watch_resume(self, callback):
+        self.sleep_watcher = SleepWatcher(callback)
+        return self.sleep_watcher.connected
+
+    def run_in_thread(self, function, on_done):
+        thread_result = ThreadResult()
+        thread_result.done.connect(on_done)
+        thread_result.done.connect(
+            lambda result: self.thread_results.discard(thread_result)
+        )
+        self.thread_results.add(thread_result)
+        # Daemon thread : never delays the exit
+        threading.Thread(
+            target=lambda: thread_result.done.emit(function()), daemon=True
+        ).start()
+
+    def exec(self):
+        return self.qt_app.exec_()
+
+    def quit(self, exit_code=0):
+        self.qt_app.exit(exit_code)
@@ -0,0 +1,73 @@
+"""
+Check for the latest release of ENACrestic, without ever blocking the app :
+
++ run in a thread (see engine.run_in_thread), the app gives up waiting
+  after RELEASE_CHECK_TIMEOUT_SECONDS (e.g. DNS resolution hanging)
++ the download itself is bounded in time and size
++ conditional request, with the ETag / Last-Modified of the previous answer :
+  as long as no new release is published, the server answers
+  "304 Not Modified" without a body
++ only info.version of the answer is kept
+
+The URL is "release_check_url" in prefs.json (PyPI's JSON API by default),
+any server answering {"info": {"version": "x.y.z"}} will do.
+"""
+
+import json
+import time
+
+import requests
+
+from enacrestic import const
+
+READ_CHUNK_SIZE = 65536
+
+
+def fetch_latest_version(url, cache, timeout=const.RELEASE_CHECK_TIMEOUT_SECONDS):
+    """
+    return (latest version, cache for the next request)
+    cache : {"etag": ..., "last_modified": ..., "version": ...}
+    from the previous answer ({} if none)
+
+    raise requests.exceptions.RequestException or ValueError (bad answer)
+    """
+    headers = {}
+    if cache.get("version") is not None:
+        if cache.get("etag"):
+            headers["If-None-Match"] = cache["etag"]
+        if cache.get("last_modified"):
+            headers["If-Modified-Since"] = cache["last_modified"]
+    deadline = time.monotonic() + timeout
+    with requests.get(url, headers=headers, timeout=timeout, stream=True) as response:
+        if response.status_code == 304:
+            return cache["version"], cache
+        response.raise_for_status()
+        # requests' timeout is per read : bound the whole download
+        body = bytearray()
+        for chunk in response.iter_content(READ_CHUNK_SIZE):
+            body += chunk
+            if time.monotonic() > deadline:
+                raise requests.exceptions.Timeout(f"No answer within {timeout} s")
+            if len(body) > const.RELEASE_CHECK_MAX_BYTES:
+                raise ValueError("Answer too large")
+        try:
+            version = json.loads(body)["info"]["version"]
+        except (KeyError, TypeError) as e:
+            raise ValueError(f"No info.version in the answer ({e})")
+        return str(version), {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "version": str(version),
+        }
+
+
+def check_latest_version(url, cache):
+    """
+    Same as fetch_latest_version, never raising (to be run in a thread)
+    return {"version": ..., "cache": ..., "error": message or None}
+    """
+    try:
+        version, cache = fetch_latest_version(url, cache)
+    except (requests.exceptions.RequestException, ValueError) as e:
+        return {"version": None, "cache": cache, "error": str(e)}
+    return {"version": version, "cache": cache, "error": None}
@@ -0,0 +1,171 @@
+"""
+Analysis of the repository size measured over time
+(see RunHistory.add_repo_stats) :
+
++ growth rate (least squares over the last STATS_GROWTH_WINDOW_DAYS)
++ dedup ratio (data backed up by the snapshots vs data stored)
++ space freed by the prunes (size measured around each)
++ when the quota (if any) will be reached at this growth rate
+"""
+
+import datetime
+
+from enacrestic import const
+from enacrestic.utils import bytes_to_human, utc_to_local_str
+
+GIB = 1024**3
+
+
+def growth_per_day(stats):
+    """
+    return the growth rate (bytes/day) of total_size over stats,
+    None if not enough data
+    """
+    if len(stats) < 2:
+        return None
+    origin = stats[0]["time_utc_dt"]
+    days = [(s["time_utc_dt"] - origin).total_seconds() / 86400 for s in stats]
+    if days[-1] < const.STATS_MIN_GROWTH_SPAN_HOURS / 24:
+        return None
+    sizes = [s["total_size"] for s in stats]
+    mean_days = sum(days) / len(days)
+    mean_size = sum(sizes) / len(sizes)
+    variance = sum((d - mean_days) ** 2 for d in days)
+    covariance = sum((d - mean_days) * (s - mean_size) for d, s in zip(days, sizes))
+    return covariance / variance
+
+
+def prune_effects(stats):
+    """
+    return [(time of prune, bytes freed)] from the sizes measured
+    just after each prune and the previous one
+    (measured just before the prune, unless a recent one was there already)
+    """
+    effects = []
+    for before, after in zip(stats, stats[1:]):
+        if after["context"] == "after_prune":
+            effects.append(
+                (after["time_utc_dt"], before["total_size"] - after["total_size"])
+            )
+    return effects
+
+
+def analyze(history, catalog, quota_gib=None, now_utc_dt=None):
+    """
+    return the analysis of the repository size (dict), None if never measured
+    """
+    if now_utc_dt is None:
+        now_utc_dt = datetime.datetime.utcnow()
+    stats = history.get_repo_stats(
+        now_utc_dt - datetime.timedelta(days=const.STATS_GROWTH_WINDOW_DAYS)
+    )
+    if len(stats) == 0:
+        return None
+    latest = stats[-1]
+    analysis = {
+        "time_utc_dt": latest["time_utc_dt"],
+        "total_size": latest["total_size"],
+        "total_uncompressed_size": latest["total_uncompressed_size"],
+        "snapshots_count": latest["snapshots_count"],
+        "growth_per_day": growth_per_day(stats),
+        "dedup_ratio": None,
+        "last_prune_freed": None,
+        "quota": None if quota_gib is None else quota_gib * GIB,
+        "quota_reached_utc_dt": None,
+    }
+
+    # Data the snapshots hold vs data stored
+    # (only snapshots whose size is known in the catalog)
+    stored_size = latest["total_uncompressed_size"] or latest["total_size"]
+    backed_up_size = catalog.total_bytes_processed()
+    if stored_size > 0 and backed_up_size > 0:
+        analysis["dedup_ratio"] = backed_up_size / stored_size
+
+    effects = prune_effects(stats)
+    if len(effects) > 0:
+        analysis["last_prune_freed"] = effects[-1][1]
+
+    growth = analysis["growth_per_day"]
+    if analysis["quota"] is not None and growth is not None and growth > 0:
+        days_left = max(analysis["quota"] - latest["total_size"], 0) / growth
+        # Beyond that, it's not a forecast anymore
+        if days_left < 3650:
+            analysis["quota_reached_utc_dt"] = latest[
+                "time_utc_dt"
+            ] + datetime.timedelta(days=days_left)
+    return analysis
+
+
+def analysis_to_str(analysis):
+    """
+    return a few lines describing the repository size for the user
+    """
+    if analysis is None:
+        return "Repository size not measured yet"
+    msg = f"Repository: {bytes_to_human(analysis['total_size'])}"
+    if analysis["growth_per_day"] is not None:
+        msg += f" ({'+' if analysis['growth_per_day'] >= 0 else '-'}"
+        msg += f"{bytes_to_human(abs(analysis['growth_per_day']))}/day)"
+    if analysis["dedup_ratio"] is not None:
+        msg += f", dedup ratio {analysis['dedup_ratio']:.2f}"
+    if analysis["last_prune_freed"] is not None:
+        msg += f"\nlast prune freed {bytes_to_human(analysis['last_prune_freed'])}"
+    if analysis["quota"] is not None:
+        msg += f"\nquota {bytes_to_human(analysis['quota'])}"
+        if analysis["total_size"] >= analysis["quota"]:
+            msg += " exceeded!"
+        elif analysis["quota_reached_utc_dt"] is not None:
+            msg += f" reached around {utc_to_local_str(analysis['quota_reached_utc_dt'])[:10]}"
+        else:
+            msg += " not reached at this rate"
+    return msg
+
+
+def publish_metrics(metrics, analysis):
+    """
+    Export the analysis as metrics
+    """
+    if analysis is None:
+        return
+
+    def _timestamp(utc_dt):
+        if utc_dt is None:
+            return None
+        return (utc_dt - datetime.datetime(1970, 1, 1)).total_seconds()
+
+    metrics.set("repo_size_bytes", analysis["total_size"], "Size of the repository")
+    metrics.set(
+        "repo_uncompressed_size_bytes",
+        analysis["total_uncompressed_size"],
+        "Size of the data stored in the repository, before compression",
+    )
+    metrics.set(
+        "repo_snapshots", analysis["snapshots_count"], "Snapshots in the repository"
+    )
+    metrics.set(
+        "repo_size_timestamp_seconds",
+        _timestamp(analysis["time_utc_dt"]),
+        "When the repository size was measured",
+    )
+    metrics.set(
+        "repo_growth_bytes_per_day",
+        analysis["growth_per_day"],
+        "Growth rate of the repository",
+    )
+    metrics.set(
+        "repo_dedup_ratio",
+        analysis["dedup_ratio"],
+        "Data backed up by the snapshots / data stored",
+    )
+    metrics.set(
+        "repo_last_prune_freed_bytes",
+        analysis["last_prune_freed"],
+        "Space freed by the last prune",
+    )
+    metrics.set("repo_quota_bytes", analysis["quota"], "Quota of the repository")
+    metrics.set(
+        "repo_quota_reached_timestamp_seconds",
+        _timestamp(analysis["quota_reached_utc_dt"]),
+        "When the quota will be reached at the current growth rate",
+    )
+    metrics.write()
@@ -0,0 +1,147 @@
+"""
+Resources used by a child process (restic, pre-backup hook),
+sampled from /proc/<pid> while it runs : the event loop (Qt or asyncio)
+reaps it, so its wait4() rusage never reaches us.
+
++ CPU time (user / system), of all its threads and of its waited-for children
++ peak RSS (VmHWM, a high-water mark, so exact up to the last sample)
++ bytes read from / written to storage
++ context switches (voluntary / involuntary), summed over all its threads
+
+CPU, IO and context switches done after the last sample are missed,
+at most RESOURCE_SAMPLE_EVERY_N_SECONDS worth of them.
+"""
+
+import os
+
+from enacrestic.utils import bytes_to_human
+
+PROC_FOLDER = "/proc"
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+
+def _read(path):
+    try:
+        with open(path, "r") as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def _fields(text):
+    """
+    return {key: first word of value} of a /proc "Key: value" file
+    """
+    fields = {}
+    for line in text.splitlines():
+        key, _, value = line.partition(":")
+        if value.strip() != "":
+            fields[key.strip()] = value.split()[0]
+    return fields
+
+
+def sample_usage(pid, proc_folder=PROC_FOLDER):
+    """
+    return the resources used so far by process pid, None if it's gone
+    """
+    folder = os.path.join(proc_folder, str(pid))
+    stat = _read(os.path.join(folder, "stat"))
+    status = _read(os.path.join(folder, "status"))
+    if stat is None or status is None:
+        return None
+    # comm (2nd field) may contain spaces, fields after it are fixed.
+    # utime + cutime : children it waited for count (e.g. commands of a hook)
+    stat_fields = stat.rpartition(")")[2].split()
+    usage = {
+        "cpu_user_seconds": (int(stat_fields[11]) + int(stat_fields[13])) / CLOCK_TICKS,
+        "cpu_system_seconds": (int(stat_fields[12]) + int(stat_fields[14]))
+        / CLOCK_TICKS,
+    }
+    status_fields = _fields(status)
+    if "VmHWM" in status_fields:
+        usage["peak_rss_bytes"] = int(status_fields["VmHWM"]) * 1024
+
+    # Not readable for processes of other users
+    io = _read(os.path.join(folder, "io"))
+    if io is not None:
+        io_fields = _fields(io)
+        usage["read_bytes"] = int(io_fields.get("read_bytes", 0))
+        usage["write_bytes"] = int(io_fields.get("write_bytes", 0))
+
+    # restic is a Go program : most of the work is done by other threads
+    voluntary = involuntary = 0
+    try:
+        tasks = os.listdir(os.path.join(folder, "task"))
+    except OSError:
+        tasks = []
+    for task in tasks:
+        task_status = _read(os.path.join(folder, "task", task, "status"))
+        if task_status is None:
+            continue  # thread exited meanwhile
+        task_fields = _fields(task_status)
+        voluntary += int(task_fields.get("voluntary_ctxt_switches", 0))
+        involuntary += int(task_fields.get("nonvoluntary_ctxt_switches", 0))
+    usage["voluntary_ctxt_switches"] = voluntary
+    usage["involuntary_ctxt_switches"] = involuntary
+    return usage
+
+
+def usage_to_str(usage):
+    """
+    return the resources used as a one-line message
+    """
+    msg = (
+        f"CPU {usage['cpu_user_seconds']:.1f} s user "
+        f"+ {usage['cpu_system_seconds']:.1f} s system"
+    )
+    if usage.get("peak_rss_bytes") is not None:
+        msg += f", peak RSS {bytes_to_human(usage['peak_rss_bytes'])}"
+    if usage.get("read_bytes") is not None:
+        msg += (
+            f", read {bytes_to_human(usage['read_bytes'])}"
+            f", written {bytes_to_human(usage['write_bytes'])}"
+        )
+    msg += (
+        f", {usage['voluntary_ctxt_switches']}"
+        f" + {usage['involuntary_ctxt_switches']} (involuntary) context switches"
+    )
+    return msg
+
+
+def publish_usage_metrics(metrics, operation, usage):
+    """
+    Export the resources used by the last run of operation
+    """
+    metrics.set(
+        "last_run_cpu_seconds",
+        usage["cpu_user_seconds"],
+        "CPU time used by the last run",
+        operation=operation.value,
+        mode="user",
+    )
+    metrics.set(
+        "last_run_cpu_seconds",
+        usage["cpu_system_seconds"],
+        "CPU time used by the last run",
+        operation=operation.value,
+        mode="system",
+    )
+    metrics.set(
+        "last_run_peak_rss_bytes",
+        usage.get("peak_rss_bytes"),
+        "Peak resident memory of the last run",
+        operation=operation.value,
+    )
+    metrics.set(
+        "last_run_read_bytes",
+        usage.get("read_bytes"),
+        "Bytes read from storage by the last run",
+        operation=operation.value,
+    )
+    metrics.set(
+        "last_run_write_bytes",
+        usage.get("write_bytes"),
+        "Bytes written to storage by the last run",
+        operation=operation.value,
+    )
+    metrics.write()
@@ -1,16 +1,44 @@
 """
 Manages the execution of restic command
 """
+import codecs
 import datetime
+import json
 import os
 import re
+import shutil
 import signal
+import socket
+import time
 from enum import Enum
 
-from PyQt5.QtCore import QProcess, QProcessEnvironment
+from pidfile import PIDFile
 
 from enacrestic import const
-from enacrestic.state import CurrentOperation, Operation, Status
+from enacrestic.connections import backend_of, choose_connections, network_key
+from enacrestic.events import EventType
+from enacrestic.gating import check_conditions, deferral_reason, publish_gating_metrics
+from enacrestic.lock_inspector import STALE_LOCK_VERDICTS, LockInspector, LockVerdict
+from enacrestic.repo_stats import analysis_to_str, analyze, publish_metrics
+from enacrestic.resources import publish_usage_metrics, sample_usage, usage_to_str
+from enacrestic.state import (
+    CurrentOperation,
+    Operation,
+    Status,
+    get_path_group,
+    get_staging_repository,
+)
+from enacrestic.storage import choose_read_concurrency, classify_paths
+from enacrestic.time_windows import next_change, window_name
+from enacrestic.utils import (
+    bytes_to_human,
+    dir_size,
+    files_from_paths,
+    load_restic_env,
+    parse_restic_time,
+    utc_to_local,
+    utc_to_local_str,
+)
 
 
 class ResticCompletionStatus(Enum):
@@ -24,24 +52,296 @@ class ResticCompletionStatus(Enum):
     REPO_NOT_INITIALIZED = "repository not initialized"
 
 
+# restic's errors when the repository can't be reached (network down, offline)
+NO_NETWORK_ERRORS = re.compile(
+    r"timeout|no such host|network is unreachable|no route to host"
+    r"|temporary failure in name resolution|connection refused",
+    re.IGNORECASE,
+)
+
+
+def _more_restrictive(profile, than_profile):
+    """
+    Answer if bandwidth profile limits more upload or download than another
+    (None or no limit meaning unlimited)
+    """
+
+    def _limit(profile, key):
+        if profile is None or profile.get(key) is None:
+            return float("inf")
+        return profile[key]
+
+    return any(
+        _limit(profile, key) < _limit(than_profile, key)
+        for key in ("limit_upload", "limit_download")
+    )
+
+
+def _no_budget(profile, keys=("limit_upload",)):
+    """
+    Answer if bandwidth profile forbids any upload (or any of keys)
+    """
+    return profile is not None and any(profile.get(key) == 0 for key in keys)
+
+
+# restic's variables telling which repository to use and how to open it
+REPOSITORY_ENV_VARS = (
+    "RESTIC_REPOSITORY",
+    "RESTIC_REPOSITORY_FILE",
+    "RESTIC_PASSWORD",
+    "RESTIC_PASSWORD_FILE",
+    "RESTIC_PASSWORD_COMMAND",
+    "RESTIC_KEY_HINT",
+)
+
+
+def _without_repository(env):
+    """
+    return env without its repository variables,
+    before another repository's ones are set
+    """
+    return {key: value for key, value in env.items() if key not in REPOSITORY_ENV_VARS}
+
+
+def _source_repository(env):
+    """
+    return the RESTIC_FROM_* variables making the repository of env
+    the source of `restic copy` or `restic init --copy-chunker-params`.
+    Its password is the one of --password-file, unless a command gives it
+    """
+    from_env = {
+        f"RESTIC_FROM_{key[len('RESTIC_'):]}": env[key]
+        for key in (
+            "RESTIC_REPOSITORY",
+            "RESTIC_REPOSITORY_FILE",
+            "RESTIC_PASSWORD_COMMAND",
+            "RESTIC_KEY_HINT",
+        )
+        if key in env
+    }
+    if "RESTIC_FROM_PASSWORD_COMMAND" not in from_env:
+        from_env["RESTIC_FROM_PASSWORD_FILE"] = const.RESTIC_USER_PREFS["PASSWORDFILE"]
+    return from_env
+
+
+# Operations whose output shows their progress,
+# the other ones can be silent for long
+PROGRESS_REPORTING_OPERATIONS = (
+    Operation.ESTIMATE,
+    Operation.BACKUP,
+    Operation.STREAM_BACKUP,
+    Operation.GROUP_BACKUP,
+    Operation.STAGE_BACKUP,
+    Operation.INDEX_FILES,
+)
+
+# Operations whose restic process scans files before reading them
+SCANNING_OPERATIONS = (
+    Operation.ESTIMATE,
+    Operation.BACKUP,
+    Operation.GROUP_BACKUP,
+    Operation.STAGE_BACKUP,
+)
+
+# Operations on the local staging repository only : no bandwidth limit
+LOCAL_OPERATIONS = (
+    Operation.INIT_STAGING,
+    Operation.STAGE_BACKUP,
+    Operation.PRUNE_STAGING,
+)
+
+# Operations uploading to the repository, with the tuned backend connections
+CONNECTIONS_TUNED_OPERATIONS = (
+    Operation.BACKUP,
+    Operation.STREAM_BACKUP,
+    Operation.GROUP_BACKUP,
+    Operation.UPLOAD_STAGED,
+    Operation.FORGET,
+)
+
+# Signals sent to a process to stop (stalled or quitting), one after the other
+STOP_SIGNALS = (signal.SIGINT, signal.SIGTERM, signal.SIGKILL)
+# When they are sent on shutdown, as a fraction of the deadline
+SHUTDOWN_SIGNALS_AT = (0, 2 / 3, 1)
+
+# Operations retried first on next launch when interrupted by a shutdown
+# (the other ones only run as a prerequisite of those)
+RETRIED_AFTER_SHUTDOWN_OPERATIONS = (
+    Operation.BACKUP,
+    Operation.STREAM_BACKUP,
+    Operation.GROUP_BACKUP,
+    Operation.FORGET,
+    Operation.FORGET_SNAPSHOT,
+    Operation.REPLICATE,
+    Operation.UPLOAD_STAGED,
+    Operation.SYNC_CATALOG,
+    Operation.INDEX_FILES,
+    Operation.STATS,
+)
+
+
 class ResticBackup:
     def __init__(self, app):
         self.app = app
         self._load_env_variables()
+        self.lock_inspector = LockInspector(app, self.env)
         self.current_utc_dt_starting = None
+        self.current_operation = None
         self.p = None
+        self.producer = None
+        self.truncated_snapshot_id = None
         self.need_to_unlock = False
+        self.bandwidth_timer = app.engine.timer(
+            self._bandwidth_window_changed, single_shot=True
+        )
+        self.bandwidth_restart = False
+        self.paused_by_restore = False
+        # {"reason": ..., "since_utc_dt": ...} while the due backup is deferred
+        self.deferral = None
+        self.backup_deferral_details = {}
+        self.last_deferred_seconds = None
+        # Estimate of the next backup's volume, and its deferral to off-peak
+        self.backup_estimate_details = {}
+        self.off_peak_deferral = None
+        self.repo_stats = None
+        self.watchdog_timer = app.engine.timer(self._watchdog_tick)
+        self.stalled = False
+        self.stop_signals_sent = 0
+        # Processes which survived SIGKILL (e.g. stuck on a dead mount)
+        self.abandoned_processes = []
+        self.shutdown_callback = None
+        self.shutdown_timer = app.engine.timer(self._shutdown_tick, single_shot=True)
+        # Resources used by self.p so far, see resources.py
+        self.process_usage = None
+        self.resources_timer = app.engine.timer(self._sample_resources)
+        # Spans of the current operation and of its current phase (see tracing.py)
+        self.operation_span = None
+        self.phase_span = None
+        self.trace_phase = None
+        # Snapshots given to the running `restic copy`
+        self.replicating_snapshots = []
+        # Network of the running queue (see connections.network_key)
+        self.network = None
+        if app.conf.replication:
+            self._publish_replication_metrics()
+        if app.conf.offline_staging:
+            self._publish_staging_metrics()
 
     def run(self):
+        span = self.app.tracer.begin("preflight")
+        can_start = self._backup_can_start()
+        self.app.tracer.end(span, started=can_start)
+        if can_start:
+            # Once per queue run, not before each of its operations
+            # (iwgetid is run synchronously)
+            self.network = network_key()
+            # Run queued commands, one by one
+            self._run_next_operation()
+
+    def _backup_can_start(self):
+        """
+        Answer if the queue can be run (restore, quiet hours, gating,
+        bandwidth budget) and fill it
+        """
+        if PIDFile(const.RESTORE_PID_FILE).is_running:
+            # Don't race the restore for the repository locks.
+            # Backup is still due -> retried on next scheduler tick
+            if not self.paused_by_restore:
+                self.app.logger.write_new_date_section(
+                    "Backup postponed. A restore is in progress"
+                )
+                self.paused_by_restore = True
+            if self.app.run_once:
+                self.app.quit()
+            return False
+        self.paused_by_restore = False
+
+        if self.app.state.in_quiet_hours():
+            resume_utc_dt = self.app.state.jittered_start(datetime.datetime.utcnow())
+            self.app.state.postpone_due(resume_utc_dt)
+            self.app.logger.write_new_date_section(
+                f"Backup postponed to {utc_to_local_str(resume_utc_dt)}. Quiet hours"
+            )
+            if self.app.run_once:
+                self.app.quit()
+            return False
+
+        if self._gate_backup():
+            # Backup is still due -> retried on next scheduler tick
+            if self.app.run_once:
+                self.app.quit()
+            return False
+
+        profile = self.app.state.bandwidth_profile()
+        if _no_budget(profile):
+            self.app.state.schedule_due_backups()
+            self.app.logger.write_new_date_section(
+                f"Backup skipped. No upload budget in bandwidth window "
+                f"'{window_name(profile)}'"
+            )
+            if self.app.run_once:
+                self.app.quit()
+            return False
+
         if not self.app.state.want_to_backup():
             self.app.logger.write_new_date_section(
                 f"Backup not launched. "
                 f"Current state is {self.app.state.current_operation.value}"
             )
-            return
+            if self.app.run_once:
+                self.app.quit()
+            return False
 
-        # Run queued commands, one by one
-        self._run_next_operation()
+        return True
+
+    def _gate_backup(self):
+        """
+        Answer if the due backup has to be deferred (see gating.py)
+        Log and export when it's deferred, and for how long
+        """
+        policies = self.app.conf.backup_gating
+        if not policies:
+            return False
+        conditions = check_conditions(policies)
+        last_success_utc_dt = None
+        if len(self.app.state.prev_backup_chronos) > 0:
+            last_success_utc_dt = self.app.state.prev_backup_chronos[0][0]
+        reason = deferral_reason(policies, conditions, last_success_utc_dt)
+        now_utc_dt = datetime.datetime.utcnow()
+        if reason is not None:
+            if self.deferral is None:
+                self.deferral = {"reason": reason, "since_utc_dt": now_utc_dt}
+                self.app.logger.write_new_date_section(f"Backup deferred: {reason}")
+            elif self.deferral["reason"] != reason:
+                self.deferral["reason"] = reason
+                self.app.logger.write_new_date_section(
+                    f"Backup still deferred: {reason}"
+                )
+            deferred_seconds = (
+                now_utc_dt - self.deferral["since_utc_dt"]
+            ).total_seconds()
+            publish_gating_metrics(
+                self.app.metrics, conditions, True, round(deferred_seconds)
+            )
+            return True
+        if self.deferral is not None:
+            deferred_seconds = (
+                now_utc_dt - self.deferral["since_utc_dt"]
+            ).total_seconds()
+            self.app.logger.write_new_date_section(
+                f"Backup deferred for {deferred_seconds / 60:.0f} minutes "
+                f"(last reason: {self.deferral['reason']}) -> starting it"
+            )
+            self.backup_deferral_details = {
+                "deferred_reason": self.deferral["reason"],
+                "deferred_seconds": round(deferred_seconds),
+            }
+            self.last_deferred_seconds = round(deferred_seconds)
+            self.deferral = None
+        publish_gating_metrics(
+            self.app.metrics, conditions, False, self.last_deferred_seconds
+        )
+        return False
 
     def terminate(self):
         """
@@ -50,56 +350,129 @@ class ResticBackup:
         This is the clean way to interrupt restic
         """
         if self.p is not None:
-            os.kill(self.p.processId(), signal.SIGINT)
+            self.p.send_signal(signal.SIGINT)
 
     def _run_next_operation(self):
         self.need_to_unlock = False
+        if self.shutdown_callback is not None:
+            # Nothing more is run when quitting, whatever has just been queued
+            self.app.state.empty_queue()
+        # Skipped / restarted without _operation_finished
+        self._trace_phase(None)
+        self.app.tracer.end(self.operation_span)
+        self.operation_span = None
         next_operation = self.app.state.next_operation()
-        self.app.qt_app.update_system_tray()
+        self.current_operation = next_operation
+        self.current_run_details = {}
+        self.app.ui.update_system_tray()
         if next_operation is None:
+            self.watchdog_timer.stop()
+            if self.shutdown_callback is not None:
+                self._shutdown_done()
+            elif self.app.run_once:
+                self.app.quit()
             return
-        elif next_operation == Operation.INIT:
+        self._start_watchdog()
+        self.operation_span = self.app.tracer.begin(
+            next_operation.value, target=self.app.state.current_target
+        )
+        self.app.events.publish(
+            EventType.OPERATION_STARTED,
+            operation=next_operation.value,
+            target=self.app.state.current_target,
+        )
+        if next_operation == Operation.INIT:
             self._run_init()
         elif next_operation == Operation.PRE_BACKUP:
             self._run_prebackup()
+        elif next_operation == Operation.ESTIMATE:
+            self._run_estimate()
         elif next_operation == Operation.BACKUP:
             self._run_backup()
+        elif next_operation == Operation.STREAM_BACKUP:
+            self._run_stream_backup()
+        elif next_operation == Operation.GROUP_BACKUP:
+            self._run_group_backup()
         elif next_operation == Operation.FORGET:
-            self._run_forget()
+            profile = self.app.state.bandwidth_profile()
+            if PIDFile(const.RESTORE_PID_FILE).is_running:
+                self.app.logger.write_new_date_section(
+                    "Forget postponed. A restore is in progress"
+                )
+                # Try again after next backup
+                self.app.state.postpone_forget(self.app.state.current_target)
+                self._skip_prune_stats()
+                self._run_next_operation()
+            elif _no_budget(profile, ("limit_upload", "limit_download")):
+                self.app.logger.write_new_date_section(
+                    f"Forget skipped. No bandwidth budget in window "
+                    f"'{window_name(profile)}'"
+                )
+                # Try again after next backup
+                self.app.state.postpone_forget(self.app.state.current_target)
+                self._skip_prune_stats()
+                self._run_next_operation()
+            else:
+                self._run_forget()
+        elif next_operation == Operation.FORGET_SNAPSHOT:
+            if PIDFile(const.RESTORE_PID_FILE).is_running:
+                self.app.logger.write_new_date_section(
+                    "Forget of the truncated snapshot postponed. "
+                    "A restore is in progress"
+                )
+                # Tried again after next backup
+                self._run_next_operation()
+            else:
+                self._run_forget_snapshot()
         elif next_operation == Operation.UNLOCK:
             self._run_unlock()
+        elif next_operation == Operation.SYNC_CATALOG:
+            self._run_sync_catalog()
+        elif next_operation == Operation.INDEX_FILES:
+            self._run_index_files()
+        elif next_operation == Operation.STATS:
+            self._run_stats()
+        elif next_operation == Operation.REPLICATE:
+            profile = self.app.state.bandwidth_profile()
+            if _no_budget(profile):
+                self.app.logger.write_new_date_section(
+                    f"Replication skipped. No bandwidth budget in window "
+                    f"'{window_name(profile)}'"
+                )
+                # Snapshots are left for the next replication
+                self._run_next_operation()
+            else:
+                self._run_replicate()
+        elif next_operation == Operation.INIT_STAGING:
+            self._run_init_staging()
+        elif next_operation == Operation.STAGE_BACKUP:
+            self._run_stage_backup()
+        elif next_operation == Operation.UPLOAD_STAGED:
+            profile = self.app.state.bandwidth_profile()
+            if _no_budget(profile):
+                self.app.logger.write_new_date_section(
+                    f"Upload of the staged snapshots skipped. "
+                    f"No bandwidth budget in window '{window_name(profile)}'"
+                )
+                # Uploaded after next backup
+                self._run_next_operation()
+            else:
+                self._run_upload_staged()
+        elif next_operation == Operation.PRUNE_STAGING:
+            self._run_prune_staging()
 
     def _load_env_variables(self):
         """
         Load expected env vars from ~/.enacrestic/env.sh
         to be used by restic commands
         """
-        self.env = QProcessEnvironment.systemEnvironment()
+        self.env = dict(os.environ)
 
         # Be sure to get output messages in english
-        self.env.insert("LC_ALL", "C")
+        self.env["LC_ALL"] = "C"
 
-        variables_i_search = [
-            r"RESTIC_\S+",
-            r"AWS_ACCESS_KEY_ID",
-            r"AWS_SECRET_ACCESS_KEY",
-        ]
-        try:
-            with open(const.RESTIC_USER_PREFS["ENV"], "r") as f:
-                for line in f.readlines():
-                    # remove comments
-                    # A) starting with #
-                    # B) having ' #'
-                    line = re.sub(r"^#.*", "", line)
-                    line = re.sub(r"\s+#.*", "", line)
-
-                    for var in variables_i_search:
-                        match = re.match(r"export (%s)=(.*)$" % var, line)
-                        if match:
-                            self.env.insert(match.group(1), match.group(2))
-        except FileNotFoundError:
-            pass
-        if not self.env.contains("RESTIC_REPOSITORY"):
+        self.env.update(load_restic_env())
+        if "RESTIC_REPOSITORY" not in self.env:
             self.app.logger.error(
                 f"{const.RESTIC_USER_PREFS['ENV']} seems not configured correctly"
             )
@@ -120,81 +493,1292 @@ class ResticBackup:
         args = []
         self._run(cmd, args)
 
-    def _run_backup(self):
-        self.app.logger.write_new_date_section("Running restic backup!")
-        cmd = "restic"
+    def _backup_args(self):
+        """
+        return the args of `restic backup` for the bkp_include files
+        """
         args = [
             "backup",
             "--files-from",
             const.RESTIC_USER_PREFS["FILESFROM"],
             "--password-file",
             const.RESTIC_USER_PREFS["PASSWORDFILE"],
+            "--json",
         ]
         if os.path.isfile(const.RESTIC_USER_PREFS["EXCLUDEFILE"]):
             args += ["--exclude-file", const.RESTIC_USER_PREFS["EXCLUDEFILE"]]
-        self._run(cmd, args)
+        return args + self._tuning_args()
+
+    def _run_estimate(self):
+        """
+        Same backup, with --dry-run : restic compares the files
+        with the same parent snapshot and tells what it would add
+        """
+        self.app.logger.write_new_date_section("Estimating the backup volume")
+        self.backup_estimate_details = {}
+        self.off_peak_deferral = None
+        self._run(
+            "restic",
+            self._backup_args() + ["--dry-run"],
+            json_output=True,
+            env=self._read_concurrency_env(self.env, files_from_paths()),
+        )
+
+    def _backup_estimated(self):
+        """
+        Defer the backup to the next off-peak window
+        if it's estimated to add more than defer_above_mib
+        """
+        estimated_bytes = self.current_run_details.get("estimated_bytes")
+        if estimated_bytes is None:
+            return
+        self.backup_estimate_details = {"estimated_bytes": estimated_bytes}
+        self.app.metrics.set(
+            "backup_estimated_bytes",
+            estimated_bytes,
+            "Bytes the last estimation predicted the backup to add",
+        )
+        self.app.metrics.write()
+        estimation = self.app.conf.backup_estimation
+        defer_above_mib = estimation.get("defer_above_mib")
+        if defer_above_mib is None or estimated_bytes <= defer_above_mib * 1024**2:
+            return
+        off_peak_utc_dt = self.app.state.next_off_peak_utc_dt()
+        if off_peak_utc_dt is None:
+            self.app.logger.write("No off-peak window ahead -> backing up now")
+            return
+        # Not deferred beyond max_age_hours
+        max_age_hours = estimation.get("max_age_hours")
+        if max_age_hours is not None and len(self.app.state.prev_backup_chronos) > 0:
+            off_peak_utc_dt = min(
+                off_peak_utc_dt,
+                self.app.state.prev_backup_chronos[0][0]
+                + datetime.timedelta(hours=max_age_hours),
+            )
+        reason = f"large backup ({bytes_to_human(estimated_bytes)} estimated)"
+        if (Operation.BACKUP, None) in self.app.state.queue:
+            self.app.state.queue.remove((Operation.BACKUP, None))
+        # Hosts deferred to the same window don't all start right away
+        self.app.state.next_backup_due_utc_dt = self.app.state.jittered_start(
+            off_peak_utc_dt
+        )
+        self.app.logger.write(
+            f"Backup deferred: {reason} -> due at "
+            f"{utc_to_local_str(self.app.state.next_backup_due_utc_dt)}"
+        )
+        self.off_peak_deferral = {
+            "reason": reason,
+            "since_utc_dt": datetime.datetime.utcnow(),
+        }
+        self.current_run_details["deferred_until"] = utc_to_local_str(
+            self.app.state.next_backup_due_utc_dt
+        )
+
+    def _run_backup(self):
+        self.app.logger.write_new_date_section("Running restic backup!")
+        cmd = "restic"
+        args = self._backup_args()
+        self.current_run_details.update(self.backup_deferral_details)
+        self.backup_deferral_details = {}
+        self.current_run_details.update(self.backup_estimate_details)
+        self.backup_estimate_details = {}
+        if self.off_peak_deferral is not None:
+            self.current_run_details.update(
+                {
+                    "deferred_reason": self.off_peak_deferral["reason"],
+                    "deferred_seconds": round(
+                        (
+                            datetime.datetime.utcnow()
+                            - self.off_peak_deferral["since_utc_dt"]
+                        ).total_seconds()
+                    ),
+                }
+            )
+            self.off_peak_deferral = None
+        self.snapshot_paths = files_from_paths()
+        self.snapshot_tags = []
+        self._run(
+            cmd,
+            args,
+            json_output=True,
+            env=self._read_concurrency_env(self.env, self.snapshot_paths),
+        )
+
+    def _read_concurrency_env(self, env, paths):
+        """
+        return restic's environment env, with the read concurrency
+        (RESTIC_READ_CONCURRENCY) for the storage of paths :
+        as set in prefs.json, or chosen from past backups (see storage.py)
+        """
+        storage_class = classify_paths(paths)
+        read_concurrency = self.app.conf.read_concurrency
+        if read_concurrency is None:
+            read_concurrency = choose_read_concurrency(
+                storage_class,
+                self.app.history.get_runs(
+                    (Operation.BACKUP, Operation.GROUP_BACKUP), limit=100
+                ),
+            )
+        if read_concurrency is None:
+            # Unknown storage : restic's default
+            return env
+        self.app.logger.write(
+            f"Read concurrency: {read_concurrency} "
+            f"({storage_class or 'unknown'} storage)"
+        )
+        self.current_run_details.update(
+            {"storage_class": storage_class, "read_concurrency": read_concurrency}
+        )
+        env = dict(env)
+        env["RESTIC_READ_CONCURRENCY"] = str(read_concurrency)
+        return env
+
+    def _run_stream_backup(self):
+        """
+        Pipe the stdout of a stream source's command
+        straight into `restic backup --stdin`.
+
+        Both processes are connected by a pipe (no temp file),
+        so the command is slowed down when restic can't keep up.
+        """
+        name = self.app.state.current_target
+        try:
+            stream_source = next(
+                source
+                for source in self.app.conf.stream_sources
+                if source["name"] == name
+            )
+        except StopIteration:
+            self.app.logger.error(f"Stream source '{name}' is not configured anymore")
+            self._run_next_operation()
+            return
+        self.app.logger.write_new_date_section(
+            f"Running restic backup of stream '{name}'!"
+        )
+        self.producer = self.app.engine.process()
+        self.producer_stderr_decoder = codecs.getincrementaldecoder("utf8")(
+            errors="replace"
+        )
+        self.producer.on_stderr = self._handle_producer_stderr
+        self.producer.on_failed_to_start = self._handle_producer_error
+        self.producer.on_finished = self._producer_finished
+        self.producer_failed = False
+        cmd = "restic"
+        args = [
+            "backup",
+            "--stdin",
+            "--stdin-filename",
+            stream_source.get("filename", name),
+            "--tag",
+            f"stream:{name}",
+            "--password-file",
+            const.RESTIC_USER_PREFS["PASSWORDFILE"],
+            "--json",
+        ] + self._tuning_args()
+        self.snapshot_paths = ["/" + stream_source.get("filename", name).lstrip("/")]
+        self.snapshot_tags = [f"stream:{name}"]
+        self._run(cmd, args, json_output=True, producer=self.producer)
+        command = list(stream_source["command"])
+        # The command doesn't need restic's secrets : system environment
+        self.producer.start(command[0], command[1:])
+
+    def _run_group_backup(self):
+        """
+        Backup the paths of a path group, in snapshots tagged group:<name>
+        (and its own tags), with its own exclude file
+        """
+        name = self.app.state.current_target
+        group = get_path_group(self.app.conf, name)
+        if group is None:
+            self.app.logger.error(f"Path group '{name}' is not configured anymore")
+            self._run_next_operation()
+            return
+        self.app.logger.write_new_date_section(
+            f"Running restic backup of group '{name}'!"
+        )
+        self.snapshot_paths = [os.path.expanduser(path) for path in group["paths"]]
+        self.snapshot_tags = [f"group:{name}"] + list(group.get("tags", []))
+        cmd = "restic"
+        args = ["backup"] + self.snapshot_paths
+        for tag in self.snapshot_tags:
+            args += ["--tag", tag]
+        args += [
+            "--password-file",
+            const.RESTIC_USER_PREFS["PASSWORDFILE"],
+            "--json",
+        ]
+        if group.get("exclude_file") is not None:
+            args += ["--exclude-file", os.path.expanduser(group["exclude_file"])]
+        args += self._tuning_args()
+        self._run(
+            cmd,
+            args,
+            json_output=True,
+            env=self._read_concurrency_env(self.env, self.snapshot_paths),
+        )
 
     def _run_forget(self):
-        self.app.logger.write_new_date_section("Running restic forget!")
+        """
+        Forget with the retention of a path group (its snapshots only)
+        or the default one (snapshots of path groups excluded)
+        """
+        name = self.app.state.current_target
+        keep = dict(const.DEF_KEEP_POLICY)
+        if name is None:
+            self.app.logger.write_new_date_section("Running restic forget!")
+            tag_args = []
+            for group in self.app.conf.path_groups:
+                tag_args += ["--keep-tag", f"group:{group['name']}"]
+        else:
+            group = get_path_group(self.app.conf, name)
+            if group is None:
+                self.app.logger.error(f"Path group '{name}' is not configured anymore")
+                self._run_next_operation()
+                return
+            self.app.logger.write_new_date_section(
+                f"Running restic forget of group '{name}'!"
+            )
+            keep.update(group.get("keep", {}))
+            tag_args = ["--tag", f"group:{name}"]
         cmd = "restic"
         args = [
             "forget",
             "--prune",
             "-g",
-            "host",
-            "-c",
+            "host,tags",
+            "--password-file",
+            const.RESTIC_USER_PREFS["PASSWORDFILE"],
+        ] + tag_args
+        for key, value in keep.items():
+            args += [f"--keep-{key}", str(value)]
+        args.append("--json")
+        self._run(cmd, args, json_output=True)
+
+    def _run_sync_catalog(self):
+        self.app.logger.write_new_date_section("Syncing the snapshot catalog")
+        cmd = "restic"
+        args = [
+            "snapshots",
+            "--json",
+            "--no-lock",
+            "--password-file",
+            const.RESTIC_USER_PREFS["PASSWORDFILE"],
+        ]
+        self._run(cmd, args, json_output=True)
+
+    def _skip_prune_stats(self):
+        """
+        No prune -> no need to measure what it freed
+        """
+        self.app.state.queue = [
+            entry
+            for entry in self.app.state.queue
+            if entry != (Operation.STATS, "after_prune")
+        ]
+
+    def _run_stats(self):
+        self.app.logger.write_new_date_section("Measuring the repository size")
+        self.repo_stats = None
+        cmd = "restic"
+        args = [
+            "stats",
+            "--mode",
+            "raw-data",
+            "--json",
+            "--no-lock",
+            "--password-file",
+            const.RESTIC_USER_PREFS["PASSWORDFILE"],
+        ]
+        self._run(cmd, args, json_output=True)
+
+    def _repo_stats_measured(self):
+        """
+        Record the repository size and report the updated analysis
+        """
+        self.app.history.add_repo_stats(
+            self.current_utc_dt_starting,
+            self.app.state.current_target,
+            self.repo_stats,
+        )
+        self.current_run_details["total_size"] = self.repo_stats["total_size"]
+        self.app.repo_analysis = analyze(
+            self.app.history, self.app.catalog, self.app.conf.repository_quota_gib
+        )
+        self.app.logger.write(analysis_to_str(self.app.repo_analysis))
+        analysis = self.app.repo_analysis
+        if analysis["quota_reached_utc_dt"] is not None and analysis[
+            "quota_reached_utc_dt"
+        ] - datetime.datetime.utcnow() < datetime.timedelta(
+            days=const.QUOTA_WARNING_DAYS
+        ):
+            self.app.logger.error(
+                f"Repository quota will be reached within {const.QUOTA_WARNING_DAYS} days"
+            )
+        publish_metrics(self.app.metrics, analysis)
+
+    def _run_index_files(self):
+        snapshot_id = self.app.state.current_target
+        snapshot = self.app.catalog.get_snapshot(snapshot_id)
+        if snapshot is None:
+            # Forgotten in the meantime
+            self._run_next_operation()
+            return
+        self.app.logger.write_new_date_section(
+            f"Indexing files of snapshot {snapshot['short_id']}"
+        )
+        self.app.file_index.begin_snapshot(snapshot)
+        cmd = "restic"
+        args = [
+            "ls",
+            snapshot_id,
+            "--json",
+            "--no-lock",
+            "--password-file",
+            const.RESTIC_USER_PREFS["PASSWORDFILE"],
+        ]
+        self._run(cmd, args, json_output=True)
+
+    def _unreplicated_snapshots(self):
+        """
+        return this host's snapshots not copied to the secondary repository yet
+        (oldest first), as known by the snapshot catalog.
+        Compared by ID, not by time : a snapshot may land in the repository
+        after newer ones (upload of the staged ones, catalog sync)
+        """
+        replicated_ids = self.app.catalog.replicated_ids()
+        return [
+            snapshot
+            for snapshot in reversed(
+                self.app.catalog.get_snapshots(limit=-1, hostname=socket.gethostname())
+            )
+            if snapshot["id"] not in replicated_ids
+        ]
+
+    def _run_replicate(self):
+        """
+        `restic copy` the snapshots not replicated yet
+        to the secondary repository (env_file, password_file of "replication").
+        The primary repository is the source (RESTIC_FROM_*),
+        the secondary one is restic's usual repository.
+        restic copy skips the snapshots already there,
+        so an interrupted replication just resumes.
+        """
+        replication = self.app.conf.replication
+        self.replicating_snapshots = self._unreplicated_snapshots()
+        if len(self.replicating_snapshots) == 0:
+            self.app.logger.write_new_date_section(
+                "Replication skipped. No new snapshot"
+            )
+            self._publish_replication_metrics()
+            self._run_next_operation()
+            return
+        self.app.logger.write_new_date_section(
+            f"Running restic copy of {len(self.replicating_snapshots)} snapshots "
+            "to the secondary repository!"
+        )
+        env = _without_repository(self.env)
+        env.update(_source_repository(self.env))
+        env.update(load_restic_env(os.path.expanduser(replication["env_file"])))
+        cmd = "restic"
+        args = (
+            ["copy"]
+            + [snapshot["id"] for snapshot in self.replicating_snapshots]
+            + [
+                "--password-file",
+                os.path.expanduser(replication["password_file"]),
+            ]
+        )
+        self.current_run_details["snapshots_to_copy"] = len(self.replicating_snapshots)
+        self._run(cmd, args, env=env)
+
+    def _snapshots_replicated(self):
+        """
+        Remember the snapshots copied, and the time of the newest one
+        """
+        self.app.catalog.mark_replicated(
+            snapshot["id"] for snapshot in self.replicating_snapshots
+        )
+        newest_utc_dt = max(
+            snapshot["time_utc_dt"] for snapshot in self.replicating_snapshots
+        )
+        last_utc_dt = self.app.state.last_replicated_snapshot_utc_dt
+        if last_utc_dt is None or newest_utc_dt > last_utc_dt:
+            self.app.state.last_replicated_snapshot_utc_dt = newest_utc_dt
+        self.replicating_snapshots = []
+
+    def _publish_replication_metrics(self):
+        """
+        + replication lag : age of the oldest snapshot not replicated yet
+          (0 when the secondary repository is up to date)
+        + time of the newest snapshot replicated
+        """
+        unreplicated = self._unreplicated_snapshots()
+        lag_seconds = 0
+        if len(unreplicated) > 0:
+            lag_seconds = (
+                datetime.datetime.utcnow() - unreplicated[0]["time_utc_dt"]
+            ).total_seconds()
+        self.app.metrics.set(
+            "replication_lag_seconds",
+            round(lag_seconds),
+            "Age of the oldest snapshot not copied to the secondary repository yet",
+        )
+        last_utc_dt = self.app.state.last_replicated_snapshot_utc_dt
+        if last_utc_dt is not None:
+            self.app.metrics.set(
+                "last_replicated_snapshot_timestamp_seconds",
+                last_utc_dt.replace(tzinfo=datetime.timezone.utc).timestamp(),
+                "Time of the newest snapshot copied to the secondary repository",
+            )
+        self.app.metrics.write()
+
+    def _staging_env(self):
+        """
+        return restic's environment, with the staging repository as repository
+        """
+        env = _without_repository(self.env)
+        env["RESTIC_REPOSITORY"] = get_staging_repository(self.app.conf)
+        return env
+
+    def _run_init_staging(self):
+        """
+        Create the staging repository with the chunker parameters
+        of the repository : the same files give the same blobs in both,
+        the upload of the staged snapshots only sends what's missing
+        """
+        self.app.logger.write_new_date_section(
+            "Running restic init of the staging repository!"
+        )
+        os.makedirs(
+            os.path.dirname(get_staging_repository(self.app.conf)), exist_ok=True
+        )
+        env = self._staging_env()
+        env.update(_source_repository(self.env))
+        cmd = "restic"
+        args = [
+            "init",
+            "--copy-chunker-params",
+            "--password-file",
+            const.RESTIC_USER_PREFS["PASSWORDFILE"],
+        ]
+        self._run(cmd, args, env=env)
+
+    def _run_stage_backup(self):
+        """
+        Backup bkp_include to the staging repository (the repository is unreachable)
+        unless it's already over its disk budget
+        """
+        staging_bytes = dir_size(get_staging_repository(self.app.conf))
+        max_size_mib = self.app.conf.offline_staging.get("max_size_mib")
+        if max_size_mib is not None and staging_bytes > max_size_mib * 1024**2:
+            self.app.logger.error(
+                f"Staging repository full ({bytes_to_human(staging_bytes)}) "
+                "-> nothing backed up until the repository is reachable"
+            )
+            self._run_next_operation()
+            return
+        self.app.logger.write_new_date_section(
+            "Running restic backup to the staging repository!"
+        )
+        cmd = "restic"
+        args = self._backup_args()
+        self.snapshot_paths = files_from_paths()
+        self.snapshot_tags = []
+        self._run(
+            cmd,
+            args,
+            json_output=True,
+            env=self._read_concurrency_env(self._staging_env(), self.snapshot_paths),
+        )
+
+    def _run_upload_staged(self):
+        """
+        `restic copy` the staged snapshots to the repository.
+        A copied snapshot keeps its time : when its files were read,
+        not when it's uploaded. restic copy skips the snapshots already there,
+        so an interrupted upload just resumes.
+        """
+        self.app.logger.write_new_date_section(
+            f"Running restic copy of {self.app.state.nb_staged_snapshots} "
+            "staged snapshots to the repository!"
+        )
+        env = dict(self.env)
+        env["RESTIC_FROM_REPOSITORY"] = get_staging_repository(self.app.conf)
+        env["RESTIC_FROM_PASSWORD_FILE"] = const.RESTIC_USER_PREFS["PASSWORDFILE"]
+        cmd = "restic"
+        args = [
+            "copy",
+            "--password-file",
+            const.RESTIC_USER_PREFS["PASSWORDFILE"],
+        ]
+        self._run(cmd, args, env=env)
+
+    def _run_forget_snapshot(self):
+        """
+        Forget the snapshot restic saved from a stream whose command failed
+        (its data is left for the next prune)
+        """
+        snapshot_id = self.app.state.current_target
+        self.app.logger.write_new_date_section(
+            f"Running restic forget of truncated snapshot {snapshot_id}!"
+        )
+        cmd = "restic"
+        args = [
+            "forget",
+            snapshot_id,
             "--password-file",
             const.RESTIC_USER_PREFS["PASSWORDFILE"],
-            "--keep-last",
-            "3",
-            "--keep-hourly",
-            "24",
-            "--keep-daily",
-            "7",
-            "--keep-weekly",
-            "4",
-            "--keep-monthly",
-            "12",
-            "--keep-yearly",
-            "5",
         ]
         self._run(cmd, args)
 
-    def _run_unlock(self):
-        self.app.logger.write_new_date_section("Running restic unlock!")
+    def _run_prune_staging(self):
+        """
+        The staged snapshots are in the repository now :
+        forget them but the last one (parent of the next staged backup,
+        whose unchanged files aren't read again)
+        """
+        self.app.logger.write_new_date_section(
+            "Running restic forget of the staging repository!"
+        )
         cmd = "restic"
+        args = [
+            "forget",
+            "--prune",
+            "--keep-last",
+            "1",
+            "--password-file",
+            const.RESTIC_USER_PREFS["PASSWORDFILE"],
+        ]
+        self._run(cmd, args, env=self._staging_env())
+
+    def _staging_pruned(self):
+        """
+        Still over its disk budget (e.g. a huge last snapshot) :
+        start over with an empty staging repository,
+        nothing in it is needed anymore
+        """
+        staging_bytes = dir_size(get_staging_repository(self.app.conf))
+        max_size_mib = self.app.conf.offline_staging.get("max_size_mib")
+        if max_size_mib is None or staging_bytes <= max_size_mib * 1024**2:
+            return
+        self.app.logger.write(
+            f"Staging repository still over its budget ({bytes_to_human(staging_bytes)})"
+            " -> recreating it"
+        )
+        shutil.rmtree(get_staging_repository(self.app.conf), ignore_errors=True)
+        self.app.state.queue.insert(0, (Operation.INIT_STAGING, None))
+
+    def _publish_staging_metrics(self):
+        self.app.metrics.set(
+            "staged_snapshots",
+            self.app.state.nb_staged_snapshots,
+            "Snapshots in the staging repository, not copied to the repository yet",
+        )
+        self.app.metrics.set(
+            "staging_repository_bytes",
+            dir_size(get_staging_repository(self.app.conf)),
+            "Size on disk of the staging repository",
+        )
+        self.app.metrics.write()
+
+    def _run_unlock(self):
+        """
+        Inspect the repository locks first,
+        then only unlock if some of them are stale
+        """
+        self.app.logger.write_new_date_section("Inspecting repository locks")
+        self.current_utc_dt_starting = datetime.datetime.utcnow()
+        self._trace_phase("inspect_locks")
+        self.lock_inspector.inspect(self._locks_inspected)
+
+    def _locks_inspected(self, locks):
+        if self.stalled or self.shutdown_callback is not None:
+            # Inspection was interrupted, don't go on with the unlock
+            self.current_chrono = (
+                datetime.datetime.utcnow() - self.current_utc_dt_starting
+            )
+            self._operation_finished(
+                Status.STALLED if self.stalled else Status.LAST_OPERATION_FAILED, None
+            )
+            return
         args = [
             "unlock",
             "--password-file",
             const.RESTIC_USER_PREFS["PASSWORDFILE"],
         ]
-        self._run(cmd, args)
+        if locks is None:
+            self.app.logger.error(
+                "Could not inspect locks. Letting restic remove the stale ones."
+            )
+        else:
+            for lock in locks:
+                self.app.logger.write(
+                    f"lock {lock['id'][:8]} by PID {lock.get('pid')} "
+                    f"on {lock.get('hostname')} "
+                    f"created at {utc_to_local_str(parse_restic_time(lock['time']))} "
+                    f"-> {lock['verdict'].value}"
+                )
+            self.app.events.publish(
+                EventType.LOCK_DETECTED,
+                locks=[
+                    {
+                        "id": lock["id"],
+                        "hostname": lock.get("hostname"),
+                        "pid": lock.get("pid"),
+                        "time": lock.get("time"),
+                        "verdict": lock["verdict"].name.lower(),
+                        "stale": lock["verdict"] in STALE_LOCK_VERDICTS,
+                    }
+                    for lock in locks
+                ],
+            )
+            stale_locks = [
+                lock for lock in locks if lock["verdict"] in STALE_LOCK_VERDICTS
+            ]
+            if len(stale_locks) == 0:
+                self.app.logger.write("No stale lock -> not unlocking")
+                self.current_chrono = (
+                    datetime.datetime.utcnow() - self.current_utc_dt_starting
+                )
+                self._operation_finished(Status.REPO_LOCKED, None)
+                return
+            if len(stale_locks) == len(locks) and any(
+                lock["verdict"] == LockVerdict.PID_REUSED for lock in stale_locks
+            ):
+                # restic only checks that the PID exists
+                args.append("--remove-all")
 
-    def _run(self, cmd, args):
-        self.p = QProcess()
-        self.p.setProcessEnvironment(self.env)
-        self.p.readyReadStandardOutput.connect(self._handle_stdout)
-        self.p.readyReadStandardError.connect(self._handle_stderr)
-        self.p.stateChanged.connect(self._handle_state)
-        self.p.finished.connect(self._process_finished)
-        self.p.start(cmd, args)
+        self.app.logger.write("Running restic unlock!")
+        self._run("restic", args)
+
+    def _run(self, cmd, args, json_output=False, producer=None, env=None):
+        """
+        Start cmd with args
+        + json_output: stdout is made of JSON messages (restic's --json)
+        + producer: Process whose stdout is piped to cmd's stdin
+        + env: environment instead of the primary repository's one
+        """
+        if env is None:
+            env = self.env
+        if cmd == "restic":
+            if self.current_operation not in LOCAL_OPERATIONS:
+                args = args + self._bandwidth_args()
+            if self.current_operation in CONNECTIONS_TUNED_OPERATIONS:
+                args = args + self._connections_args()
+            env = self._go_gc_env(env)
+        self.p = self.app.engine.process()
+        self.p.on_started = self._process_started
+        self.p.on_stdout = self._handle_stdout
+        self.p.on_stderr = self._handle_stderr
+        self.p.on_failed_to_start = self._process_failed_to_start
+        self.p.on_finished = self._process_exited
+        if producer is not None:
+            producer.pipe_to(self.p)
+        self.json_output = json_output
+        # A read may end in the middle of a UTF-8 character
+        self.stdout_decoder = codecs.getincrementaldecoder("utf8")(errors="replace")
+        self.stderr_decoder = codecs.getincrementaldecoder("utf8")(errors="replace")
+        self.stdout_buffer = ""
+        self.progress_bytes_done = 0
+        self.progress_key = None
+        self.last_progress_log_utc_dt = datetime.datetime.utcnow()
+        self.last_progress_event_monotonic = time.monotonic()
+        self.last_activity_monotonic = time.monotonic()
+        self.current_utc_dt_starting = datetime.datetime.utcnow()
+        self.app.ui.update_system_tray()
+        self.process_usage = None
+        self._trace_phase("spawn", command=cmd)
+        self.p.start(cmd, args, env)
+        self.resources_timer.start(const.RESOURCE_SAMPLE_EVERY_N_SECONDS * 1000)
         self.current_process_completion_status = ResticCompletionStatus.NO_ERROR
 
-    def _handle_stdout(self):
-        data = self.p.readAllStandardOutput()
-        stdout = bytes(data).decode("utf8")
-        self.app.logger.write(stdout)
+    def _go_gc_env(self, env):
+        """
+        return restic's environment env, with GOGC / GOMEMLIMIT
+        as set for the current operation in prefs.json
+        e.g. a lower GOGC and a GOMEMLIMIT cap the memory of a prune
+        on a small machine, at the expense of CPU time
+        """
+        go_gc = self.app.conf.restic_go_gc
+        settings = go_gc.get(
+            self.current_operation.value
+            if self.current_operation is not None
+            else None,
+            go_gc.get("default", {}),
+        )
+        env = dict(env)
+        for key in ("GOGC", "GOMEMLIMIT"):
+            if settings.get(key) is not None:
+                env[key] = str(settings[key])
+                self.current_run_details[key.lower()] = settings[key]
+        return env
 
-    def _handle_stderr(self):
-        data = self.p.readAllStandardError()
-        stderr = bytes(data).decode("utf8")
+    def _process_started(self):
+        # The pre-backup hook isn't restic
+        self._trace_phase(
+            "running"
+            if self.current_operation == Operation.PRE_BACKUP
+            else "open_repository"
+        )
+        self._sample_resources()
+
+    def _trace_phase(self, phase, **args):
+        """
+        End the span of the current phase of the operation (if any),
+        start the one of phase (unless None)
+        """
+        if not self.app.tracer.enabled:
+            return
+        self.app.tracer.end(self.phase_span)
+        self.trace_phase = phase
+        self.phase_span = None
+        if phase is not None:
+            self.phase_span = self.app.tracer.begin(phase, **args)
+
+    def _trace_output(self):
+        """
+        The process wrote something : its repository is open and locked
+        """
+        if self.trace_phase != "open_repository":
+            return
+        self.app.tracer.instant("first_output")
+        if self.current_operation in SCANNING_OPERATIONS:
+            self._trace_phase("scan")
+        elif self.current_operation == Operation.STREAM_BACKUP:
+            self._trace_phase("upload")
+        else:
+            self._trace_phase("running")
+
+    def _trace_progress(self, message):
+        """
+        Follow the phases of a backup from its status messages :
+        scan until the first bytes are read, upload until all are,
+        then write_index (index and snapshot saved)
+        """
+        if self.trace_phase == "scan" and (message.get("bytes_done") or 0) > 0:
+            self._trace_phase("upload")
+        if self.trace_phase == "upload" and (message.get("percent_done") or 0) >= 1:
+            self._trace_phase("write_index")
+
+    def _sample_resources(self):
+        if self.p is None or self.p.pid is None:
+            return
+        usage = sample_usage(self.p.pid)
+        # None once the process is gone : keep the last sample
+        if usage is not None:
+            self.process_usage = usage
+
+    def _start_watchdog(self):
+        """
+        Watch the operation about to run, see self._watchdog_tick
+        """
+        self.stalled = False
+        self.stop_signals_sent = 0
+        self.operation_start_monotonic = time.monotonic()
+        self.last_activity_monotonic = self.operation_start_monotonic
+        self.watchdog_timer.start(const.WATCHDOG_TICK_EVERY_N_SECONDS * 1000)
+
+    def _activity(self):
+        """
+        The running process made progress (or wrote something)
+        """
+        self.last_activity_monotonic = time.monotonic()
+
+    def _max_runtime_minutes(self):
+        max_runtime_minutes = {
+            **const.DEF_MAX_RUNTIME_MINUTES,
+            **self.app.conf.max_runtime_minutes,
+        }
+        return max_runtime_minutes.get(self.current_operation.value)
+
+    def _watchdog_tick(self):
+        """
+        Declare the current operation stalled when
+        + it reports its progress but didn't progress for stall_after_n_minutes
+        + it runs for more than its max_runtime_minutes
+        and interrupt it (monotonic clock -> time suspended doesn't count)
+        """
+        if self.current_operation is None:
+            self.watchdog_timer.stop()
+            return
+        if self.stalled:
+            self._escalate_stall()
+            return
+        now = time.monotonic()
+        stall_after_n_minutes = self.app.conf.stall_after_n_minutes
+        max_runtime_minutes = self._max_runtime_minutes()
+        idle_minutes = (now - self.last_activity_monotonic) / 60
+        runtime_minutes = (now - self.operation_start_monotonic) / 60
+        if (
+            self.current_operation in PROGRESS_REPORTING_OPERATIONS
+            and stall_after_n_minutes is not None
+            and idle_minutes >= stall_after_n_minutes
+        ):
+            reason = f"no progress for {idle_minutes:.0f} minutes"
+        elif max_runtime_minutes is not None and runtime_minutes >= max_runtime_minutes:
+            reason = f"running for more than {max_runtime_minutes} minutes"
+        else:
+            return
+        self.app.logger.error(
+            f"{self.current_operation.value} stalled ({reason}) -> interrupting it"
+        )
+        self.app.events.publish(
+            EventType.STALLED,
+            operation=self.current_operation.value,
+            target=self.app.state.current_target,
+            reason=reason,
+            idle_seconds=round(idle_minutes * 60),
+            runtime_seconds=round(runtime_minutes * 60),
+        )
+        self.stalled = True
+        self.watchdog_timer.start(const.STALL_ESCALATION_SECONDS * 1000)
+        self._escalate_stall()
+
+    def _running_processes(self):
+        return [
+            process
+            for process in (self.p, self.producer, self.lock_inspector.p)
+            if process is not None and process.running
+        ]
+
+    def _escalate_stall(self):
+        """
+        Send the next signal of STOP_SIGNALS to the stalled processes,
+        abandon them once they all have been sent
+        """
+        processes = self._running_processes()
+        if len(processes) == 0:
+            return
+        if self.stop_signals_sent >= len(STOP_SIGNALS):
+            self._abandon_processes(processes, Status.STALLED)
+            return
+        self._send_next_stop_signal(processes)
+
+    def _send_next_stop_signal(self, processes):
+        sig = STOP_SIGNALS[self.stop_signals_sent]
+        self.stop_signals_sent += 1
+        for process in processes:
+            self.app.logger.write(f"Sending {sig.name} to process {process.pid}")
+            process.send_signal(sig)
+
+    def _abandon_processes(self, processes, completion_status):
+        """
+        Processes still running after SIGKILL are stuck in the kernel
+        (e.g. uninterruptible read of a dead NFS mount).
+        Don't wait for them any longer, the queue has to go on
+        """
+        for process in processes:
+            self.app.logger.error(f"Process {process.pid} can't be killed -> abandoned")
+            process.abandon()
+            # Kept referenced : destroying a running QProcess (GUI) waits for it
+            self.abandoned_processes.append(process)
+        if self.current_utc_dt_starting is None:
+            self.current_utc_dt_starting = datetime.datetime.utcnow()
+        self.current_chrono = datetime.datetime.utcnow() - self.current_utc_dt_starting
+        self.lock_inspector.p = None
+        self._operation_finished(completion_status, None)
+
+    def shutdown(self, on_finished):
+        """
+        Stop the current operation (if any) to quit the app.
+        on_finished(seconds it took) is called once every child process
+        is finished (from their finished signal), at most
+        conf.shutdown_deadline_seconds later :
+        + SIGINT right away, the clean way to interrupt restic
+        + SIGTERM, then SIGKILL (see SHUTDOWN_SIGNALS_AT)
+        + processes still running are abandoned
+        The interrupted operation is noted in the state,
+        to be retried first on next launch
+        """
+        if self.shutdown_callback is not None:
+            # Already shutting down
+            return
+        self.shutdown_callback = on_finished
+        self.shutdown_start_monotonic = time.monotonic()
+        self.app.state.empty_queue()
+        self.bandwidth_restart = False
+        self.watchdog_timer.stop()
+        processes = self._running_processes()
+        if len(processes) == 0:
+            self._shutdown_done()
+            return
+        self.app.logger.write(
+            f"Closing the app. Interrupting {self.current_operation.value}, "
+            f"waiting at most {self.app.conf.shutdown_deadline_seconds} seconds"
+        )
+        if self.current_operation in RETRIED_AFTER_SHUTDOWN_OPERATIONS:
+            self.app.state.interrupted_operation = (
+                self.current_operation,
+                self.app.state.current_target,
+            )
+        self.current_run_details["interrupted_by_shutdown"] = True
+        self._shutdown_tick()
+
+    def _shutdown_tick(self):
+        """
+        Send the stop signal due at this point of the shutdown
+        and arm the timer for the next one
+        """
+        processes = self._running_processes()
+        if len(processes) == 0:
+            return
+        if self.stop_signals_sent >= len(STOP_SIGNALS):
+            self._abandon_processes(processes, Status.LAST_OPERATION_FAILED)
+            return
+        deadline_seconds = self.app.conf.shutdown_deadline_seconds
+        elapsed = time.monotonic() - self.shutdown_start_monotonic
+        # Signals sent already by the watchdog aren't sent again
+        if elapsed >= SHUTDOWN_SIGNALS_AT[self.stop_signals_sent] * deadline_seconds:
+            self._send_next_stop_signal(processes)
+        if self.stop_signals_sent < len(STOP_SIGNALS):
+            next_tick_at = (
+                SHUTDOWN_SIGNALS_AT[self.stop_signals_sent] * deadline_seconds
+            )
+        else:
+            next_tick_at = deadline_seconds + const.SHUTDOWN_ABANDON_AFTER_SECONDS
+        self.shutdown_timer.start(int(max(next_tick_at - elapsed, 0) * 1000))
+
+    def _shutdown_done(self):
+        self.shutdown_timer.stop()
+        self.shutdown_callback(time.monotonic() - self.shutdown_start_monotonic)
+
+    def _bandwidth_args(self):
+        """
+        + return restic args limiting the bandwidth
+          according to the current bandwidth profile
+        + arm a timer to check it again when the window changes
+        """
+        profile = self.app.state.bandwidth_profile()
+        self.current_bandwidth_profile = profile
+        self.current_run_details["bandwidth_window"] = window_name(profile)
+        limits = {}
+        if profile is not None:
+            for key in ("limit_upload", "limit_download"):
+                if profile.get(key) is not None:
+                    limits[key] = profile[key]
+        if self.current_operation == Operation.REPLICATE:
+            # Its own limits, on top of the bandwidth window's ones
+            for key in ("limit_upload", "limit_download"):
+                limit = self.app.conf.replication.get(key)
+                if limit is not None:
+                    limits[key] = min(limit, limits.get(key, limit))
+        args = []
+        for key, limit in limits.items():
+            args += [f"--{key.replace('_', '-')}", str(limit)]
+            self.current_run_details[key] = limit
+        self._arm_bandwidth_timer()
+        return args
+
+    def _connections_args(self):
+        """
+        return restic args setting the number of connections to the backend :
+        as set in prefs.json, or tuned for the backend and the network
+        of the queue run from the past backups (see connections.py)
+        """
+        repository = self.env.get("RESTIC_REPOSITORY")
+        if repository is None and self.env.get("RESTIC_REPOSITORY_FILE"):
+            try:
+                with open(self.env["RESTIC_REPOSITORY_FILE"], "r") as f:
+                    repository = f.read().strip()
+            except OSError:
+                pass
+        backend = backend_of(repository)
+        if backend is None:
+            return []
+        network = self.network
+        connections = self.app.conf.backend_connections
+        if connections is None:
+            connections = choose_connections(
+                backend,
+                network,
+                self.app.history.get_runs(
+                    (Operation.BACKUP, Operation.STREAM_BACKUP, Operation.GROUP_BACKUP),
+                    limit=100,
+                ),
+            )
+        self.app.logger.write(
+            f"Backend connections: {connections} ({backend}, network '{network}')"
+        )
+        self.current_run_details.update(
+            {"backend": backend, "network": network, "connections": connections}
+        )
+        self.app.metrics.set(
+            "backend_connections",
+            connections,
+            "Concurrent connections to the backend of the last operation",
+            backend=backend,
+        )
+        self.app.metrics.write()
+        return ["-o", f"{backend}.connections={connections}"]
+
+    def _tuning_args(self):
+        """
+        return restic args setting compression and pack size,
+        as tuned for the current bandwidth profile (see `enacrestic benchmark`)
+        """
+        tuning = self.app.conf.backup_tuning
+        name = window_name(self.app.state.bandwidth_profile())
+        settings = tuning.get(name, tuning.get("default", {}))
+        args = []
+        if settings.get("compression") is not None:
+            args += ["--compression", settings["compression"]]
+            self.current_run_details["compression"] = settings["compression"]
+        if settings.get("pack_size") is not None:
+            args += ["--pack-size", str(settings["pack_size"])]
+            self.current_run_details["pack_size"] = settings["pack_size"]
+        return args
+
+    def _arm_bandwidth_timer(self):
+        """
+        Call self._bandwidth_window_changed when next bandwidth window starts/ends
+        """
+        now_local_dt = utc_to_local(datetime.datetime.utcnow())
+        next_change_local_dt = next_change(
+            self.app.conf.bandwidth_profiles, now_local_dt
+        )
+        if next_change_local_dt is not None:
+            self.bandwidth_timer.start(
+                int((next_change_local_dt - now_local_dt).total_seconds() * 1000) + 1000
+            )
+
+    def _bandwidth_window_changed(self):
+        """
+        Interrupt current upload if the new window is more restrictive,
+        it'll be restarted with the new limits (or skipped if no budget)
+        """
+        if self.shutdown_callback is not None:
+            return
+        if self.p is None or self.current_operation not in (
+            Operation.BACKUP,
+            Operation.STREAM_BACKUP,
+            Operation.GROUP_BACKUP,
+            Operation.FORGET,
+            Operation.REPLICATE,
+            Operation.UPLOAD_STAGED,
+        ):
+            return
+        profile = self.app.state.bandwidth_profile()
+        if not _more_restrictive(profile, self.current_bandwidth_profile):
+            self._arm_bandwidth_timer()
+            return
+        self.app.logger.write_new_date_section(
+            f"Entering bandwidth window '{window_name(profile)}' "
+            "-> interrupting current operation to apply its limits"
+        )
+        self.bandwidth_restart = True
+        self.terminate()
+
+    def _handle_stdout(self, data):
+        stdout = self.stdout_decoder.decode(data)
+        self._trace_output()
+        if not self.json_output:
+            self._activity()
+            self.app.logger.write(stdout)
+            if self.current_operation in (
+                Operation.REPLICATE,
+                Operation.UPLOAD_STAGED,
+            ):
+                nb_copied = len(re.findall(r"snapshot \w+ saved", stdout))
+                self.current_run_details["snapshots_copied"] = (
+                    self.current_run_details.get("snapshots_copied", 0) + nb_copied
+                )
+            return
+
+        # JSON messages come one per line, possibly split across reads
+        lines = (self.stdout_buffer + stdout).split("\n")
+        self.stdout_buffer = lines.pop()
+        for line in lines:
+            if line.strip() == "":
+                continue
+            try:
+                message = json.loads(line)
+            except json.decoder.JSONDecodeError:
+                self.app.logger.write(line)
+                continue
+            self._handle_json_message(message)
+
+    def _handle_json_message(self, message):
+        """
+        Handle one message of restic's --json output
+        """
+        if not isinstance(message, dict) or message.get("message_type") != "status":
+            self._activity()
+        if isinstance(message, list):
+            self._handle_json_snapshots(message)
+            return
+        if self.current_operation == Operation.INDEX_FILES:
+            self.app.file_index.add_node(message)
+            return
+        if self.current_operation == Operation.STATS:
+            if "total_size" in message:
+                self.repo_stats = message
+            return
+        message_type = message.get("message_type")
+        if message_type == "status":
+            # Status is repeated while stuck, only changes are progress
+            progress_key = tuple(
+                message.get(key)
+                for key in ("files_done", "bytes_done", "total_files", "total_bytes")
+            )
+            if progress_key != self.progress_key:
+                self.progress_key = progress_key
+                self._activity()
+                self._trace_progress(message)
+            if (
+                "read_concurrency" in self.current_run_details
+                and "read_seconds" not in self.current_run_details
+                and (message.get("percent_done") or 0) >= 1
+                and message.get("seconds_elapsed") is not None
+            ):
+                # Every file is read : the rest is upload and index
+                self.current_run_details["read_seconds"] = message["seconds_elapsed"]
+            self.progress_bytes_done = message.get(
+                "bytes_done", self.progress_bytes_done
+            )
+            if (
+                time.monotonic() - self.last_progress_event_monotonic
+                >= const.PROGRESS_EVENT_EVERY_N_SECONDS
+            ):
+                self.last_progress_event_monotonic = time.monotonic()
+                self.app.events.publish(
+                    EventType.PROGRESS,
+                    operation=self.current_operation.value,
+                    target=self.app.state.current_target,
+                    percent_done=message.get("percent_done"),
+                    files_done=message.get("files_done"),
+                    total_files=message.get("total_files"),
+                    bytes_done=self.progress_bytes_done,
+                    total_bytes=message.get("total_bytes"),
+                )
+            now_utc_dt = datetime.datetime.utcnow()
+            if (now_utc_dt - self.last_progress_log_utc_dt).total_seconds() >= (
+                const.PROGRESS_LOG_EVERY_N_SECONDS
+            ):
+                self.last_progress_log_utc_dt = now_utc_dt
+                elapsed = (now_utc_dt - self.current_utc_dt_starting).total_seconds()
+                self.app.logger.write(
+                    f"{bytes_to_human(self.progress_bytes_done)} read so far "
+                    f"({bytes_to_human(self.progress_bytes_done / max(elapsed, 1))}/s)"
+                )
+        elif message_type == "summary" and self.current_operation == Operation.ESTIMATE:
+            self._trace_phase("exit")
+            self.current_run_details.update(
+                {
+                    "estimated_bytes": message.get("data_added"),
+                    "files_new": message.get("files_new"),
+                    "files_changed": message.get("files_changed"),
+                    "bytes_processed": message.get("total_bytes_processed"),
+                }
+            )
+            self.app.logger.write(
+                f"Files: {message.get('files_new', 0)} new, "
+                f"{message.get('files_changed', 0)} changed -> "
+                f"{bytes_to_human(message.get('data_added', 0))} to add to the repo"
+            )
+        elif message_type == "summary":
+            self._trace_phase("exit")
+            self.current_run_details.update(
+                {
+                    "snapshot_id": message.get("snapshot_id"),
+                    "files_new": message.get("files_new"),
+                    "files_changed": message.get("files_changed"),
+                    "files_unmodified": message.get("files_unmodified"),
+                    "bytes_processed": message.get("total_bytes_processed"),
+                    "data_added": message.get("data_added"),
+                    # Only known since restic 0.17
+                    "bytes_uploaded": message.get(
+                        "data_added_packed", message.get("data_added")
+                    ),
+                }
+            )
+            self.app.logger.write(
+                f"Files: {message.get('files_new', 0)} new, "
+                f"{message.get('files_changed', 0)} changed, "
+                f"{message.get('files_unmodified', 0)} unmodified\n"
+                f"snapshot {message.get('snapshot_id')} saved: "
+                f"{bytes_to_human(message.get('total_bytes_processed', 0))} read, "
+                f"{bytes_to_human(message.get('data_added', 0))} added to the repo"
+            )
+            # The catalog lists the snapshots of the repository only
+            # (not the truncated ones, forgotten afterwards)
+            if (
+                message.get("snapshot_id") is not None
+                and self.current_operation != Operation.STAGE_BACKUP
+                and not (self.producer is not None and self.producer_failed)
+            ):
+                self.app.catalog.add_backup(
+                    message, self.snapshot_paths, self.snapshot_tags
+                )
+        elif message_type == "error":
+            self.app.logger.error(json.dumps(message))
+
+    def _handle_json_snapshots(self, message):
+        """
+        Update the snapshot catalog from the snapshots listed by
+        + `restic forget --json` (list of groups of kept / removed snapshots)
+        + `restic snapshots --json` (list of snapshots)
+        """
+        if self.current_operation == Operation.FORGET:
+            nb_kept = sum(len(group.get("keep") or []) for group in message)
+            nb_removed = sum(len(group.get("remove") or []) for group in message)
+            self.app.logger.write(
+                f"{nb_kept} snapshots kept, {nb_removed} snapshots removed"
+            )
+            self.current_run_details.update(
+                {"snapshots_kept": nb_kept, "snapshots_removed": nb_removed}
+            )
+            # A path group's forget (--tag) lists only that group's snapshots
+            scoped = self.app.state.current_target is not None
+            removed_ids = self.app.catalog.apply_forget(message, scoped)
+        elif self.current_operation == Operation.SYNC_CATALOG:
+            self.app.logger.write(f"{len(message)} snapshots in the repository")
+            self.app.catalog.sync(message)
+            scoped = False
+        else:
+            return
+        if self.app.file_index is not None:
+            if scoped:
+                nb_pruned = self.app.file_index.remove(removed_ids)
+            else:
+                nb_pruned = self.app.file_index.prune(self.app.catalog.snapshot_ids())
+            if nb_pruned > 0:
+                self.app.logger.write(f"{nb_pruned} snapshots removed from file index")
+
+    def _handle_producer_stderr(self, data):
+        stderr = self.producer_stderr_decoder.decode(data)
+        self.app.logger.error(stderr)
+
+    def _handle_producer_error(self, message):
+        self.app.logger.error(f"Stream command failed to start: {message}")
+        self.producer_failed = True
+        # Don't let restic snapshot an empty stream
+        self.terminate()
+
+    def _producer_finished(self):
+        if self.producer.crashed or self.producer.exit_code != 0:
+            self.app.logger.error(f"Stream command failed ({self.producer.exit_code})")
+            self.producer_failed = True
+            # Don't let restic snapshot a truncated stream
+            if self.p is not None and self.p.running:
+                self.terminate()
+        if self.p is not None and not self.p.running:
+            self._process_finished()
+
+    def _handle_stderr(self, data):
+        stderr = self.stderr_decoder.decode(data)
+        self._trace_output()
+        self._activity()
         self.app.logger.error(stderr)
         if self.app.state.current_operation in (
+            CurrentOperation.ESTIMATE_IN_PROGRESS,
             CurrentOperation.BACKUP_IN_PROGRESS,
+            CurrentOperation.STREAM_BACKUP_IN_PROGRESS,
+            CurrentOperation.GROUP_BACKUP_IN_PROGRESS,
             CurrentOperation.FORGET_IN_PROGRESS,
+            CurrentOperation.FORGET_SNAPSHOT_IN_PROGRESS,
             CurrentOperation.UNLOCK_IN_PROGRESS,
         ):
-            if re.search(r"timeout", stderr):
+            if NO_NETWORK_ERRORS.search(stderr):
                 self.current_process_completion_status = ResticCompletionStatus.TIMEOUT
 
             elif re.search(
@@ -212,32 +1796,52 @@ class ResticBackup:
                 self.current_process_completion_status = (
                     ResticCompletionStatus.REPO_LOCKED
                 )
-                lock_ago_str = re.search(
-                    r"lock was created at.* \((.*)\)", stderr
-                ).group(1)
-                lock_hours_bool = re.search(r"\dh\d", lock_ago_str) is not None
-                try:
-                    lock_minutes_int = int(re.search(r"(\d+)m", lock_ago_str).group(1))
-                except AttributeError:
-                    lock_minutes_int = 0
-                self.need_to_unlock = lock_hours_bool or lock_minutes_int > 30
-                if not self.need_to_unlock:
-                    self.app.logger.write(
-                        "The lock is too new. We expect 30+ minutes to unlock manually."
-                    )
-
-    def _handle_state(self, proc_state):
-        if proc_state == QProcess.Starting:
-            self.current_utc_dt_starting = datetime.datetime.utcnow()
-            self.app.qt_app.update_system_tray()
-        elif proc_state == QProcess.NotRunning:
-            self.current_chrono = (
-                datetime.datetime.utcnow() - self.current_utc_dt_starting
-            )
+                # Let the lock inspector decide if the lock is stale
+                self.need_to_unlock = (
+                    self.app.state.current_operation
+                    != CurrentOperation.UNLOCK_IN_PROGRESS
+                )
+
+    def _process_failed_to_start(self, message):
+        self.app.logger.error(f"Failed to start: {message}")
+        self.current_chrono = datetime.datetime.utcnow() - self.current_utc_dt_starting
+        if self.producer is not None and self.producer.running:
+            # Nobody reads its output anymore
+            self.producer.abandon()
+            self.producer.send_signal(signal.SIGTERM)
+        self._operation_finished(Status.LAST_OPERATION_FAILED, None)
+
+    def _process_exited(self):
+        self.resources_timer.stop()
+        self.current_chrono = datetime.datetime.utcnow() - self.current_utc_dt_starting
+        self._process_finished()
 
     def _process_finished(self):
-        exitCode = self.p.exitCode()
-        if self.p.exitStatus() == QProcess.NormalExit:
+        if self.producer is not None and self.producer.running:
+            # Wait for both ends of the pipe, see self._producer_finished
+            return
+        interrupted = not self.p.succeeded()
+        if self.bandwidth_restart and interrupted and not self.stalled:
+            self.bandwidth_restart = False
+            profile = self.app.state.bandwidth_profile()
+            if _no_budget(profile):
+                self.app.logger.write(
+                    f"No upload budget in bandwidth window '{window_name(profile)}' "
+                    "-> operation skipped\n\n"
+                )
+            else:
+                self.app.logger.write("Restarting operation with new limits\n\n")
+                self.app.state.queue.insert(
+                    0, (self.current_operation, self.app.state.current_target)
+                )
+            self.current_utc_dt_starting = None
+            self.p = None
+            self.producer = None
+            self._run_next_operation()
+            return
+        self.bandwidth_restart = False
+        exitCode = self.p.exit_code
+        if not self.p.crashed:
             if exitCode == 0:
                 completion_status = Status.OK
             else:
@@ -260,18 +1864,150 @@ class ResticBackup:
                     completion_status = Status.LAST_OPERATION_FAILED
         else:
             completion_status = Status.LAST_OPERATION_FAILED
+        self.truncated_snapshot_id = None
+        if self.producer is not None and self.producer_failed:
+            if completion_status == Status.OK:
+                completion_status = Status.LAST_OPERATION_FAILED
+            # restic may have saved the stream read until the command failed
+            self.truncated_snapshot_id = self.current_run_details.get("snapshot_id")
+        if self.stalled and completion_status != Status.OK:
+            completion_status = Status.STALLED
+        self._operation_finished(completion_status, exitCode)
+
+    def _operation_finished(self, completion_status, exitCode):
+        """
+        + Update the state with the result of current operation
+        + Run the next one
+        """
+        self._trace_phase(None)
+        if self.shutdown_callback is not None and completion_status == Status.OK:
+            # Finished before the signal -> nothing to retry
+            self.app.state.interrupted_operation = None
+        span = self.app.tracer.begin("save_state")
         self.app.state.finished_restic_cmd(
             completion_status,
             self.current_utc_dt_starting,
             self.current_chrono,
             self.need_to_unlock,
         )
-        self.app.logger.write(
-            f"Process finished ({exitCode}) in "
-            f"{self.current_chrono.total_seconds():.2f} seconds "
-            f"with status: '{completion_status.value}'\n\n"
-        )
+        self.app.tracer.end(span)
+        if self.truncated_snapshot_id is not None:
+            self.app.logger.error(
+                f"Snapshot {self.truncated_snapshot_id} of the failed stream command "
+                "is truncated -> forgetting it"
+            )
+            self.app.catalog.remove(self.truncated_snapshot_id)
+            self.app.state.forget_truncated_snapshot(self.truncated_snapshot_id)
+            self.truncated_snapshot_id = None
+        if self.current_operation == Operation.INDEX_FILES:
+            indexed = self.app.file_index.end_snapshot(completion_status == Status.OK)
+            if indexed is not None:
+                self.app.logger.write(
+                    f"{indexed[0]} files indexed, {indexed[1]} new versions"
+                )
+                self.current_run_details.update(
+                    {"files_indexed": indexed[0], "new_versions": indexed[1]}
+                )
+        if (
+            self.current_operation == Operation.STATS
+            and completion_status == Status.OK
+            and self.repo_stats is not None
+        ):
+            self._repo_stats_measured()
+        if (
+            self.current_operation == Operation.ESTIMATE
+            and completion_status == Status.OK
+        ):
+            self._backup_estimated()
+        if (
+            self.current_operation == Operation.REPLICATE
+            and completion_status == Status.OK
+        ):
+            self._snapshots_replicated()
+        if (
+            self.current_operation == Operation.PRUNE_STAGING
+            and completion_status == Status.OK
+        ):
+            self._staging_pruned()
+        if self.app.conf.offline_staging and self.current_operation in (
+            Operation.INIT_STAGING,
+            Operation.STAGE_BACKUP,
+            Operation.UPLOAD_STAGED,
+            Operation.PRUNE_STAGING,
+        ):
+            self._publish_staging_metrics()
+        if self.app.conf.replication and self.current_operation in (
+            Operation.BACKUP,
+            Operation.STREAM_BACKUP,
+            Operation.GROUP_BACKUP,
+            Operation.REPLICATE,
+        ):
+            self._publish_replication_metrics()
+        estimated_bytes = self.current_run_details.get("estimated_bytes")
+        data_added = self.current_run_details.get("data_added")
+        if estimated_bytes is not None and data_added is not None:
+            self.app.logger.write(
+                f"Added {bytes_to_human(data_added)}, "
+                f"estimated {bytes_to_human(estimated_bytes)}"
+            )
+        bytes_uploaded = self.current_run_details.get("bytes_uploaded")
+        seconds = self.current_chrono.total_seconds()
+        if bytes_uploaded is not None and seconds > 0:
+            message = (
+                f"Uploaded {bytes_to_human(bytes_uploaded)} "
+                f"at {bytes_to_human(bytes_uploaded / seconds)}/s"
+            )
+            bandwidth_window = self.current_run_details.get("bandwidth_window")
+            if bandwidth_window is not None:
+                message += f" (bandwidth window '{bandwidth_window}')"
+            self.app.logger.write(message)
+        self.resources_timer.stop()
+        if self.process_usage is not None:
+            self.app.logger.write(usage_to_str(self.process_usage))
+            self.current_run_details.update(self.process_usage)
+            if self.current_operation is not None:
+                publish_usage_metrics(
+                    self.app.metrics, self.current_operation, self.process_usage
+                )
+            self.process_usage = None
+        if self.current_operation is not None:
+            span = self.app.tracer.begin("save_history")
+            self.app.history.add_run(
+                self.current_operation,
+                self.app.state.current_target,
+                self.current_utc_dt_starting,
+                self.current_chrono.total_seconds(),
+                completion_status,
+                self.current_run_details,
+            )
+            self.app.tracer.end(span)
+            self.app.events.publish(
+                EventType.OPERATION_FINISHED,
+                operation=self.current_operation.value,
+                target=self.app.state.current_target,
+                status=completion_status.value,
+                exit_code=exitCode,
+                seconds=self.current_chrono.total_seconds(),
+                details=dict(self.current_run_details),
+            )
+        if exitCode is None:
+            self.app.logger.write(
+                f"Operation finished in "
+                f"{self.current_chrono.total_seconds():.2f} seconds "
+                f"with status: '{completion_status.value}'\n\n"
+            )
+        else:
+            self.app.logger.write(
+                f"Process finished ({exitCode}) in "
+                f"{self.current_chrono.total_seconds():.2f} seconds "
+                f"with status: '{completion_status.value}'\n\n"
+            )
 
+        self.app.tracer.end(
+            self.operation_span, status=completion_status.value, exit_code=exitCode
+        )
+        self.operation_span = None
         self.current_utc_dt_starting = None
         self.p = None
+        self.producer = None
         self._run_next_operation()
@@ -0,0 +1,257 @@
+"""
+`enacrestic restore` : restore a snapshot with the same environment
+and password file as the backups, while scheduled backups are paused.
+
++ holds const.RESTORE_PID_FILE, so that the running app (or the jobs of the
+  system daemon) postpone their backups and forgets until it's done
++ waits for an operation holding an exclusive lock (forget, unlock, init)
+  to be finished before starting
++ can restore the files found by the file index (--find)
++ shows restic's JSON progress with throughput and ETA
++ records the run in the history
+"""
+
+import datetime
+import json
+import os
+import subprocess
+import sys
+import time
+
+from dynaconf import Dynaconf
+from pidfile import AlreadyRunningError, PIDFile
+
+from enacrestic import const
+from enacrestic.file_index import FileIndex
+from enacrestic.history import RunHistory
+from enacrestic.state import CurrentOperation, Operation, Status
+from enacrestic.utils import bytes_to_human, load_restic_env
+
+EXCLUSIVE_LOCK_OPERATIONS = (
+    CurrentOperation.INIT_IN_PROGRESS.value,
+    CurrentOperation.FORGET_IN_PROGRESS.value,
+    CurrentOperation.FORGET_SNAPSHOT_IN_PROGRESS.value,
+    CurrentOperation.UNLOCK_IN_PROGRESS.value,
+)
+
+
+def duration_to_human(seconds):
+    """
+    return nice duration as 1:02:03
+    """
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02}:{seconds:02}"
+
+
+class Restore:
+    def __init__(self, args):
+        self.args = args
+        self.last_progress_print = 0
+        self.details = {}
+
+    def run(self):
+        """
+        return the exit code of `enacrestic restore`
+        """
+        env = dict(os.environ)
+        # Be sure to get output messages in english
+        env["LC_ALL"] = "C"
+        env.update(load_restic_env())
+        if "RESTIC_REPOSITORY" not in env:
+            print(
+                f"{const.RESTIC_USER_PREFS['ENV']} seems not configured correctly",
+                file=sys.stderr,
+            )
+            return 1
+
+        if self.args.find is not None and not self._select_from_index():
+            return 1
+
+        try:
+            with PIDFile(const.RESTORE_PID_FILE):
+                self._wait_for_exclusive_operation()
+                return self._restore(env)
+        except AlreadyRunningError:
+            print("Another restore is in progress -> quit", file=sys.stderr)
+            return const.EXIT_ALREADY_RUNNING
+
+    def _select_from_index(self):
+        """
+        --find : restore the files matching the pattern,
+        from the latest snapshot holding one (unless a snapshot is given)
+        """
+        if not os.path.exists(const.FILE_INDEX_DB):
+            print("The file index is not built -> can't use --find", file=sys.stderr)
+            return False
+        found = FileIndex().latest_snapshot_holding(self.args.find)
+        if found is None:
+            print(f"No file matching {self.args.find} in the file index")
+            return False
+        snapshot_id, paths = found
+        if self.args.snapshot == "latest":
+            self.args.snapshot = snapshot_id
+        self.args.includes += paths
+        return True
+
+    def _wait_for_exclusive_operation(self):
+        """
+        Backups are paused from now on, but an operation holding
+        an exclusive lock on the repository has to be finished first
+        """
+        announced = False
+        while PIDFile(const.PID_FILE).is_running:
+            state = Dynaconf(settings_files=[const.RESTIC_STATEFILE])
+            current_operation = state.get("current_operation")
+            if current_operation not in EXCLUSIVE_LOCK_OPERATIONS:
+                break
+            if not announced:
+                print(f"Waiting for {current_operation} to be finished ...")
+                announced = True
+            time.sleep(const.RESTORE_WAIT_EVERY_N_SECONDS)
+
+    def _restic_args(self):
+        args = [
+            "restic",
+            "restore",
+            self.args.snapshot,
+            "--target",
+            self.args.target,
+            "--password-file",
+            const.RESTIC_USER_PREFS["PASSWORDFILE"],
+            "--json",
+        ]
+        for path in self.args.paths:
+            args += ["--path", path]
+        if self.args.host is not None:
+            args += ["--host", self.args.host]
+        for pattern in self.args.includes:
+            args += ["--include", pattern]
+        for pattern in self.args.excludes:
+            args += ["--exclude", pattern]
+        if self.args.sparse:
+            args.append("--sparse")
+        if self.args.verify:
+            args.append("--verify")
+        return args
+
+    def _restore(self, env):
+        start_utc_dt = datetime.datetime.utcnow()
+        start_monotonic = time.monotonic()
+        if not self.args.json:
+            print(f"Restoring {self.args.snapshot} to {self.args.target}")
+        p = subprocess.Popen(
+            self._restic_args(),
+            env=env,
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+        try:
+            for line in p.stdout:
+                self._handle_stdout_line(line)
+            exit_code = p.wait()
+        except KeyboardInterrupt:
+            # restic got the ctrl-c as well, let it close cleanly
+            exit_code = p.wait()
+        self._end_progress_line()
+
+        status = Status.OK if exit_code == 0 else Status.LAST_OPERATION_FAILED
+        if exit_code == 0:
+            if not self.args.json:
+                print(self._summary())
+        else:
+            print(f"Restore failed ({exit_code})", file=sys.stderr)
+        RunHistory().add_run(
+            Operation.RESTORE,
+            self.args.snapshot,
+            start_utc_dt,
+            time.monotonic() - start_monotonic,
+            status,
+            self.details,
+        )
+        return exit_code
+
+    def _handle_stdout_line(self, line):
+        try:
+            message = json.loads(line)
+        except json.decoder.JSONDecodeError:
+            print(line, end="")
+            return
+        if not isinstance(message, dict):
+            return
+        message_type = message.get("message_type")
+        if self.args.json and message_type != "status":
+            print(line, end="", flush=True)
+        if message_type == "status":
+            self._progress(message)
+        elif message_type == "summary":
+            for key in (
+                "total_files",
+                "files_restored",
+                "files_skipped",
+                "total_bytes",
+                "bytes_restored",
+                "bytes_skipped",
+            ):
+                if key in message:
+                    self.details[key] = message[key]
+            if message.get("seconds_elapsed"):
+                self.details["throughput"] = (
+                    message.get("bytes_restored", 0) / message["seconds_elapsed"]
+                )
+        elif message_type == "error" and not self.args.json:
+            self._end_progress_line()
+            error = message.get("error", {}).get("message", line.strip())
+            print(f"{message.get('item', '')}: {error}", file=sys.stderr)
+
+    def _progress(self, message):
+        """
+        Show throughput and ETA computed from restic's status message
+        + on a single refreshed line on a terminal
+        + every PROGRESS_LOG_EVERY_N_SECONDS otherwise
+        """
+        seconds = message.get("seconds_elapsed", 0)
+        bytes_restored = message.get("bytes_restored", 0)
+        total_bytes = message.get("total_bytes", 0)
+        throughput = bytes_restored / seconds if seconds > 0 else 0
+        if self.args.json:
+            message["throughput"] = throughput
+            message["eta_seconds"] = (
+                (total_bytes - bytes_restored) / throughput if throughput > 0 else None
+            )
+            print(json.dumps(message), flush=True)
+            return
+
+        if not sys.stdout.isatty():
+            if time.monotonic() - self.last_progress_print < (
+                const.PROGRESS_LOG_EVERY_N_SECONDS
+            ):
+                return
+        self.last_progress_print = time.monotonic()
+        line = (
+            f"{message.get('percent_done', 0) * 100:5.1f}% "
+            f"{bytes_to_human(bytes_restored)} / {bytes_to_human(total_bytes)}, "
+            f"{message.get('files_restored', 0)} / {message.get('total_files', 0)} "
+            f"files, {bytes_to_human(throughput)}/s"
+        )
+        if throughput > 0:
+            line += f", ETA {duration_to_human((total_bytes - bytes_restored) / throughput)}"
+        if sys.stdout.isatty():
+            print(f"\r\033[K{line}", end="", flush=True)
+        else:
+            print(line, flush=True)
+
+    def _end_progress_line(self):
+        if sys.stdout.isatty() and not self.args.json:
+            print("\r\033[K", end="", flush=True)
+
+    def _summary(self):
+        summary = (
+            f"Restored {self.details.get('files_restored', 0)} files, "
+            f"{bytes_to_human(self.details.get('bytes_restored', 0))}"
+        )
+        if self.details.get("throughput"):
+            summary += f" at {bytes_to_human(self.details['throughput'])}/s"
+        if self.details.get("files_skipped"):
+            summary += f" ({self.details['files_skipped']} files already there)"
+        return summary
@@ -6,7 +6,16 @@ from enum import Enum
 from dynaconf import Dynaconf
 
 from enacrestic import __version__, const
-from enacrestic.utils import local_str_to_utc, utc_to_local_str
+from enacrestic.time_windows import end_of_windows, find_window, next_change
+from enacrestic.utils import (
+    files_from_paths,
+    host_phase_seconds,
+    local_str_to_utc,
+    local_to_utc,
+    next_phase_slot,
+    utc_to_local,
+    utc_to_local_str,
+)
 
 
 class Operation(Enum):
@@ -16,9 +25,29 @@ class Operation(Enum):
 
     INIT = "init"
     PRE_BACKUP = "pre_backup"
+    # `restic backup --dry-run` before a BACKUP, see State.estimation_is_due
+    ESTIMATE = "estimate"
     BACKUP = "backup"
+    STREAM_BACKUP = "stream_backup"
+    GROUP_BACKUP = "group_backup"
+    # `restic copy` of the new snapshots to the secondary repository
+    REPLICATE = "replicate"
+    # Offline staging repository (see conf.offline_staging) :
+    # created while the repository is reachable,
+    # backed up to while it's not, copied to it once it's back
+    INIT_STAGING = "init_staging"
+    STAGE_BACKUP = "stage_backup"
+    UPLOAD_STAGED = "upload_staged"
+    PRUNE_STAGING = "prune_staging"
     FORGET = "forget"
+    # `restic forget <snapshot_id>` of a stream backup whose command failed
+    FORGET_SNAPSHOT = "forget_snapshot"
     UNLOCK = "unlock"
+    SYNC_CATALOG = "sync_catalog"
+    INDEX_FILES = "index_files"
+    STATS = "stats"
+    # Run by `enacrestic restore`, never queued
+    RESTORE = "restore"
 
 
 class CurrentOperation(Enum):
@@ -29,9 +58,21 @@ class CurrentOperation(Enum):
     JUST_LAUNCHED = "just_launched"
     INIT_IN_PROGRESS = "init_in_progress"
     PRE_BACKUP_IN_PROGRESS = "pre_backup_in_progress"
+    ESTIMATE_IN_PROGRESS = "estimate_in_progress"
     BACKUP_IN_PROGRESS = "backup_in_progress"
+    STREAM_BACKUP_IN_PROGRESS = "stream_backup_in_progress"
+    GROUP_BACKUP_IN_PROGRESS = "group_backup_in_progress"
+    REPLICATE_IN_PROGRESS = "replicate_in_progress"
+    INIT_STAGING_IN_PROGRESS = "init_staging_in_progress"
+    STAGE_BACKUP_IN_PROGRESS = "stage_backup_in_progress"
+    UPLOAD_STAGED_IN_PROGRESS = "upload_staged_in_progress"
+    PRUNE_STAGING_IN_PROGRESS = "prune_staging_in_progress"
     FORGET_IN_PROGRESS = "forget_in_progress"
+    FORGET_SNAPSHOT_IN_PROGRESS = "forget_snapshot_in_progress"
     UNLOCK_IN_PROGRESS = "unlock_in_progress"
+    SYNC_CATALOG_IN_PROGRESS = "sync_catalog_in_progress"
+    INDEX_FILES_IN_PROGRESS = "index_files_in_progress"
+    STATS_IN_PROGRESS = "stats_in_progress"
     IDLE = "idle"
 
 
@@ -45,6 +86,32 @@ class Status(Enum):
     LAST_OPERATION_FAILED = "last_operation_failed"
     NO_NETWORK = "no_network"
     REPO_LOCKED = "repo_locked"
+    # Interrupted by the watchdog (no progress or running for too long)
+    STALLED = "stalled"
+
+
+def get_path_group(conf, name):
+    """
+    return the path group name as set in prefs.json, None if there is none
+    """
+    for group in conf.path_groups:
+        if group["name"] == name:
+            return group
+    return None
+
+
+def get_staging_repository(conf):
+    """
+    return the path of the offline staging repository, None if there is none
+    """
+    if not conf.offline_staging:
+        return None
+    return os.path.expanduser(conf.offline_staging["repository"])
+
+
+def staging_is_initialized(conf):
+    repository = get_staging_repository(conf)
+    return repository is not None and os.path.exists(os.path.join(repository, "config"))
 
 
 class State:
@@ -55,6 +122,7 @@ class State:
     def __init__(self, app):
         self.app = app
         self.pre_backup_failed = False
+        self.current_target = None
 
     def __enter__(self):
         self._load()
@@ -76,15 +144,106 @@ class State:
         self.latest_version_available = conf_read.get(
             "latest_version_available", __version__
         )
+        # ETag / Last-Modified of the last answer, see release_check.py
+        self.release_check_cache = dict(conf_read.get("release_check_cache", {}))
         self.nb_backups_before_forget = conf_read.get(
             "nb_backups_before_forget", self.app.conf.forget_every_n_backups
         )
+        # Per path group (see conf.path_groups)
+        self.nb_group_backups_before_forget = {
+            group["name"]: conf_read.get("nb_group_backups_before_forget", {}).get(
+                group["name"],
+                group.get(
+                    "forget_every_n_backups", self.app.conf.forget_every_n_backups
+                ),
+            )
+            for group in self.app.conf.path_groups
+        }
+        # Snapshots in the offline staging repository, not copied yet
+        self.nb_staged_snapshots = conf_read.get("nb_staged_snapshots", 0)
         self.prev_backup_chronos = []
         for chrono in conf_read.get("prev_backup_chronos", []):
             self.prev_backup_chronos.append((local_str_to_utc(chrono[0]), chrono[1]))
         self.prev_forget_chronos = []
         for chrono in conf_read.get("prev_forget_chronos", []):
             self.prev_forget_chronos.append((local_str_to_utc(chrono[0]), chrono[1]))
+        # (Operation, target) interrupted by last shutdown, to be retried first
+        interrupted_operation = conf_read.get("interrupted_operation")
+        self.interrupted_operation = None
+        if interrupted_operation is not None:
+            self.interrupted_operation = (
+                Operation(interrupted_operation[0]),
+                interrupted_operation[1],
+            )
+        self.last_shutdown_utc_dt = None
+        if conf_read.get("last_shutdown_datetime") is not None:
+            self.last_shutdown_utc_dt = local_str_to_utc(
+                conf_read.get("last_shutdown_datetime")
+            )
+        self.last_shutdown_seconds = conf_read.get("last_shutdown_seconds")
+
+        # Next backup is due one interval after the last one,
+        # whatever the number of restarts or suspends in between
+        backup_interval = datetime.timedelta(
+            minutes=self.app.conf.backup_every_n_minutes
+        )
+        now_utc_dt = datetime.datetime.utcnow()
+        if conf_read.get("next_backup_due_datetime") is not None:
+            self.next_backup_due_utc_dt = local_str_to_utc(
+                conf_read.get("next_backup_due_datetime")
+            )
+        elif len(self.prev_backup_chronos) > 0:
+            self.next_backup_due_utc_dt = (
+                self.prev_backup_chronos[0][0] + backup_interval
+            )
+        else:
+            self.next_backup_due_utc_dt = now_utc_dt
+        # In case backup_every_n_minutes has been reduced
+        self.next_backup_due_utc_dt = min(
+            self.next_backup_due_utc_dt,
+            self.jittered_start(now_utc_dt + backup_interval),
+        )
+        next_group_backup_datetimes = conf_read.get("next_group_backup_datetimes", {})
+        self.next_group_backup_utc_dts = {}
+        for group in self.app.conf.path_groups:
+            name = group["name"]
+            if next_group_backup_datetimes.get(name) is None:
+                self.next_group_backup_utc_dts[name] = now_utc_dt
+                continue
+            self.next_group_backup_utc_dts[name] = min(
+                local_str_to_utc(next_group_backup_datetimes[name]),
+                self.jittered_start(
+                    now_utc_dt + datetime.timedelta(minutes=self._group_interval(group))
+                ),
+            )
+        # Time of the newest snapshot copied to the secondary repository
+        self.last_replicated_snapshot_utc_dt = None
+        if conf_read.get("last_replicated_snapshot_datetime") is not None:
+            self.last_replicated_snapshot_utc_dt = local_str_to_utc(
+                conf_read.get("last_replicated_snapshot_datetime")
+            )
+        self.next_replication_due_utc_dt = now_utc_dt
+        if conf_read.get("next_replication_due_datetime") is not None:
+            self.next_replication_due_utc_dt = local_str_to_utc(
+                conf_read.get("next_replication_due_datetime")
+            )
+        # Forgets postponed by the peak hours (of bkp_include / of path groups)
+        self.next_forget_due_utc_dt = None
+        if conf_read.get("next_forget_due_datetime") is not None:
+            self.next_forget_due_utc_dt = local_str_to_utc(
+                conf_read.get("next_forget_due_datetime")
+            )
+        self.next_group_forget_utc_dts = {
+            name: local_str_to_utc(local_str)
+            for name, local_str in conf_read.get(
+                "next_group_forget_datetimes", {}
+            ).items()
+        }
+        # Truncated snapshots (of a failed stream command) to forget
+        self.truncated_snapshot_ids = conf_read.get("truncated_snapshot_ids", [])
+        if self.interrupted_operation is not None:
+            # Resume it as soon as possible
+            self.next_backup_due_utc_dt = now_utc_dt
 
     def _save(self):
         prev_backup_chronos = []
@@ -99,13 +258,57 @@ class State:
                 {
                     "current_operation": self.current_operation.value,
                     "current_status": self.current_status.value,
+                    "interrupted_operation": (
+                        None
+                        if self.interrupted_operation is None
+                        else [
+                            self.interrupted_operation[0].value,
+                            self.interrupted_operation[1],
+                        ]
+                    ),
                     "last_check_new_version_datetime": utc_to_local_str(
                         self.last_check_new_version_utc_dt
                     ),
+                    "last_shutdown_datetime": (
+                        None
+                        if self.last_shutdown_utc_dt is None
+                        else utc_to_local_str(self.last_shutdown_utc_dt)
+                    ),
+                    "last_shutdown_seconds": self.last_shutdown_seconds,
+                    "last_replicated_snapshot_datetime": (
+                        None
+                        if self.last_replicated_snapshot_utc_dt is None
+                        else utc_to_local_str(self.last_replicated_snapshot_utc_dt)
+                    ),
                     "latest_version_available": self.latest_version_available,
                     "nb_backups_before_forget": self.nb_backups_before_forget,
+                    "nb_group_backups_before_forget": (
+                        self.nb_group_backups_before_forget
+                    ),
+                    "nb_staged_snapshots": self.nb_staged_snapshots,
+                    "next_backup_due_datetime": utc_to_local_str(
+                        self.next_backup_due_utc_dt
+                    ),
+                    "next_forget_due_datetime": (
+                        None
+                        if self.next_forget_due_utc_dt is None
+                        else utc_to_local_str(self.next_forget_due_utc_dt)
+                    ),
+                    "next_group_forget_datetimes": {
+                        name: utc_to_local_str(utc_dt)
+                        for name, utc_dt in self.next_group_forget_utc_dts.items()
+                    },
+                    "next_replication_due_datetime": utc_to_local_str(
+                        self.next_replication_due_utc_dt
+                    ),
+                    "next_group_backup_datetimes": {
+                        name: utc_to_local_str(utc_dt)
+                        for name, utc_dt in self.next_group_backup_utc_dts.items()
+                    },
                     "prev_backup_chronos": prev_backup_chronos,
                     "prev_forget_chronos": prev_forget_chronos,
+                    "release_check_cache": self.release_check_cache,
+                    "truncated_snapshot_ids": self.truncated_snapshot_ids,
                     "version": __version__,
                 },
                 fh,
@@ -153,7 +356,10 @@ class State:
                         if self.version_need_upgrade()
                         else f"{const.ICONS_FOLDER}/error.png"
                     )
-            elif self.current_status == Status.LAST_OPERATION_FAILED:
+            elif self.current_status in (
+                Status.LAST_OPERATION_FAILED,
+                Status.STALLED,
+            ):
                 return (
                     f"{const.ICONS_FOLDER}/error_badge.png"
                     if self.version_need_upgrade()
@@ -179,13 +385,31 @@ class State:
                     if self.version_need_upgrade()
                     else f"{const.ICONS_FOLDER}/just_launched.png"
                 )
-        elif self.current_operation == CurrentOperation.INIT_IN_PROGRESS:
+        elif self.current_operation in (
+            CurrentOperation.INIT_IN_PROGRESS,
+            CurrentOperation.INIT_STAGING_IN_PROGRESS,
+        ):
             return f"{const.ICONS_FOLDER}/repo_locked.png"
         elif self.current_operation == CurrentOperation.PRE_BACKUP_IN_PROGRESS:
             return f"{const.ICONS_FOLDER}/pre_backup_in_progress.png"
-        elif self.current_operation == CurrentOperation.BACKUP_IN_PROGRESS:
+        elif self.current_operation in (
+            CurrentOperation.ESTIMATE_IN_PROGRESS,
+            CurrentOperation.BACKUP_IN_PROGRESS,
+            CurrentOperation.STREAM_BACKUP_IN_PROGRESS,
+            CurrentOperation.GROUP_BACKUP_IN_PROGRESS,
+            CurrentOperation.STAGE_BACKUP_IN_PROGRESS,
+        ):
             return f"{const.ICONS_FOLDER}/backup_in_progress.png"
-        elif self.current_operation == CurrentOperation.FORGET_IN_PROGRESS:
+        elif self.current_operation in (
+            CurrentOperation.FORGET_IN_PROGRESS,
+            CurrentOperation.FORGET_SNAPSHOT_IN_PROGRESS,
+            CurrentOperation.REPLICATE_IN_PROGRESS,
+            CurrentOperation.UPLOAD_STAGED_IN_PROGRESS,
+            CurrentOperation.PRUNE_STAGING_IN_PROGRESS,
+            CurrentOperation.SYNC_CATALOG_IN_PROGRESS,
+            CurrentOperation.INDEX_FILES_IN_PROGRESS,
+            CurrentOperation.STATS_IN_PROGRESS,
+        ):
             return f"{const.ICONS_FOLDER}/forget_in_progress.png"
         elif self.current_operation == CurrentOperation.UNLOCK_IN_PROGRESS:
             return f"{const.ICONS_FOLDER}/unlock_in_progress.png"
@@ -199,20 +423,407 @@ class State:
                 else f"{const.ICONS_FOLDER}/just_launched.png"
             )
 
+    def in_peak_hours(self, utc_dt=None):
+        """
+        Answer if utc_dt (default now) is within the peak hours
+        """
+        if utc_dt is None:
+            utc_dt = datetime.datetime.utcnow()
+        return find_window(self.app.conf.peak_hours, utc_to_local(utc_dt)) is not None
+
+    def in_quiet_hours(self, utc_dt=None):
+        """
+        Answer if utc_dt (default now) is within the quiet hours
+        """
+        if utc_dt is None:
+            utc_dt = datetime.datetime.utcnow()
+        return find_window(self.app.conf.quiet_hours, utc_to_local(utc_dt)) is not None
+
+    def _end_of_windows_utc_dt(self, windows, utc_dt):
+        """
+        return the first time from utc_dt outside of windows, None if never
+        """
+        local_dt = end_of_windows(windows, utc_to_local(utc_dt))
+        return None if local_dt is None else local_to_utc(local_dt)
+
+    def end_of_peak_hours_utc_dt(self):
+        """
+        return when the current peak hours are over
+        (at most MAX_FORGET_POSTPONEMENT_HOURS from now)
+        """
+        now_utc_dt = datetime.datetime.utcnow()
+        max_utc_dt = now_utc_dt + datetime.timedelta(
+            hours=const.MAX_FORGET_POSTPONEMENT_HOURS
+        )
+        end_utc_dt = self._end_of_windows_utc_dt(self.app.conf.peak_hours, now_utc_dt)
+        if end_utc_dt is None:
+            return max_utc_dt
+        return min(end_utc_dt, max_utc_dt)
+
+    def bandwidth_profile(self, utc_dt=None):
+        """
+        return the bandwidth profile applying at utc_dt (default now)
+        None if there is none
+        """
+        if utc_dt is None:
+            utc_dt = datetime.datetime.utcnow()
+        return find_window(self.app.conf.bandwidth_profiles, utc_to_local(utc_dt))
+
+    def in_off_peak(self, utc_dt=None):
+        """
+        Answer if utc_dt (default now) is within the off-peak windows
+        of backup_estimation (outside of the peak hours if there are none)
+        """
+        if utc_dt is None:
+            utc_dt = datetime.datetime.utcnow()
+        off_peak = self.app.conf.backup_estimation.get("off_peak")
+        if off_peak is None:
+            return not self.in_peak_hours(utc_dt)
+        return find_window(off_peak, utc_to_local(utc_dt)) is not None
+
+    def next_off_peak_utc_dt(self):
+        """
+        return when the next off-peak window starts, None if never
+        """
+        windows = self.app.conf.backup_estimation.get("off_peak")
+        if windows is None:
+            windows = self.app.conf.peak_hours
+        local_dt = utc_to_local(datetime.datetime.utcnow())
+        # Overlapping windows may start / end without changing anything :
+        # look at every start / end within next_change's horizon (8 days)
+        for _ in range(2 * 8 * len(windows)):
+            local_dt = next_change(windows, local_dt)
+            if local_dt is None:
+                return None
+            if self.in_off_peak(local_to_utc(local_dt)):
+                return local_to_utc(local_dt)
+        return None
+
+    def estimation_is_due(self):
+        """
+        Answer if the volume of the due backup has to be estimated first
+        (see backup_estimation in README) :
+        + not in an off-peak window, where any volume is fine
+        + the last successful backup isn't older than max_age_hours
+          (then it's run whatever its volume)
+        """
+        estimation = self.app.conf.backup_estimation
+        if not estimation or self.in_off_peak():
+            return False
+        max_age_hours = estimation.get("max_age_hours")
+        if max_age_hours is None:
+            return True
+        if len(self.prev_backup_chronos) == 0:
+            return False
+        return datetime.datetime.utcnow() - self.prev_backup_chronos[0][
+            0
+        ] < datetime.timedelta(hours=max_age_hours)
+
+    def jittered_start(self, after_utc_dt):
+        """
+        return when to start an operation not before after_utc_dt
+        so that many hosts don't start at the same time :
+        the first slot of this host's phase within the jitter window
+        (larger during peak hours), after the quiet hours
+        """
+        if self.in_quiet_hours(after_utc_dt):
+            end_utc_dt = self._end_of_windows_utc_dt(
+                self.app.conf.quiet_hours, after_utc_dt
+            )
+            if end_utc_dt is not None:
+                after_utc_dt = end_utc_dt
+        if self.in_peak_hours(after_utc_dt):
+            window_minutes = self.app.conf.peak_start_jitter_window_minutes
+        else:
+            window_minutes = self.app.conf.start_jitter_window_minutes
+        if window_minutes <= 0:
+            return after_utc_dt
+        period_seconds = window_minutes * 60
+        return next_phase_slot(
+            after_utc_dt, period_seconds, host_phase_seconds(period_seconds)
+        )
+
+    def backup_is_due(self):
+        """
+        Answer if it's time to attempt a backup (of bkp_include or of a path group),
+        a scheduled replication or a forget postponed by the peak hours
+        """
+        return (
+            datetime.datetime.utcnow() >= self.next_backup_due_utc_dt
+            or len(self.due_groups()) > 0
+            or self.replication_is_due()
+            or len(self.due_forgets()) > 0
+        )
+
+    def replication_is_due(self):
+        """
+        Answer if the replication has its own schedule, and it's due
+        (otherwise it follows every backup)
+        """
+        replication = self.app.conf.replication
+        return (
+            bool(replication)
+            and replication.get("every_n_minutes") is not None
+            and datetime.datetime.utcnow() >= self.next_replication_due_utc_dt
+        )
+
+    def due_groups(self):
+        """
+        return the names of the path groups whose backup is due
+        """
+        now_utc_dt = datetime.datetime.utcnow()
+        return [
+            name
+            for name, utc_dt in self.next_group_backup_utc_dts.items()
+            if now_utc_dt >= utc_dt
+        ]
+
+    def due_forgets(self):
+        """
+        return the targets (None : bkp_include, or a path group name)
+        whose forget postponed by the peak hours is due
+        """
+        now_utc_dt = datetime.datetime.utcnow()
+        targets = [
+            name
+            for name, utc_dt in self.next_group_forget_utc_dts.items()
+            if now_utc_dt >= utc_dt
+        ]
+        if (
+            self.next_forget_due_utc_dt is not None
+            and now_utc_dt >= self.next_forget_due_utc_dt
+        ):
+            targets.insert(0, None)
+        return targets
+
+    def _postpone_forget_after_peak_hours(self, target):
+        """
+        Peak hours : the forget of target (None : bkp_include, or a path group)
+        is due once they are over
+        """
+        due_utc_dt = self.jittered_start(self.end_of_peak_hours_utc_dt())
+        if target is None:
+            self.next_forget_due_utc_dt = due_utc_dt
+            what = "forget"
+        else:
+            self.next_group_forget_utc_dts[target] = due_utc_dt
+            what = f"forget of group '{target}'"
+        self.app.logger.write(
+            f"Peak hours -> {what} postponed to {utc_to_local_str(due_utc_dt)}"
+        )
+
+    def postpone_due(self, utc_dt):
+        """
+        Whatever is due before utc_dt is due at utc_dt instead
+        """
+        self.next_backup_due_utc_dt = max(self.next_backup_due_utc_dt, utc_dt)
+        for name, due_utc_dt in self.next_group_backup_utc_dts.items():
+            self.next_group_backup_utc_dts[name] = max(due_utc_dt, utc_dt)
+        self.next_replication_due_utc_dt = max(self.next_replication_due_utc_dt, utc_dt)
+        if self.next_forget_due_utc_dt is not None:
+            self.next_forget_due_utc_dt = max(self.next_forget_due_utc_dt, utc_dt)
+        for name, due_utc_dt in self.next_group_forget_utc_dts.items():
+            self.next_group_forget_utc_dts[name] = max(due_utc_dt, utc_dt)
+
+    def _retry_delay(self, interval_minutes):
+        return datetime.timedelta(
+            minutes=min(interval_minutes, const.BACKUP_RETRY_DELAY_MINUTES)
+        )
+
+    def schedule_backup_retry(self):
+        """
+        The backup starting now is due again soon, until it succeeds
+        """
+        self.next_backup_due_utc_dt = self.jittered_start(
+            datetime.datetime.utcnow()
+            + self._retry_delay(self.app.conf.backup_every_n_minutes)
+        )
+
+    def schedule_next_backup(self):
+        """
+        Next backup is due one interval from now
+        """
+        self.next_backup_due_utc_dt = self.jittered_start(
+            datetime.datetime.utcnow()
+            + datetime.timedelta(minutes=self.app.conf.backup_every_n_minutes)
+        )
+
+    def _group_interval(self, group):
+        return group.get("every_n_minutes", self.app.conf.backup_every_n_minutes)
+
+    def schedule_next_group_backup(self, name):
+        """
+        Next backup of path group name is due one of its intervals from now
+        """
+        group = get_path_group(self.app.conf, name)
+        if group is None:
+            return
+        self.next_group_backup_utc_dts[name] = self.jittered_start(
+            datetime.datetime.utcnow()
+            + datetime.timedelta(minutes=self._group_interval(group))
+        )
+
+    def schedule_group_backup_retry(self, name):
+        """
+        The backup of path group name starting now is due again soon,
+        until it succeeds
+        """
+        group = get_path_group(self.app.conf, name)
+        if group is None:
+            return
+        self.next_group_backup_utc_dts[name] = self.jittered_start(
+            datetime.datetime.utcnow() + self._retry_delay(self._group_interval(group))
+        )
+
+    def schedule_due_backups(self):
+        """
+        Skip the backups due now : they are due again one interval from now
+        """
+        if datetime.datetime.utcnow() >= self.next_backup_due_utc_dt:
+            self.schedule_next_backup()
+        for name in self.due_groups():
+            self.schedule_next_group_backup(name)
+        if self.replication_is_due():
+            self.schedule_next_replication()
+
+    def schedule_next_replication(self):
+        self.next_replication_due_utc_dt = self.jittered_start(
+            datetime.datetime.utcnow()
+            + datetime.timedelta(minutes=self.app.conf.replication["every_n_minutes"])
+        )
+
+    def postpone_forget(self, target):
+        """
+        The forget of target (None : bkp_include, or a path group) couldn't run,
+        try again after next backup
+        """
+        if target is None:
+            self.nb_backups_before_forget = 0
+        else:
+            self.nb_group_backups_before_forget[target] = 0
+
+    def stats_are_due(self, max_age):
+        """
+        Answer if the repository size was measured more than max_age ago
+        """
+        last_stats_utc_dt = self.app.history.last_repo_stats_utc_dt()
+        return (
+            last_stats_utc_dt is None
+            or datetime.datetime.utcnow() - last_stats_utc_dt >= max_age
+        )
+
+    def _queue_target_forget(self, target):
+        """
+        Queue the forget of target (None : bkp_include, or a path group)
+        and start counting the backups until the next one
+        """
+        if target is None:
+            self.next_forget_due_utc_dt = None
+            self.nb_backups_before_forget = self.app.conf.forget_every_n_backups
+            self._queue_forget()
+            return
+        self.next_group_forget_utc_dts.pop(target, None)
+        group = get_path_group(self.app.conf, target)
+        if group is None:
+            return
+        self.nb_group_backups_before_forget[target] = group.get(
+            "forget_every_n_backups", self.app.conf.forget_every_n_backups
+        )
+        self.queue.append((Operation.FORGET, target))
+
+    def _queue_forget(self):
+        """
+        Queue a forget, with the repository size measured around it
+        to know what the prune freed
+        """
+        if self.stats_are_due(
+            datetime.timedelta(minutes=const.STATS_BEFORE_PRUNE_MAX_AGE_MINUTES)
+        ):
+            self.queue.append((Operation.STATS, "before_prune"))
+        self.queue.append((Operation.FORGET, None))
+        self.queue.append((Operation.STATS, "after_prune"))
+
+    def _queue_interrupted_operation(self):
+        """
+        Move the operation interrupted by last shutdown first in the queue
+        (after the pre-backup hook, which prepares the data)
+        """
+        interrupted_operation = self.interrupted_operation
+        self.interrupted_operation = None
+        self.app.logger.write(
+            f"Retrying {interrupted_operation[0].value} first, "
+            "interrupted by last shutdown"
+        )
+        if interrupted_operation in self.queue:
+            self.queue.remove(interrupted_operation)
+        position = 0
+        if len(self.queue) > 0 and self.queue[0][0] == Operation.PRE_BACKUP:
+            position = 1
+        self.queue.insert(position, interrupted_operation)
+
     def want_to_backup(self):
         """
         + Answer if a backup/forget can be run now
         + Set self.queue if possible
+          (starting with the operation interrupted by last shutdown, if any) :
+          the backup of bkp_include (and stream sources) if it's due,
+          then the backups of the path groups due, then the replication if due,
+          then the forgets postponed by the peak hours if due.
+          Asked to run while nothing is due (--run-once), bkp_include is backed up
+        + Set when the backups started are due again if they don't succeed
+
+        Each queue entry is a tuple (Operation, target)
+        where target is None or the name of what the operation applies to
+        (e.g. the stream source of a STREAM_BACKUP)
         """
+        now_utc_dt = datetime.datetime.utcnow()
+        due_groups = self.due_groups()
+        replication_is_due = self.replication_is_due()
+        due_forgets = self.due_forgets()
+        main_is_due = now_utc_dt >= self.next_backup_due_utc_dt
+        if (
+            not main_is_due
+            and len(due_groups) == 0
+            and not replication_is_due
+            and len(due_forgets) == 0
+        ):
+            main_is_due = True
+        # One interval after they succeed (see finished_restic_cmd)
+        if main_is_due:
+            self.schedule_backup_retry()
+        for name in due_groups:
+            self.schedule_group_backup_retry(name)
+        if replication_is_due:
+            self.schedule_next_replication()
         if self.current_operation in (
             CurrentOperation.IDLE,
             CurrentOperation.JUST_LAUNCHED,
         ):
-            pre_backup_hook_is_executable = os.access(const.PRE_BACKUP_HOOK, os.X_OK)
-            if pre_backup_hook_is_executable:
-                self.queue = [Operation.PRE_BACKUP, Operation.BACKUP]
-            else:
-                self.queue = [Operation.BACKUP]
+            self.queue = []
+            # With path groups, bkp_include may list nothing
+            if main_is_due and (
+                len(self.app.conf.path_groups) == 0 or files_from_paths() != []
+            ):
+                pre_backup_hook_is_executable = os.access(
+                    const.PRE_BACKUP_HOOK, os.X_OK
+                )
+                if pre_backup_hook_is_executable:
+                    self.queue.append((Operation.PRE_BACKUP, None))
+                # A retried backup isn't estimated again
+                if self.interrupted_operation is None and self.estimation_is_due():
+                    self.queue.append((Operation.ESTIMATE, None))
+                self.queue.append((Operation.BACKUP, None))
+            if main_is_due:
+                for stream_source in self.app.conf.stream_sources:
+                    self.queue.append((Operation.STREAM_BACKUP, stream_source["name"]))
+            for name in due_groups:
+                self.queue.append((Operation.GROUP_BACKUP, name))
+            if replication_is_due:
+                self.queue.append((Operation.REPLICATE, None))
+            for target in due_forgets:
+                self._queue_target_forget(target)
+            if self.interrupted_operation is not None:
+                self._queue_interrupted_operation()
             return True
         else:
             return False
@@ -220,32 +831,118 @@ class State:
     def next_operation(self):
         """
         + return next Operation from self.queue
-        + set self.current_operation accordingly
+        + set self.current_operation and self.current_target accordingly
         + return None if nothing in the queue
         """
         if len(self.queue) > 0:
-            operation = self.queue.pop(0)
+            operation, self.current_target = self.queue.pop(0)
             if operation == Operation.INIT:
                 self.current_operation = CurrentOperation.INIT_IN_PROGRESS
             elif operation == Operation.PRE_BACKUP:
                 self.current_operation = CurrentOperation.PRE_BACKUP_IN_PROGRESS
                 self.pre_backup_failed = False
+            elif operation == Operation.ESTIMATE:
+                self.current_operation = CurrentOperation.ESTIMATE_IN_PROGRESS
             elif operation == Operation.BACKUP:
                 self.current_operation = CurrentOperation.BACKUP_IN_PROGRESS
+            elif operation == Operation.STREAM_BACKUP:
+                self.current_operation = CurrentOperation.STREAM_BACKUP_IN_PROGRESS
+            elif operation == Operation.GROUP_BACKUP:
+                self.current_operation = CurrentOperation.GROUP_BACKUP_IN_PROGRESS
+            elif operation == Operation.REPLICATE:
+                self.current_operation = CurrentOperation.REPLICATE_IN_PROGRESS
+            elif operation == Operation.INIT_STAGING:
+                self.current_operation = CurrentOperation.INIT_STAGING_IN_PROGRESS
+            elif operation == Operation.STAGE_BACKUP:
+                self.current_operation = CurrentOperation.STAGE_BACKUP_IN_PROGRESS
+            elif operation == Operation.UPLOAD_STAGED:
+                self.current_operation = CurrentOperation.UPLOAD_STAGED_IN_PROGRESS
+            elif operation == Operation.PRUNE_STAGING:
+                self.current_operation = CurrentOperation.PRUNE_STAGING_IN_PROGRESS
             elif operation == Operation.FORGET:
                 self.current_operation = CurrentOperation.FORGET_IN_PROGRESS
+            elif operation == Operation.FORGET_SNAPSHOT:
+                self.current_operation = CurrentOperation.FORGET_SNAPSHOT_IN_PROGRESS
             elif operation == Operation.UNLOCK:
                 self.current_operation = CurrentOperation.UNLOCK_IN_PROGRESS
+            elif operation == Operation.SYNC_CATALOG:
+                self.current_operation = CurrentOperation.SYNC_CATALOG_IN_PROGRESS
+            elif operation == Operation.INDEX_FILES:
+                self.current_operation = CurrentOperation.INDEX_FILES_IN_PROGRESS
+            elif operation == Operation.STATS:
+                self.current_operation = CurrentOperation.STATS_IN_PROGRESS
             else:
                 self.app.logger.error(
                     f"unexpected Operation: operation.value={operation.value} -> skipping"
                 )
                 return self.next_operation()
-
-            return operation
         else:
             self.current_operation = CurrentOperation.IDLE
-            return None
+            self.current_target = None
+            operation = None
+        # `enacrestic restore` reads the current operation from the state file
+        self._save()
+        return operation
+
+    def _group_backup_done(self, name):
+        """
+        Schedule the next backup of path group name,
+        and queue its forget if needed
+        """
+        group = get_path_group(self.app.conf, name)
+        if group is None:
+            return
+        self.schedule_next_group_backup(name)
+        self.nb_group_backups_before_forget[name] = (
+            self.nb_group_backups_before_forget.get(name, 0) - 1
+        )
+        if self.nb_group_backups_before_forget[name] > 0:
+            return
+        if self.in_peak_hours():
+            if name not in self.next_group_forget_utc_dts:
+                self._postpone_forget_after_peak_hours(name)
+            return
+        self._queue_target_forget(name)
+
+    def forget_truncated_snapshot(self, snapshot_id):
+        """
+        restic saved a snapshot of a stream whose command failed :
+        forget it first (until done, again after each backup)
+        """
+        if snapshot_id not in self.truncated_snapshot_ids:
+            self.truncated_snapshot_ids.append(snapshot_id)
+        self.queue.insert(0, (Operation.FORGET_SNAPSHOT, snapshot_id))
+
+    def _queue_truncated_snapshots_forget(self):
+        for snapshot_id in self.truncated_snapshot_ids:
+            if (Operation.FORGET_SNAPSHOT, snapshot_id) not in self.queue:
+                self.queue.append((Operation.FORGET_SNAPSHOT, snapshot_id))
+
+    def _queue_staging_maintenance(self):
+        """
+        The repository is reachable :
+        + copy the staged snapshots to it, if any
+        + or create the staging repository, if not done yet
+        """
+        if not self.app.conf.offline_staging:
+            return
+        if self.nb_staged_snapshots > 0:
+            self.queue.append((Operation.UPLOAD_STAGED, None))
+        elif not staging_is_initialized(self.app.conf):
+            self.queue.append((Operation.INIT_STAGING, None))
+
+    def _queue_replication_after_backup(self):
+        """
+        Without its own schedule, the replication follows the backups
+        (once, after all the ones queued)
+        """
+        replication = self.app.conf.replication
+        if (
+            replication
+            and replication.get("every_n_minutes") is None
+            and (Operation.REPLICATE, None) not in self.queue
+        ):
+            self.queue.append((Operation.REPLICATE, None))
 
     def finished_restic_cmd(
         self, completion_status, start_utc_dt, chrono, queue_repo_unlock
@@ -253,7 +950,13 @@ class State:
         """
         + when success:
           + save chrono for current operation (backup or forget)
+          + the next backup is due one interval from now
           + queue a forget if needed
+          + or a sync of the snapshot catalog / repository stats if needed
+          + index the files of new snapshots when nothing else is queued
+          + queue the replication after a backup (unless it has its own schedule)
+          + queue the upload of the staged snapshots after a backup
+        + when the repository is unreachable, back up to the staging repository
         + otherwise:
           + empty queue
           + set self.last_failed_utc_dt
@@ -263,23 +966,67 @@ class State:
         if completion_status == Status.OK:
             chrono_seconds = round(chrono.total_seconds(), 2)  # Keep only 2 digits
             if self.current_operation == CurrentOperation.BACKUP_IN_PROGRESS:
+                self.schedule_next_backup()
                 self.nb_backups_before_forget -= 1
                 if self.nb_backups_before_forget <= 0:
-                    self.nb_backups_before_forget = self.app.conf.forget_every_n_backups
-                    self.queue.append(Operation.FORGET)
+                    if self.in_peak_hours():
+                        if self.next_forget_due_utc_dt is None:
+                            self._postpone_forget_after_peak_hours(None)
+                    else:
+                        self._queue_target_forget(None)
+                if (Operation.FORGET, None) not in self.queue:
+                    # forget output updates the snapshot catalog as well
+                    if self.app.catalog.sync_is_due():
+                        self.queue.append((Operation.SYNC_CATALOG, None))
+                    if self.stats_are_due(
+                        datetime.timedelta(hours=const.STATS_EVERY_N_HOURS)
+                    ):
+                        self.queue.append((Operation.STATS, "periodic"))
                 self.prev_backup_chronos.insert(0, (start_utc_dt, chrono_seconds))
                 if len(self.prev_backup_chronos) > const.NB_CHRONOS_TO_SAVE:
                     self.prev_backup_chronos.pop()
+                self._queue_truncated_snapshots_forget()
+                self._queue_staging_maintenance()
+            elif self.current_operation == CurrentOperation.STAGE_BACKUP_IN_PROGRESS:
+                # Backed up (locally) : no retry before next interval
+                self.schedule_next_backup()
+                self.nb_staged_snapshots += 1
+            elif self.current_operation == CurrentOperation.UPLOAD_STAGED_IN_PROGRESS:
+                self.nb_staged_snapshots = 0
+                self.queue.append((Operation.PRUNE_STAGING, None))
+                # The copied snapshots get new IDs in the repository :
+                # sync the catalog, then replicate them (from the catalog)
+                if (Operation.SYNC_CATALOG, None) in self.queue:
+                    self.queue.remove((Operation.SYNC_CATALOG, None))
+                self.queue.append((Operation.SYNC_CATALOG, None))
+                if (Operation.REPLICATE, None) in self.queue:
+                    self.queue.remove((Operation.REPLICATE, None))
+                    self.queue.append((Operation.REPLICATE, None))
+            elif self.current_operation == CurrentOperation.GROUP_BACKUP_IN_PROGRESS:
+                self._group_backup_done(self.current_target)
+            elif self.current_operation == CurrentOperation.FORGET_SNAPSHOT_IN_PROGRESS:
+                if self.current_target in self.truncated_snapshot_ids:
+                    self.truncated_snapshot_ids.remove(self.current_target)
             elif self.current_operation == CurrentOperation.FORGET_IN_PROGRESS:
                 self.prev_forget_chronos.insert(0, (start_utc_dt, chrono_seconds))
                 if len(self.prev_forget_chronos) > const.NB_CHRONOS_TO_SAVE:
                     self.prev_forget_chronos.pop()
+            if self.current_operation in (
+                CurrentOperation.BACKUP_IN_PROGRESS,
+                CurrentOperation.STREAM_BACKUP_IN_PROGRESS,
+                CurrentOperation.GROUP_BACKUP_IN_PROGRESS,
+                CurrentOperation.UPLOAD_STAGED_IN_PROGRESS,
+            ):
+                self._queue_replication_after_backup()
         elif completion_status == Status.REPO_LOCKED:
             self.last_failed_utc_dt = datetime.datetime.utcnow()
+            if self.current_operation == CurrentOperation.UNLOCK_IN_PROGRESS:
+                # Lock is still held -> don't retry before next backup
+                self.queue = []
         elif completion_status == Status.REPO_NOT_INITIALIZED:
             if len(self.prev_backup_chronos) == 0:
                 self.app.logger.write("Repo needs to be initialized")
-                self.queue = [Operation.INIT, Operation.BACKUP]
+                self.queue = [(Operation.INIT, None), (Operation.BACKUP, None)]
             else:
                 self.app.logger.error(
                     "Repo not initialized but previous backups found -> not going to init the repo."
@@ -289,19 +1036,84 @@ class State:
         else:
             if self.current_operation == CurrentOperation.PRE_BACKUP_IN_PROGRESS:
                 self.pre_backup_failed = True
+            elif (
+                self.current_operation == CurrentOperation.ESTIMATE_IN_PROGRESS
+                and completion_status == Status.LAST_OPERATION_FAILED
+            ):
+                # e.g. restic older than 0.13 (no --dry-run)
+                self.app.logger.write("Estimation failed -> backing up anyway")
+            elif (
+                # The estimate (--dry-run) is the first to reach the repository
+                self.current_operation
+                in (
+                    CurrentOperation.ESTIMATE_IN_PROGRESS,
+                    CurrentOperation.BACKUP_IN_PROGRESS,
+                )
+                and completion_status == Status.NO_NETWORK
+                and self.app.conf.offline_staging
+            ):
+                self.last_failed_utc_dt = datetime.datetime.utcnow()
+                self.queue = []
+                if staging_is_initialized(self.app.conf):
+                    self.app.logger.write(
+                        "Repository unreachable -> backing up to the staging repository"
+                    )
+                    self.queue.append((Operation.STAGE_BACKUP, None))
+                else:
+                    self.app.logger.error(
+                        "Repository unreachable and staging repository not "
+                        "initialized yet (done once the repository is reachable)"
+                    )
             else:
-                # Don't do more things yet if NO_NETWORK or LAST_OPERATION_FAILED
+                # Don't do more things yet if NO_NETWORK, LAST_OPERATION_FAILED
+                # or STALLED. Next backup starts afresh
                 self.last_failed_utc_dt = datetime.datetime.utcnow()
                 self.queue = []
 
         if queue_repo_unlock:
-            if self.current_operation == CurrentOperation.BACKUP_IN_PROGRESS:
-                self.queue.insert(0, Operation.BACKUP)
+            if self.current_operation == CurrentOperation.ESTIMATE_IN_PROGRESS:
+                self.queue.insert(0, (Operation.ESTIMATE, self.current_target))
+            elif self.current_operation == CurrentOperation.BACKUP_IN_PROGRESS:
+                self.queue.insert(0, (Operation.BACKUP, self.current_target))
+            elif self.current_operation == CurrentOperation.STREAM_BACKUP_IN_PROGRESS:
+                self.queue.insert(0, (Operation.STREAM_BACKUP, self.current_target))
+            elif self.current_operation == CurrentOperation.GROUP_BACKUP_IN_PROGRESS:
+                self.queue.insert(0, (Operation.GROUP_BACKUP, self.current_target))
             elif self.current_operation == CurrentOperation.FORGET_IN_PROGRESS:
-                self.queue.insert(0, Operation.FORGET)
-            self.queue.insert(0, Operation.UNLOCK)
+                self.queue.insert(0, (Operation.FORGET, self.current_target))
+            elif self.current_operation == CurrentOperation.FORGET_SNAPSHOT_IN_PROGRESS:
+                self.queue.insert(0, (Operation.FORGET_SNAPSHOT, self.current_target))
+            self.queue.insert(0, (Operation.UNLOCK, None))
 
-        self.current_status = completion_status
+        # Once everything else is done, index the files of new snapshots
+        if (
+            completion_status == Status.OK
+            and len(self.queue) == 0
+            and self.current_operation
+            not in (
+                CurrentOperation.INDEX_FILES_IN_PROGRESS,
+                CurrentOperation.STAGE_BACKUP_IN_PROGRESS,
+            )
+            and self.app.file_index is not None
+        ):
+            for snapshot_id in self.app.file_index.snapshots_to_index(
+                self.app.catalog, const.FILE_INDEX_MAX_SNAPSHOTS_PER_RUN
+            ):
+                self.queue.append((Operation.INDEX_FILES, snapshot_id))
+
+        # The stream backup a forget of a truncated snapshot cleans up still failed
+        if not (
+            completion_status == Status.OK
+            and self.current_operation == CurrentOperation.FORGET_SNAPSHOT_IN_PROGRESS
+        ):
+            self.current_status = completion_status
+        if (
+            completion_status == Status.OK
+            and self.current_operation == CurrentOperation.STAGE_BACKUP_IN_PROGRESS
+        ):
+            # Backed up, but only locally : the repository is still unreachable
+            self.current_status = Status.NO_NETWORK
+        self._save()
 
     def empty_queue(self):
         """
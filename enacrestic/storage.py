@@ -0,0 +1,245 @@
+"""
+Storage behind the paths to back up, to choose restic's read concurrency
+(how many files it reads at once) :
+
++ classify the device of each path : nvme, ssd, hdd (/sys/block/*/queue/rotational),
+  or network (NFS, SMB, sshfs... from the mount type)
++ start from the read concurrency of the slowest class of bkp_include
+  (READ_CONCURRENCY_PER_STORAGE) : a spinning disk seeks between
+  concurrent reads, an NVMe drive is only busy with many of them,
+  a network share waits for round trips unless many are in flight
++ refine it from the read throughput of past backups on the same storage class
+  (bytes read from the storage over restic's read phase, until all files
+  are processed : not the upload of the last packs, nor the index) :
+  hill-climbing to the neighbour value (x2, /2) reading faster,
+  each value being tried READ_CONCURRENCY_MIN_RUNS times
+"""
+
+import collections
+import os
+import statistics
+
+from enacrestic import const
+from enacrestic.state import Status
+
+MOUNTINFO = "/proc/self/mountinfo"
+SYS_FOLDER = "/sys"
+
+NETWORK_FILESYSTEMS = (
+    "nfs",
+    "nfs4",
+    "cifs",
+    "smb3",
+    "smbfs",
+    "9p",
+    "afs",
+    "ceph",
+    "glusterfs",
+    "lustre",
+    "davfs",
+    "fuse.sshfs",
+    "fuse.rclone",
+)
+
+# From the slowest (fewest concurrent reads) to the fastest
+STORAGE_CLASSES = ("hdd", "network", "ssd", "nvme")
+
+
+def _read(path):
+    try:
+        with open(path, "r") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def _unescape(field):
+    """
+    mountinfo escapes spaces, tabs, newlines and backslashes as \\ooo
+    """
+    for code in ("040", "011", "012", "134"):
+        field = field.replace(f"\\{code}", chr(int(code, 8)))
+    return field
+
+
+def read_mounts(mountinfo=MOUNTINFO):
+    """
+    return [(mount point, filesystem type, "major:minor", source)]
+    """
+    mounts = []
+    try:
+        with open(mountinfo, "r") as f:
+            lines = f.readlines()
+    except OSError:
+        return mounts
+    for line in lines:
+        fields = line.split()
+        try:
+            separator = fields.index("-")
+            mounts.append(
+                (
+                    _unescape(fields[4]),
+                    fields[separator + 1],
+                    fields[2],
+                    _unescape(fields[separator + 2]),
+                )
+            )
+        except (ValueError, IndexError):
+            continue
+    return mounts
+
+
+def _mount_of(path, mounts):
+    """
+    return the mount path is on (the longest mount point containing it)
+    """
+    path = os.path.realpath(os.path.expanduser(path))
+    best = None
+    for mount in mounts:
+        mount_point = mount[0]
+        # The last one mounted on a mount point hides the previous ones
+        if (path == mount_point or path.startswith(mount_point.rstrip("/") + "/")) and (
+            best is None or len(mount_point) >= len(best[0])
+        ):
+            best = mount
+    return best
+
+
+def _device_class(device_folder, sys_folder=SYS_FOLDER, depth=0):
+    """
+    return the class of the block device of /sys/dev/block/<major:minor>
+    (or /sys/class/block/<name>), None if unknown
+    """
+    if not os.path.exists(device_folder) or depth > 4:
+        return None
+    folder = os.path.realpath(device_folder)
+    # A partition's queue is its disk's one
+    if os.path.exists(os.path.join(folder, "partition")):
+        folder = os.path.dirname(folder)
+    # device-mapper / md (LUKS, LVM, RAID) : as slow as its slowest device
+    try:
+        slaves = os.listdir(os.path.join(folder, "slaves"))
+    except OSError:
+        slaves = []
+    if len(slaves) > 0:
+        classes = [
+            _device_class(
+                os.path.join(sys_folder, "class", "block", slave),
+                sys_folder,
+                depth + 1,
+            )
+            for slave in slaves
+        ]
+        return slowest(classes)
+    rotational = _read(os.path.join(folder, "queue", "rotational"))
+    if rotational == "1":
+        return "hdd"
+    if os.path.basename(folder).startswith("nvme"):
+        return "nvme"
+    if rotational == "0":
+        return "ssd"
+    return None
+
+
+def classify_path(path, mounts=None, sys_folder=SYS_FOLDER):
+    """
+    return the storage class of path : nvme, ssd, hdd, network
+    or None if unknown (e.g. tmpfs, overlay)
+    """
+    if mounts is None:
+        mounts = read_mounts()
+    mount = _mount_of(path, mounts)
+    if mount is None:
+        return None
+    _, fs_type, device, source = mount
+    if fs_type in NETWORK_FILESYSTEMS:
+        return "network"
+    storage_class = _device_class(
+        os.path.join(sys_folder, "dev", "block", device), sys_folder
+    )
+    if storage_class is None and source.startswith("/dev/"):
+        # e.g. btrfs : anonymous major:minor, the source is the real device
+        try:
+            rdev = os.stat(source).st_rdev
+        except OSError:
+            return None
+        storage_class = _device_class(
+            os.path.join(
+                sys_folder, "dev", "block", f"{os.major(rdev)}:{os.minor(rdev)}"
+            ),
+            sys_folder,
+        )
+    return storage_class
+
+
+def slowest(storage_classes):
+    """
+    return the slowest of storage_classes (None ignored), None if none
+    """
+    known = [
+        storage_class for storage_class in storage_classes if storage_class is not None
+    ]
+    if len(known) == 0:
+        return None
+    return min(known, key=STORAGE_CLASSES.index)
+
+
+def classify_paths(paths):
+    """
+    return the storage class of the slowest of paths
+    (restic reads them all with the same concurrency)
+    """
+    mounts = read_mounts()
+    return slowest(classify_path(path, mounts) for path in paths)
+
+
+def read_throughputs(runs, storage_class):
+    """
+    return {read concurrency: [read throughput (bytes/s)]} of the past runs
+    on storage_class which read enough to tell, over their read phase
+    """
+    throughputs = collections.defaultdict(list)
+    for run in runs:
+        if (
+            run["status"] == Status.OK.value
+            and run.get("storage_class") == storage_class
+            and run.get("read_concurrency") is not None
+            and (run.get("read_bytes") or 0) >= const.READ_CONCURRENCY_MIN_READ_BYTES
+            and (run.get("read_seconds") or 0) > 0
+        ):
+            throughputs[run["read_concurrency"]].append(
+                run["read_bytes"] / run["read_seconds"]
+            )
+    return throughputs
+
+
+def choose_read_concurrency(storage_class, runs):
+    """
+    return the read concurrency for the next backup on storage_class
+    given the past runs (see module docstring)
+    """
+    current = const.READ_CONCURRENCY_PER_STORAGE.get(storage_class)
+    if current is None:
+        return None
+    throughputs = read_throughputs(runs, storage_class)
+
+    def _median(value):
+        return statistics.median(throughputs[value])
+
+    for _ in range(const.READ_CONCURRENCY_MAX):
+        if len(throughputs[current]) < const.READ_CONCURRENCY_MIN_RUNS:
+            return current
+        neighbours = [
+            value
+            for value in (current * 2, current // 2)
+            if const.READ_CONCURRENCY_MIN <= value <= const.READ_CONCURRENCY_MAX
+        ]
+        for value in neighbours:
+            if len(throughputs[value]) < const.READ_CONCURRENCY_MIN_RUNS:
+                # Not tried enough yet
+                return value
+        best = max([current] + neighbours, key=_median)
+        if best == current:
+            return current
+        current = best
+    return current
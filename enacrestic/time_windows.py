@@ -0,0 +1,96 @@
+"""
+Weekly calendar of time windows, as set in prefs.json :
+
+{"days": ["mon", "tue", "wed", "thu", "fri"], "start": "08:00", "end": "18:00"}
+
++ "days" is optional (every day by default)
++ "end" before "start" means the window ends the day after
++ times are in local time
+"""
+
+import datetime
+
+WEEKDAYS = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+
+
+def _minutes(hh_mm):
+    """
+    convert "HH:MM" to minutes since midnight
+    """
+    hours, minutes = hh_mm.split(":")
+    return int(hours) * 60 + int(minutes)
+
+
+def window_contains(window, local_dt):
+    """
+    return True if local_dt is inside window
+    """
+    days = [day.lower()[:3] for day in window.get("days", WEEKDAYS)]
+    start = _minutes(window["start"])
+    end = _minutes(window["end"])
+    minutes = local_dt.hour * 60 + local_dt.minute
+    today = WEEKDAYS[local_dt.weekday()]
+    yesterday = WEEKDAYS[(local_dt.weekday() - 1) % 7]
+    if start < end:
+        return today in days and start <= minutes < end
+    # Window spanning midnight, belongs to the day it starts
+    return (today in days and minutes >= start) or (yesterday in days and minutes < end)
+
+
+def find_window(windows, local_dt):
+    """
+    return the first window containing local_dt, None if there is none
+    """
+    for window in windows:
+        if window_contains(window, local_dt):
+            return window
+    return None
+
+
+def next_change(windows, local_dt):
+    """
+    return the first local datetime after local_dt
+    where a window starts or ends, None if there is no window
+    """
+    changes = []
+    for window in windows:
+        days = [day.lower()[:3] for day in window.get("days", WEEKDAYS)]
+        start = _minutes(window["start"])
+        end = _minutes(window["end"])
+        for nb_days in range(-1, 8):
+            day = datetime.datetime.combine(
+                local_dt.date() + datetime.timedelta(days=nb_days), datetime.time()
+            )
+            if WEEKDAYS[day.weekday()] not in days:
+                continue
+            changes.append(day + datetime.timedelta(minutes=start))
+            if end <= start:
+                day += datetime.timedelta(days=1)
+            changes.append(day + datetime.timedelta(minutes=end))
+    changes = [change for change in changes if change > local_dt]
+    return min(changes) if len(changes) > 0 else None
+
+
+def end_of_windows(windows, local_dt):
+    """
+    return the first local datetime from local_dt outside of every window
+    (local_dt itself if it already is), None if there is none
+    within next_change's horizon
+    """
+    # Overlapping windows may start / end without changing anything
+    for _ in range(2 * 8 * len(windows) + 1):
+        if find_window(windows, local_dt) is None:
+            return local_dt
+        local_dt = next_change(windows, local_dt)
+        if local_dt is None:
+            return None
+    return None
+
+
+def window_name(window):
+    """
+    return the name of a window ("start-end" if not named)
+    """
+    if window is None:
+        return None
+    return window.get("name", f"{window['start']}-{window['end']}")
@@ -0,0 +1,120 @@
+"""
+Spans of the operations and of their phases, written to a trace file
+in the Chrome trace-event format (open it in https://ui.perfetto.dev
+or chrome://tracing) when "trace_file" is set in prefs.json.
+
++ one span per operation, containing the spans of its phases :
+  preflight, spawn, open_repository, scan, upload, write_index, exit
+  (see ResticBackup._trace_phase), and save_state
++ spans are written when they end, one event per line
+  (the closing "]" is optional in this format, the file is always valid)
++ the file is rotated when it exceeds TRACE_FILE_MAX_BYTES
+
+Without trace_file, every call returns right away.
+"""
+
+import json
+import os
+import time
+
+from enacrestic import const
+
+
+class Tracer:
+    def __init__(self, path):
+        self.path = os.path.expanduser(path) if path else ""
+        self.enabled = self.path != ""
+        self.pid = os.getpid()
+        self.process_named = False
+
+    def begin(self, name, **args):
+        """
+        return a span starting now, to be given to end()
+        (None if tracing is off)
+        """
+        if not self.enabled:
+            return None
+        return {
+            "name": name,
+            "ts": time.time() * 1e6,
+            "start_monotonic": time.monotonic(),
+            "args": args,
+        }
+
+    def end(self, span, **args):
+        """
+        Write span, ending now, with args added to its begin() ones
+        """
+        if span is None:
+            return
+        span["args"].update(args)
+        self._write(
+            {
+                "name": span["name"],
+                "cat": "enacrestic",
+                "ph": "X",
+                "ts": round(span["ts"]),
+                "dur": round((time.monotonic() - span["start_monotonic"]) * 1e6),
+                "pid": self.pid,
+                "tid": self.pid,
+                "args": span["args"],
+            }
+        )
+
+    def instant(self, name, **args):
+        """
+        Write an event happening now (e.g. first output of a process)
+        """
+        if not self.enabled:
+            return
+        self._write(
+            {
+                "name": name,
+                "cat": "enacrestic",
+                "ph": "i",
+                "s": "t",
+                "ts": round(time.time() * 1e6),
+                "pid": self.pid,
+                "tid": self.pid,
+                "args": args,
+            }
+        )
+
+    def _rotate(self):
+        for i in range(const.TRACE_FILE_BACKUP_COUNT - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if const.TRACE_FILE_BACKUP_COUNT > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+
+    def _write(self, event):
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            size = 0
+        try:
+            if size > const.TRACE_FILE_MAX_BYTES:
+                self._rotate()
+                size = 0
+            with open(self.path, "a") as f:
+                if size == 0:
+                    f.write("[\n")
+                if size == 0 or not self.process_named:
+                    self.process_named = True
+                    f.write(
+                        json.dumps(
+                            {
+                                "name": "process_name",
+                                "ph": "M",
+                                "pid": self.pid,
+                                "args": {"name": f"ENACrestic ({const.USERNAME})"},
+                            }
+                        )
+                        + ",\n"
+                    )
+                f.write(json.dumps(event) + ",\n")
+        except OSError:
+            # Tracing must never break the backups
+            pass
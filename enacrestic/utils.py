@@ -1,4 +1,9 @@
 import datetime
+import hashlib
+import math
+import os
+import re
+import socket
 import time
 
 from enacrestic import const
@@ -38,3 +43,109 @@ def local_str_to_utc(dt):
     convert local timezone datetime in string to UTC datetime
     """
     return local_to_utc(datetime.datetime.strptime(dt, const.DATE_FORMAT))
+
+
+def parse_restic_time(restic_time):
+    """
+    convert restic's time (RFC 3339 with nanoseconds)
+    to UTC datetime
+    """
+    # Python only handles microseconds, and before 3.11 exactly 3 or 6 digits
+    # of them : any number of digits -> 6
+    restic_time = re.sub(
+        r"\.(\d+)", lambda m: "." + m.group(1)[:6].ljust(6, "0"), restic_time
+    )
+    restic_time = re.sub(r"Z$", "+00:00", restic_time)
+    aware_dt = datetime.datetime.fromisoformat(restic_time)
+    return aware_dt.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+
+def bytes_to_human(nb_bytes):
+    """
+    return nice size as 1.23 GiB
+    """
+    for unit in ("B", "KiB", "MiB", "GiB", "TiB"):
+        if abs(nb_bytes) < 1024 or unit == "TiB":
+            break
+        nb_bytes /= 1024
+    return f"{nb_bytes:.2f} {unit}"
+
+
+def host_phase_seconds(period_seconds):
+    """
+    return a deterministic offset in [0, period_seconds[
+    specific to this host and user
+    """
+    digest = hashlib.sha256(f"{socket.gethostname()}:{const.UID}".encode()).digest()
+    return int.from_bytes(digest[:8], "big") % period_seconds
+
+
+def next_phase_slot(after_utc_dt, period_seconds, phase_seconds):
+    """
+    return the first datetime >= after_utc_dt
+    that is phase_seconds after a multiple of period_seconds (since epoch)
+    """
+    epoch = datetime.datetime(1970, 1, 1)
+    seconds = (after_utc_dt - epoch).total_seconds()
+    nb_periods = math.ceil((seconds - phase_seconds) / period_seconds)
+    return epoch + datetime.timedelta(
+        seconds=nb_periods * period_seconds + phase_seconds
+    )
+
+
+def files_from_paths():
+    """
+    return the paths listed in bkp_include (as given to --files-from)
+    """
+    try:
+        with open(const.RESTIC_USER_PREFS["FILESFROM"], "r") as f:
+            return [
+                line.strip()
+                for line in f.readlines()
+                if line.strip() != "" and not line.startswith("#")
+            ]
+    except FileNotFoundError:
+        return []
+
+
+def dir_size(path):
+    """
+    return the size on disk of the files under path (bytes, 0 if it doesn't exist)
+    """
+    size = 0
+    for dir_path, _, file_names in os.walk(path):
+        for file_name in file_names:
+            try:
+                size += os.lstat(os.path.join(dir_path, file_name)).st_size
+            except OSError:
+                pass
+    return size
+
+
+def load_restic_env(path=const.RESTIC_USER_PREFS["ENV"]):
+    """
+    return the env vars expected by restic (dict),
+    as exported in ~/.enacrestic/env.sh (or path)
+    """
+    env = {}
+    variables_i_search = [
+        r"RESTIC_\S+",
+        r"AWS_ACCESS_KEY_ID",
+        r"AWS_SECRET_ACCESS_KEY",
+    ]
+    try:
+        with open(path, "r") as f:
+            for line in f.readlines():
+                # remove comments
+                # A) starting with #
+                # B) having ' #'
+                line = re.sub(r"^#.*", "", line)
+                line = re.sub(r"\s+#.*", "", line)
+
+                for var in variables_i_search:
+                    match = re.match(r"export (%s)=(.*)$" % var, line)
+                    if match:
+                        env[match.group(1)] = match.group(2)
+    except FileNotFoundError:
+        pass
+    return env